@@ -0,0 +1,223 @@
+import os
+import logging
+import math
+import time
+import asyncio
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CHAT_RETRIEVAL_CONCURRENCY = int(os.getenv("CHAT_RETRIEVAL_CONCURRENCY", "16"))
+CHAT_RETRIEVAL_QUEUE_SIZE = int(os.getenv("CHAT_RETRIEVAL_QUEUE_SIZE", "64"))
+CHAT_LLM_CONCURRENCY = int(os.getenv("CHAT_LLM_CONCURRENCY", "8"))
+CHAT_LLM_QUEUE_SIZE = int(os.getenv("CHAT_LLM_QUEUE_SIZE", "64"))
+CHAT_LLM_MIN_CONCURRENCY = int(os.getenv("CHAT_LLM_MIN_CONCURRENCY", "1"))
+# After a rate-limit cut, further 429s within this window don't cut the limit again
+LLM_BACKOFF_COOLDOWN_SECONDS = float(os.getenv("LLM_BACKOFF_COOLDOWN_SECONDS", "5"))
+# /chat/batch/: per-batch caps on concurrent retrievals and Groq generations
+CHAT_BATCH_MAX_QUERIES = int(os.getenv("CHAT_BATCH_MAX_QUERIES", "500"))
+CHAT_BATCH_RETRIEVAL_CONCURRENCY = int(os.getenv("CHAT_BATCH_RETRIEVAL_CONCURRENCY", "8"))
+CHAT_BATCH_LLM_CONCURRENCY = int(os.getenv("CHAT_BATCH_LLM_CONCURRENCY", "4"))
+
+class OverloadedError(Exception):
+    """Raised when a limiter's wait queue is full; retry_after is a hint in seconds."""
+    def __init__(self, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.retry_after = retry_after
+
+class Ticket:
+    """A reserved place in a ConcurrencyLimiter: acquire() waits for a slot, release() gives it up."""
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.acquired_at = None
+        self.released = False
+
+    async def acquire(self):
+        await self.limiter._acquire(self)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limiter._release(self)
+
+class ConcurrencyLimiter:
+    """
+    Caps concurrent work at `limit` with a FIFO wait queue of at most max_queue.
+    Callers reserve a Ticket up front (try_reserve fails fast with
+    OverloadedError when limit + max_queue tickets are out), then acquire it
+    when they actually need the slot. With adaptive=True the limit follows
+    AIMD: halved on on_rate_limited() (at most once per cooldown), grown by
+    1/limit on each on_success(), within [min_limit, max_limit].
+    """
+    def __init__(self, name: str, limit: int, max_queue: int, adaptive: bool = False,
+                 min_limit: int = 1, cooldown_seconds: float = LLM_BACKOFF_COOLDOWN_SECONDS):
+        self.name = name
+        self.max_limit = max(1, limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = float(self.max_limit)
+        self.max_queue = max_queue
+        self.adaptive = adaptive
+        self.cooldown_seconds = cooldown_seconds
+        self.active = 0
+        self.reserved = 0
+        self.waiters = deque()
+        self.last_cut = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.rate_limited = 0
+        self.acquisitions = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.avg_hold = 1.0  # EWMA of seconds a slot is held, for Retry-After hints
+
+    @property
+    def current_limit(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    def try_reserve(self) -> Ticket:
+        if self.reserved >= self.current_limit + self.max_queue:
+            self.rejected += 1
+            raise OverloadedError(f"Too many concurrent {self.name} requests; try again later.",
+                                  retry_after=self.retry_after_hint())
+        self.reserved += 1
+        self.admitted += 1
+        return Ticket(self)
+
+    def retry_after_hint(self) -> int:
+        return max(1, math.ceil(self.avg_hold * (len(self.waiters) + 1) / self.current_limit))
+
+    async def _acquire(self, ticket: Ticket):
+        started = time.monotonic()
+        if self.active < self.current_limit and not self.waiters:
+            self.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.waiters.append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self.active -= 1  # The slot was handed over just as we were cancelled
+                    self._wake()
+                else:
+                    self.waiters.remove(future)
+                raise
+        waited = time.monotonic() - started
+        self.acquisitions += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        ticket.acquired_at = time.monotonic()
+
+    def _release(self, ticket: Ticket):
+        self.reserved -= 1
+        if ticket.acquired_at is not None:
+            self.active -= 1
+            held = time.monotonic() - ticket.acquired_at
+            self.avg_hold = 0.9 * self.avg_hold + 0.1 * held
+            self._wake()
+
+    def _wake(self):
+        while self.waiters and self.active < self.current_limit:
+            future = self.waiters.popleft()
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    def on_rate_limited(self):
+        self.rate_limited += 1
+        if not self.adaptive:
+            return
+        now = time.monotonic()
+        if now - self.last_cut >= self.cooldown_seconds:
+            self.last_cut = now
+            self.limit = max(float(self.min_limit), self.limit / 2.0)
+            logger.warning(f"Upstream rate limited; {self.name} concurrency cut to {self.current_limit}.")
+
+    def on_success(self):
+        if self.adaptive and self.limit < self.max_limit:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self._wake()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.current_limit,
+            "max_limit": self.max_limit,
+            "active": self.active,
+            "waiting": len(self.waiters),
+            "reserved": self.reserved,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "rate_limited": self.rate_limited,
+            "avg_wait_ms": round(1000 * self.total_wait / self.acquisitions, 1) if self.acquisitions else 0.0,
+            "max_wait_ms": round(1000 * self.max_wait, 1),
+        }
+
+class ChatAdmission:
+    """The retrieval and LLM tickets reserved for one chat request."""
+    def __init__(self, retrieval: Ticket, llm: Ticket):
+        self.retrieval = retrieval
+        self.llm = llm
+        self.claimed = False
+
+    def claim(self):
+        """Marks the tickets as owned by a running stream, which will release them."""
+        self.claimed = True
+
+    def release(self):
+        self.retrieval.release()
+        self.llm.release()
+
+    def release_unclaimed(self):
+        """Safety net for responses whose stream never started (e.g. the client left first)."""
+        if not self.claimed:
+            self.release()
+
+retrieval_limiter = ConcurrencyLimiter("retrieval", CHAT_RETRIEVAL_CONCURRENCY, CHAT_RETRIEVAL_QUEUE_SIZE)
+llm_limiter = ConcurrencyLimiter("LLM", CHAT_LLM_CONCURRENCY, CHAT_LLM_QUEUE_SIZE,
+                                 adaptive=True, min_limit=CHAT_LLM_MIN_CONCURRENCY)
+
+def admit_chat() -> ChatAdmission:
+    """Reserves retrieval and LLM capacity for a chat, or raises OverloadedError right away."""
+    retrieval = retrieval_limiter.try_reserve()
+    try:
+        llm = llm_limiter.try_reserve()
+    except OverloadedError:
+        retrieval.release()
+        raise
+    return ChatAdmission(retrieval, llm)
+
+class BatchTicket:
+    """
+    Ticket for one query of a batch: acquire() first waits for a slot in the
+    batch's own limiter, then reserves and waits for a slot in the shared one.
+    A batch therefore never holds or queues for more shared capacity than its
+    own limit, however many queries it has. acquire() raises OverloadedError
+    if the shared queue is full.
+    """
+    def __init__(self, batch_limiter: ConcurrencyLimiter, shared_limiter: ConcurrencyLimiter):
+        self.batch_ticket = batch_limiter.try_reserve()
+        self.shared_limiter = shared_limiter
+        self.shared_ticket = None
+
+    async def acquire(self):
+        await self.batch_ticket.acquire()
+        self.shared_ticket = self.shared_limiter.try_reserve()
+        await self.shared_ticket.acquire()
+
+    def release(self):
+        if self.shared_ticket is not None:
+            self.shared_ticket.release()
+        self.batch_ticket.release()
+
+class BatchAdmission:
+    """Per-batch retrieval and LLM limiters; admit() hands out the admission for one query."""
+    def __init__(self, queries: int, retrieval_concurrency: int = CHAT_BATCH_RETRIEVAL_CONCURRENCY,
+                 llm_concurrency: int = CHAT_BATCH_LLM_CONCURRENCY):
+        # Callers may ask for less parallelism than configured, never more
+        self.retrieval = ConcurrencyLimiter("batch retrieval",
+                                            min(retrieval_concurrency, CHAT_BATCH_RETRIEVAL_CONCURRENCY), queries)
+        self.llm = ConcurrencyLimiter("batch LLM", min(llm_concurrency, CHAT_BATCH_LLM_CONCURRENCY), queries)
+
+    def admit(self) -> ChatAdmission:
+        return ChatAdmission(BatchTicket(self.retrieval, retrieval_limiter), BatchTicket(self.llm, llm_limiter))
@@ -0,0 +1,229 @@
+import re
+import zlib
+import time
+import random
+import asyncio
+import threading
+import types
+
+import httpx
+from groq import RateLimitError, InternalServerError
+
+from filter_utils import matches_metadata_filter
+
+_WORD_RE = re.compile(r"\w+")
+
+_GROQ_URL = "https://api.groq.com/openai/v1/chat/completions"
+
+_WORDS = ("latency throughput replica shard cache index vector token stream batch queue worker "
+          "request response timeout retry backoff budget quota region cluster node partition "
+          "checkpoint snapshot compaction manifest ingestion pipeline embedding retrieval ranking").split()
+
+class Latency:
+    """A delay of mean_ms +/- jitter_ms (uniform), in seconds via sample()."""
+    def __init__(self, mean_ms: float = 0.0, jitter_ms: float = 0.0):
+        self.mean_ms = mean_ms
+        self.jitter_ms = jitter_ms
+
+    def sample(self) -> float:
+        return max(0.0, self.mean_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000.0
+
+def synthetic_text(n_words: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    sentences, words = [], []
+    for i in range(n_words):
+        words.append(rng.choice(_WORDS))
+        if len(words) >= 12 or i == n_words - 1:
+            sentences.append(" ".join(words).capitalize() + ".")
+            words = []
+    return " ".join(sentences)
+
+class FakePineconeIndex:
+    """
+    Stands in for the object returned by init_pinecone_index(): implements
+    upsert_records, search, delete and describe_index_stats with the same
+    response shapes. Scores are word overlap with the query. Calls block the
+    calling thread for the configured latency (like the real, synchronous SDK)
+    and raise with probability error_rate.
+    """
+    def __init__(self, search_latency: Latency = None, upsert_latency: Latency = None,
+                 error_rate: float = 0.0):
+        self.search_latency = search_latency or Latency()
+        self.upsert_latency = upsert_latency or Latency()
+        self.error_rate = error_rate
+        self.namespaces = {}  # namespace -> {id: record}
+        self.lock = threading.Lock()
+        self.calls = {"search": 0, "upsert_records": 0, "delete": 0, "errors": 0}
+
+    def _call(self, name: str, latency: Latency):
+        with self.lock:
+            self.calls[name] += 1
+        time.sleep(latency.sample())
+        if self.error_rate and random.random() < self.error_rate:
+            with self.lock:
+                self.calls["errors"] += 1
+            raise RuntimeError(f"Injected Pinecone {name} failure")
+
+    def upsert_records(self, records: list[dict], namespace: str = ""):
+        self._call("upsert_records", self.upsert_latency)
+        with self.lock:
+            store = self.namespaces.setdefault(namespace, {})
+            for record in records:
+                store[record["id"]] = dict(record)
+
+    def search(self, namespace: str = "", query: dict = None, **kwargs):
+        self._call("search", self.search_latency)
+        query_words = set(_WORD_RE.findall(query["inputs"]["text"].lower()))
+        with self.lock:
+            records = list(self.namespaces.get(namespace, {}).values())
+        hits = []
+        for record in records:
+            if not matches_metadata_filter(record, query.get("filter")):
+                continue
+            overlap = len(query_words & set(_WORD_RE.findall(record["text"].lower())))
+            if overlap:
+                fields = {k: v for k, v in record.items() if k != "id"}
+                hits.append({"_id": record["id"], "_score": overlap / (len(query_words) or 1), "fields": fields})
+        hits.sort(key=lambda hit: -hit["_score"])
+        return {"result": {"hits": hits[:query["top_k"]]}}
+
+    def delete(self, ids: list[str] = None, namespace: str = "", **kwargs):
+        self._call("delete", Latency())
+        with self.lock:
+            store = self.namespaces.get(namespace, {})
+            for record_id in ids or []:
+                store.pop(record_id, None)
+
+    def describe_index_stats(self):
+        with self.lock:
+            namespaces = {name: types.SimpleNamespace(vector_count=len(records))
+                          for name, records in self.namespaces.items()}
+        return types.SimpleNamespace(
+            total_vector_count=sum(ns.vector_count for ns in namespaces.values()),
+            dimension=1024, index_fullness=0.0, namespaces=namespaces,
+        )
+
+class _FakeGroqStream:
+    """Async iterator of chat completion chunks, paced at tokens_per_second."""
+    def __init__(self, client, tokens: list[str], first_token_delay: float, fail_after: int = None):
+        self.client = client
+        self.tokens = tokens
+        self.first_token_delay = first_token_delay
+        self.fail_after = fail_after
+        self.position = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed or self.position >= len(self.tokens):
+            raise StopAsyncIteration
+        if self.fail_after is not None and self.position >= self.fail_after:
+            raise InternalServerError("Injected Groq failure mid-stream", body=None,
+                                      response=httpx.Response(500, request=httpx.Request("POST", _GROQ_URL)))
+        delay = self.first_token_delay if self.position == 0 else 1.0 / self.client.tokens_per_second
+        await asyncio.sleep(delay)
+        token = self.tokens[self.position]
+        self.position += 1
+        self.client.tokens_streamed += 1
+        delta = types.SimpleNamespace(content=token)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)])
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            self.client.streams_closed += 1
+
+class _FakeCompletions:
+    def __init__(self, client):
+        self.client = client
+
+    async def create(self, messages: list, model: str = None, stream: bool = False, **kwargs):
+        client = self.client
+        client.requests += 1
+        if client.error_rate and random.random() < client.error_rate:
+            client.errors += 1
+            raise RateLimitError("Injected Groq rate limit", body=None,
+                                 response=httpx.Response(429, request=httpx.Request("POST", _GROQ_URL)))
+        fail_after = None
+        if client.stream_error_rate and random.random() < client.stream_error_rate:
+            client.errors += 1
+            fail_after = random.randrange(max(1, client.answer_tokens))
+        tokens = [word + " " for word in synthetic_text(client.answer_tokens, seed=client.requests).split()]
+        return _FakeGroqStream(client, tokens, client.time_to_first_token.sample(), fail_after)
+
+class FakeGroqClient:
+    """
+    Stands in for the AsyncGroq client returned by init_groq_client(): only
+    chat.completions.create(stream=True) is implemented. The first token
+    arrives after time_to_first_token, then tokens_per_second. error_rate
+    fails the request with a 429; stream_error_rate fails it part-way through.
+    """
+    def __init__(self, time_to_first_token: Latency = None, tokens_per_second: float = 200.0,
+                 answer_tokens: int = 120, error_rate: float = 0.0, stream_error_rate: float = 0.0):
+        self.time_to_first_token = time_to_first_token or Latency()
+        self.tokens_per_second = max(1.0, tokens_per_second)
+        self.answer_tokens = max(1, answer_tokens)
+        self.error_rate = error_rate
+        self.stream_error_rate = stream_error_rate
+        self.chat = types.SimpleNamespace(completions=_FakeCompletions(self))
+        self.requests = 0
+        self.errors = 0
+        self.tokens_streamed = 0
+        self.streams_closed = 0
+
+class FakeWebServer:
+    """
+    An httpx.MockTransport handler serving synthetic HTML articles for any URL,
+    after the configured latency; error_rate answers 503 instead.
+    """
+    def __init__(self, latency: Latency = None, page_words: int = 800, error_rate: float = 0.0):
+        self.latency = latency or Latency()
+        self.page_words = page_words
+        self.error_rate = error_rate
+        self.requests = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency.sample())
+        if self.error_rate and random.random() < self.error_rate:
+            return httpx.Response(503, text="Injected failure")
+        seed = zlib.crc32(str(request.url).encode())
+        paragraphs = "".join(f"<p>{synthetic_text(100, seed + i)}</p>" for i in range(max(1, self.page_words // 100)))
+        html = (f"<html><head><title>{request.url.path}</title></head><body><nav>Home | About</nav>"
+                f"<article><h1>{request.url.path}</h1>{paragraphs}</article><footer>Footer</footer></body></html>")
+        return httpx.Response(200, headers={"Content-Type": "text/html; charset=utf-8"}, text=html)
+
+    def client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.MockTransport(self), follow_redirects=True)
+
+def make_pdf(page_texts: list[str]) -> bytes:
+    """Builds a minimal text PDF (one line of Helvetica per page) without extra dependencies."""
+    objects = []
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    pages_id = len(objects) + 2 * len(page_texts) + 1
+    kids = []
+    for text in page_texts:
+        safe = text.replace("\\", "").replace("(", "").replace(")", "")
+        stream = f"BT /F1 10 Tf 72 720 Td ({safe}) Tj ET".encode("latin-1", errors="replace")
+        content = add(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        kids.append(add(b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] /Contents %d 0 R "
+                        b"/Resources << /Font << /F1 %d 0 R >> >> >>" % (pages_id, content, font)))
+    add(b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in kids), len(kids)))
+    catalog = add(b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id)
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog, xref)
+    return out
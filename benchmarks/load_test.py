@@ -0,0 +1,330 @@
+"""
+Offline load test: runs the app in-process with fake Pinecone, Groq and web
+servers (see fakes.py), drives /chat/, /upload-pdf/ and /upload-url/
+concurrently over HTTP and writes a JSON report.
+
+    python benchmarks/load_test.py --output bench.json
+    python benchmarks/load_test.py --baseline bench.json   # compare with an earlier run
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from fakes import Latency, FakePineconeIndex, FakeGroqClient, FakeWebServer, make_pdf, synthetic_text
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    workload = parser.add_argument_group("workload")
+    workload.add_argument("--chat-requests", type=int, default=200)
+    workload.add_argument("--chat-concurrency", type=int, default=32)
+    workload.add_argument("--query-pool", type=int, default=0,
+                          help="Draw chat queries from this many distinct questions (0: every query is unique, so caches miss)")
+    workload.add_argument("--top-k", type=int, default=6)
+    workload.add_argument("--pdf-requests", type=int, default=10)
+    workload.add_argument("--pdf-concurrency", type=int, default=2)
+    workload.add_argument("--pdf-pages", type=int, default=40)
+    workload.add_argument("--url-requests", type=int, default=50)
+    workload.add_argument("--url-concurrency", type=int, default=8)
+    workload.add_argument("--url-hosts", type=int, default=10, help="Spread URL uploads over this many hosts")
+    workload.add_argument("--corpus-docs", type=int, default=2000, help="Chunks indexed before the run starts")
+
+    fakes = parser.add_argument_group("fake services (latencies in ms)")
+    fakes.add_argument("--pinecone-search-ms", type=float, default=40.0)
+    fakes.add_argument("--pinecone-upsert-ms", type=float, default=80.0)
+    fakes.add_argument("--pinecone-jitter-ms", type=float, default=10.0)
+    fakes.add_argument("--pinecone-error-rate", type=float, default=0.0)
+    fakes.add_argument("--groq-ttft-ms", type=float, default=250.0)
+    fakes.add_argument("--groq-jitter-ms", type=float, default=50.0)
+    fakes.add_argument("--groq-tokens-per-second", type=float, default=200.0)
+    fakes.add_argument("--groq-answer-tokens", type=int, default=120)
+    fakes.add_argument("--groq-error-rate", type=float, default=0.0, help="Fraction of requests failing with a 429")
+    fakes.add_argument("--groq-stream-error-rate", type=float, default=0.0, help="Fraction of streams failing mid-way")
+    fakes.add_argument("--web-latency-ms", type=float, default=100.0)
+    fakes.add_argument("--web-jitter-ms", type=float, default=30.0)
+    fakes.add_argument("--web-page-words", type=int, default=800)
+    fakes.add_argument("--web-error-rate", type=float, default=0.0)
+
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON report here (default: stdout)")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare against")
+    return parser.parse_args(argv)
+
+def prepare_environment():
+    """Points every on-disk store at a scratch directory and lifts limits meant for real sites."""
+    os.chdir(REPO_DIR)  # main.py loads .env and static/ relative to the working directory
+    scratch = tempfile.mkdtemp(prefix="rag-bench-")
+    defaults = {
+        "VECTOR_STORE_BACKEND": "pinecone",
+        "BM25_INDEX_DIR": os.path.join(scratch, "bm25_index"),
+        "LOCAL_INDEX_DIR": os.path.join(scratch, "local_index"),
+        "WEB_CACHE_PATH": os.path.join(scratch, "web_cache.sqlite3"),
+        "MANIFEST_PATH": os.path.join(scratch, "manifest.sqlite3"),
+        "WEB_RATE_LIMIT_PER_MINUTE": "1000000",
+        "CACHE_REDIS_URL": "",
+        "LOG_LEVEL": "WARNING",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    os.environ["VECTOR_STORE_BACKEND"] = "pinecone"  # The fake replaces the Pinecone index
+    return scratch
+
+def percentile(values: list[float], pct: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100.0 * len(ordered) + 0.5) - 1))
+    return round(ordered[index], 1)
+
+def summarize(samples: list[dict], elapsed: float) -> dict:
+    latencies = [s["latency_ms"] for s in samples if s["ok"]]
+    status_codes = {}
+    for s in samples:
+        status_codes[str(s["status"])] = status_codes.get(str(s["status"]), 0) + 1
+    summary = {
+        "requests": len(samples),
+        "ok": len(latencies),
+        "failed": len(samples) - len(latencies),
+        "status_codes": status_codes,
+        "elapsed_seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 50), "p90": percentile(latencies, 90), "p99": percentile(latencies, 99),
+            "max": round(max(latencies), 1) if latencies else None,
+            "mean": round(sum(latencies) / len(latencies), 1) if latencies else None,
+        },
+    }
+    ttfts = [s["ttft_ms"] for s in samples if s.get("ttft_ms") is not None]
+    if ttfts:
+        summary["ttft_ms"] = {"p50": percentile(ttfts, 50), "p90": percentile(ttfts, 90), "p99": percentile(ttfts, 99)}
+    stage_totals = {}
+    for s in samples:
+        for stage, ms in (s.get("timings") or {}).items():
+            stage_totals.setdefault(stage, []).append(ms)
+    if stage_totals:
+        summary["server_stage_ms_p50"] = {stage: percentile(values, 50) for stage, values in stage_totals.items()}
+    return summary
+
+async def run_scenario(count: int, concurrency: int, do_request) -> dict:
+    """Sends `count` requests with at most `concurrency` in flight and summarizes them."""
+    samples = []
+    next_index = iter(range(count))
+
+    async def worker():
+        for i in next_index:
+            started = time.perf_counter()
+            try:
+                sample = await do_request(i, started)
+            except Exception as e:
+                sample = {"ok": False, "status": type(e).__name__}
+            sample["latency_ms"] = (time.perf_counter() - started) * 1000
+            samples.append(sample)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, count)))))
+    return summarize(samples, time.perf_counter() - started)
+
+def make_chat_request(client, args):
+    words = synthetic_text(400, seed=args.seed).lower().replace(".", "").split()
+
+    def question(i: int) -> str:
+        key = i % args.query_pool if args.query_pool else i
+        picked = random.Random(args.seed * 1000003 + key).sample(words, 3)
+        return f"How does {picked[0]} relate to {picked[1]} and {picked[2]}? ({key})"
+
+    async def do_request(i: int, started: float) -> dict:
+        payload = {"query": question(i), "top_k": args.top_k}
+        sample = {"ok": False, "status": None, "ttft_ms": None}
+        async with client.stream("POST", "/chat/", json=payload) as response:
+            sample["status"] = response.status_code
+            if response.status_code != 200:
+                await response.aread()
+                return sample
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                    if event == "token" and sample["ttft_ms"] is None:
+                        sample["ttft_ms"] = (time.perf_counter() - started) * 1000
+                elif line.startswith("data: ") and event in ("done", "error"):
+                    data = json.loads(line[len("data: "):])
+                    if event == "done":
+                        sample["ok"] = True
+                        sample["timings"] = data.get("timings")
+                    else:
+                        sample["status"] = "stream_error"
+        return sample
+    return do_request
+
+def make_pdf_request(client, args):
+    pages = [synthetic_text(120, seed=args.seed * 1000 + page) for page in range(args.pdf_pages)]
+    pdf_bytes = make_pdf(pages)
+
+    async def do_request(i: int, started: float) -> dict:
+        files = {"file": (f"bench-{i}.pdf", pdf_bytes, "application/pdf")}
+        response = await client.post("/upload-pdf/", files=files)
+        return {"ok": response.status_code == 200, "status": response.status_code}
+    return do_request
+
+def make_url_request(client, args, run_id: str):
+    async def do_request(i: int, started: float) -> dict:
+        url = f"https://site{i % max(1, args.url_hosts)}.bench.test/{run_id}/article-{i}"
+        response = await client.post("/upload-url/", json={"url": url, "force": True})
+        return {"ok": response.status_code == 200, "status": response.status_code}
+    return do_request
+
+async def seed_corpus(store, count: int, seed: int):
+    from retrieval_utils import upsert_documents_async
+    documents = [{"id": f"corpus-{i}", "text": synthetic_text(80, seed=seed * 7919 + i),
+                  "source": f"corpus-{i // 20}.pdf", "page_number": i % 20 + 1, "chunk_index": 0}
+                 for i in range(count)]
+    await upsert_documents_async(store, documents)
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+async def run_benchmark(args) -> dict:
+    import httpx
+    import uvicorn
+    import main
+    import vector_store as vector_store_module
+
+    index = FakePineconeIndex(
+        search_latency=Latency(args.pinecone_search_ms, args.pinecone_jitter_ms),
+        upsert_latency=Latency(args.pinecone_upsert_ms, args.pinecone_jitter_ms),
+        error_rate=args.pinecone_error_rate,
+    )
+    groq = FakeGroqClient(
+        time_to_first_token=Latency(args.groq_ttft_ms, args.groq_jitter_ms),
+        tokens_per_second=args.groq_tokens_per_second, answer_tokens=args.groq_answer_tokens,
+        error_rate=args.groq_error_rate, stream_error_rate=args.groq_stream_error_rate,
+    )
+    web = FakeWebServer(Latency(args.web_latency_ms, args.web_jitter_ms), args.web_page_words, args.web_error_rate)
+
+    async def init_fake_groq_client():
+        return groq
+    vector_store_module.init_pinecone_index = lambda: index
+    main.init_groq_client = init_fake_groq_client
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=0, log_level="warning", lifespan="on"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        if server_task.done():
+            raise RuntimeError("The application failed to start; see the log above.")
+        await asyncio.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    main.web_fetcher.client = web.client()
+
+    try:
+        await seed_corpus(main.vector_store, args.corpus_docs, args.seed)
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=300.0, limits=limits) as client:
+            run_id = f"run{int(time.time())}"
+            scenarios = {
+                "chat": (args.chat_requests, args.chat_concurrency, make_chat_request(client, args)),
+                "upload_pdf": (args.pdf_requests, args.pdf_concurrency, make_pdf_request(client, args)),
+                "upload_url": (args.url_requests, args.url_concurrency, make_url_request(client, args, run_id)),
+            }
+            scenarios = {name: spec for name, spec in scenarios.items() if spec[0] > 0}
+            started = time.perf_counter()
+            results = await asyncio.gather(*(run_scenario(*spec) for spec in scenarios.values()))
+            wall = time.perf_counter() - started
+    finally:
+        server.should_exit = True
+        await server_task  # Runs the app's shutdown, which also stops the worker process pools
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        },
+        "wall_seconds": round(wall, 3),
+        "endpoints": dict(zip(scenarios, results)),
+        "peak_memory_mb": {
+            # ru_maxrss is in KiB on Linux; "children" covers the PDF/HTML worker processes once they exit
+            "main_process": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "worker_processes": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        },
+        "upstream": {
+            "pinecone_calls": dict(index.calls),
+            "groq": {"requests": groq.requests, "errors": groq.errors, "tokens_streamed": groq.tokens_streamed,
+                     "streams_closed": groq.streams_closed},
+            "web_requests": web.requests,
+        },
+    }
+
+# (label, path into the report, True if higher is better)
+_COMPARED_METRICS = [
+    ("{name} rps", ("endpoints", "{name}", "requests_per_second"), True),
+    ("{name} p50 ms", ("endpoints", "{name}", "latency_ms", "p50"), False),
+    ("{name} p99 ms", ("endpoints", "{name}", "latency_ms", "p99"), False),
+    ("{name} ttft p50 ms", ("endpoints", "{name}", "ttft_ms", "p50"), False),
+    ("{name} ttft p99 ms", ("endpoints", "{name}", "ttft_ms", "p99"), False),
+]
+
+def _lookup(report: dict, path: tuple):
+    for key in path:
+        if not isinstance(report, dict) or key not in report:
+            return None
+        report = report[key]
+    return report
+
+def compare_reports(baseline: dict, current: dict) -> list[str]:
+    """One line per metric present in both reports: baseline, current and the relative change."""
+    rows = []
+    names = [name for name in current.get("endpoints", {}) if name in baseline.get("endpoints", {})]
+    metrics = [(label.format(name=name), tuple(part.format(name=name) for part in path), higher_is_better)
+               for name in names for label, path, higher_is_better in _COMPARED_METRICS]
+    metrics.append(("peak memory MB", ("peak_memory_mb", "main_process"), False))
+    for label, path, higher_is_better in metrics:
+        before, after = _lookup(baseline, path), _lookup(current, path)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        better = change > 0 if higher_is_better else change < 0
+        verdict = "" if abs(change) < 5 else ("better" if better else "WORSE")
+        rows.append(f"{label:<26} {before:>10} -> {after:>10}  {change:+6.1f}%  {verdict}")
+    return rows
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    scratch = prepare_environment()
+    report = asyncio.run(run_benchmark(args))
+    report["meta"]["scratch_dir"] = scratch
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.baseline} (commit {baseline.get('meta', {}).get('git_commit')}):", file=sys.stderr)
+        for row in compare_reports(baseline, report):
+            print("  " + row, file=sys.stderr)
+
+if __name__ == "__main__":
+    main_cli()
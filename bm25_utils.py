@@ -0,0 +1,274 @@
+import os
+import logging
+import re
+import math
+import time
+import heapq
+import pickle
+import threading
+from array import array
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from filter_utils import matches_metadata_filter
+
+logger = logging.getLogger(__name__)
+
+BM25_INDEX_DIR = os.getenv("BM25_INDEX_DIR", "bm25_index")
+BM25_SAVE_INTERVAL_SECONDS = float(os.getenv("BM25_SAVE_INTERVAL_SECONDS", "30"))
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# Identifier-like tokens ("ERR-404", "v2.3.1", "foo_bar") are kept whole and also split into parts
+_COMPOUND_RE = re.compile(r"\w+(?:[.\-:/]\w+)+", re.UNICODE)
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_STORED_FIELDS = ("text", "source", "page_number", "chunk_index")
+
+def tokenize(text: str) -> list[str]:
+    lowered = text.lower()
+    return _WORD_RE.findall(lowered) + _COMPOUND_RE.findall(lowered)
+
+class BM25Index:
+    """
+    Incremental BM25 index for one namespace.
+    Each term has an array-backed posting list: doc numbers (array 'I') and term
+    frequencies (array 'H'). Re-upserting or deleting a document only tombstones
+    its doc number; dead postings are skipped at query time and dropped by
+    compact() once they make up half of the index.
+    """
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.term_ids = {}
+        self.postings_docs = []      # term_id -> array('I') of doc numbers
+        self.postings_tfs = []       # term_id -> array('H') of term frequencies
+        self.doc_ids = []            # doc number -> external id (None once deleted)
+        self.doc_fields = []         # doc number -> stored fields (None once deleted)
+        self.doc_lengths = array("I")
+        self.id_to_doc = {}
+        self.total_length = 0
+        self.dead_docs = 0
+
+    @property
+    def document_count(self) -> int:
+        return len(self.id_to_doc)
+
+    def add(self, document: dict):
+        self.remove(document["id"])
+        terms = tokenize(document["text"])
+        doc_number = len(self.doc_ids)
+        self.doc_ids.append(document["id"])
+        self.doc_fields.append({k: document.get(k) for k in _STORED_FIELDS})
+        self.doc_lengths.append(len(terms))
+        self.id_to_doc[document["id"]] = doc_number
+        self.total_length += len(terms)
+
+        frequencies = {}
+        for term in terms:
+            frequencies[term] = frequencies.get(term, 0) + 1
+        for term, tf in frequencies.items():
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                term_id = len(self.postings_docs)
+                self.term_ids[term] = term_id
+                self.postings_docs.append(array("I"))
+                self.postings_tfs.append(array("H"))
+            self.postings_docs[term_id].append(doc_number)
+            self.postings_tfs[term_id].append(min(tf, 65535))
+
+    def remove(self, doc_id: str) -> bool:
+        doc_number = self.id_to_doc.pop(doc_id, None)
+        if doc_number is None:
+            return False
+        self.doc_ids[doc_number] = None
+        self.doc_fields[doc_number] = None
+        self.total_length -= self.doc_lengths[doc_number]
+        self.dead_docs += 1
+        if self.dead_docs > 1000 and self.dead_docs > len(self.doc_ids) // 2:
+            self.compact()
+        return True
+
+    def compact(self):
+        """Renumbers live documents and rebuilds the postings without tombstoned entries."""
+        remap = {}
+        doc_ids, doc_fields, doc_lengths = [], [], array("I")
+        for old_number, doc_id in enumerate(self.doc_ids):
+            if doc_id is None:
+                continue
+            remap[old_number] = len(doc_ids)
+            doc_ids.append(doc_id)
+            doc_fields.append(self.doc_fields[old_number])
+            doc_lengths.append(self.doc_lengths[old_number])
+        term_ids, postings_docs, postings_tfs = {}, [], []
+        for term, term_id in self.term_ids.items():
+            docs, tfs = array("I"), array("H")
+            for doc_number, tf in zip(self.postings_docs[term_id], self.postings_tfs[term_id]):
+                new_number = remap.get(doc_number)
+                if new_number is not None:
+                    docs.append(new_number)
+                    tfs.append(tf)
+            if docs:
+                term_ids[term] = len(postings_docs)
+                postings_docs.append(docs)
+                postings_tfs.append(tfs)
+        self.doc_ids, self.doc_fields, self.doc_lengths = doc_ids, doc_fields, doc_lengths
+        self.term_ids, self.postings_docs, self.postings_tfs = term_ids, postings_docs, postings_tfs
+        self.id_to_doc = {doc_id: number for number, doc_id in enumerate(doc_ids)}
+        self.dead_docs = 0
+
+    def search(self, query_text: str, top_k: int, predicate=None) -> list[dict]:
+        """predicate, if given, is called with a document's stored fields; documents it rejects are skipped."""
+        live_docs = self.document_count
+        if live_docs == 0 or top_k <= 0:
+            return []
+        avg_length = self.total_length / live_docs or 1.0
+        scores = {}
+        for term in set(tokenize(query_text)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            matches = [
+                (doc_number, tf)
+                for doc_number, tf in zip(self.postings_docs[term_id], self.postings_tfs[term_id])
+                if self.doc_ids[doc_number] is not None
+            ]
+            if not matches:
+                continue
+            # IDF comes from the whole namespace, so filtering doesn't change how terms are weighted
+            idf = math.log(1.0 + (live_docs - len(matches) + 0.5) / (len(matches) + 0.5))
+            for doc_number, tf in matches:
+                if predicate is not None and not predicate(self.doc_fields[doc_number]):
+                    continue
+                norm = self.k1 * (1.0 - self.b + self.b * self.doc_lengths[doc_number] / avg_length)
+                scores[doc_number] = scores.get(doc_number, 0.0) + idf * tf * (self.k1 + 1.0) / (tf + norm)
+        hits = []
+        for doc_number, score in heapq.nlargest(top_k, scores.items(), key=lambda item: item[1]):
+            hit = {"id": self.doc_ids[doc_number], "score": score}
+            hit.update(self.doc_fields[doc_number])
+            hits.append(hit)
+        return hits
+
+class LexicalIndex:
+    """
+    BM25 indexes for all namespaces, kept in sync by retrieval_utils as documents
+    are upserted/deleted and pickled to BM25_INDEX_DIR (throttled to one save
+    per BM25_SAVE_INTERVAL_SECONDS per namespace, plus a final save on shutdown).
+    Only documents that went through this process are indexed, so the index
+    must have a single owner process: claim_directory() enforces that.
+    """
+    def __init__(self, directory: str = BM25_INDEX_DIR, save_interval: float = BM25_SAVE_INTERVAL_SECONDS):
+        self.directory = directory
+        self.save_interval = save_interval
+        self.indexes = {}
+        self.dirty = set()
+        self.last_saved = {}
+        self.lock = threading.RLock()
+        self.lock_file = None
+
+    def claim_directory(self):
+        """
+        Takes an exclusive lock on the index directory for this process. Several
+        uvicorn workers would each index only their own upserts, return different
+        hybrid results and overwrite each other's saved indexes, so a second
+        process fails here with RuntimeError.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        lock_file = open(os.path.join(self.directory, ".lock"), "a+")
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError(
+                f"BM25 index directory {self.directory} is in use by another process. Hybrid search needs "
+                f"a single worker; run one uvicorn worker or set HYBRID_SEARCH_ENABLED=false."
+            )
+        self.lock_file = lock_file
+
+    def release_directory(self):
+        if self.lock_file is not None:
+            self.lock_file.close()  # Closing the file drops the lock
+            self.lock_file = None
+
+    def _path(self, namespace: str) -> str:
+        safe = re.sub(r"[^A-Za-z0-9_.-]", "_", namespace)
+        return os.path.join(self.directory, f"ns-{safe}.pkl" if namespace else "default.pkl")
+
+    def _index(self, namespace: str) -> BM25Index:
+        index = self.indexes.get(namespace)
+        if index is None:
+            path = self._path(namespace)
+            index = BM25Index()
+            if os.path.exists(path):
+                try:
+                    with open(path, "rb") as f:
+                        index = pickle.load(f)
+                except Exception as e:
+                    logger.warning(f"Could not load BM25 index {path}, starting empty: {e}")
+            self.indexes[namespace] = index
+        return index
+
+    def add_documents(self, documents: list[dict], namespace: str = ""):
+        with self.lock:
+            index = self._index(namespace)
+            for document in documents:
+                if document.get("id") and document.get("text"):
+                    index.add(document)
+            self._mark_dirty(namespace)
+
+    def delete_documents(self, ids: list[str], namespace: str = ""):
+        with self.lock:
+            index = self._index(namespace)
+            for doc_id in ids:
+                index.remove(doc_id)
+            self._mark_dirty(namespace)
+
+    def search(self, query_text: str, top_k: int, namespace: str = "", metadata_filter: dict = None) -> list[dict]:
+        predicate = (lambda fields: matches_metadata_filter(fields, metadata_filter)) if metadata_filter else None
+        with self.lock:
+            return self._index(namespace).search(query_text, top_k, predicate)
+
+    def _mark_dirty(self, namespace: str):
+        self.dirty.add(namespace)
+        if time.monotonic() - self.last_saved.get(namespace, 0.0) >= self.save_interval:
+            self.save(namespace)
+
+    def save(self, namespace: str):
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(namespace)
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(self._index(namespace), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+            self.dirty.discard(namespace)
+            self.last_saved[namespace] = time.monotonic()
+
+    def save_all(self):
+        with self.lock:
+            for namespace in list(self.dirty):
+                self.save(namespace)
+
+def reciprocal_rank_fusion(ranked_lists: list[list[dict]], top_k: int, k: int = RRF_K) -> list[dict]:
+    """
+    Merges several best-first hit lists by id with reciprocal rank fusion:
+    score(d) = sum(1 / (k + rank)). Each fused hit keeps the fields of its first
+    occurrence and gets the fused score as "rrf_score".
+    """
+    fused = {}
+    for hits in ranked_lists:
+        for rank, hit in enumerate(hits, start=1):
+            entry = fused.get(hit["id"])
+            if entry is None:
+                entry = dict(hit)
+                entry["rrf_score"] = 0.0
+                fused[hit["id"]] = entry
+            entry["rrf_score"] += 1.0 / (k + rank)
+    return sorted(fused.values(), key=lambda hit: hit["rrf_score"], reverse=True)[:top_k]
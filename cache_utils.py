@@ -0,0 +1,268 @@
+import os
+import logging
+import json
+import time
+import hashlib
+from collections import OrderedDict
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:  # Optional: only needed for the shared (multi-worker) backend
+    redis_asyncio = None
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.getenv("RETRIEVAL_CACHE_MAX_ENTRIES", "1024"))
+RETRIEVAL_CACHE_MAX_BYTES = int(os.getenv("RETRIEVAL_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RETRIEVAL_CACHE_TTL_SECONDS = float(os.getenv("RETRIEVAL_CACHE_TTL_SECONDS", "300"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "512"))
+ANSWER_CACHE_MAX_BYTES = int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+# e.g. redis://localhost:6379/0 - lets all uvicorn workers share one cache
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "")
+
+def normalize_query(query: str) -> str:
+    """Lowercases and collapses whitespace so trivially different spellings share a cache entry."""
+    return " ".join(query.lower().split())
+
+def make_cache_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+class LRUCache:
+    """
+    In-process LRU cache with a TTL, an entry cap and an approximate memory cap.
+    Entries carry a tag (the namespace) so everything written for a namespace can
+    be dropped at once; a per-tag generation counter makes sure a value fetched
+    before an invalidation is not stored after it.
+    """
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # key -> (expires_at, size, tag, value)
+        self.generations = {}
+        self.current_bytes = 0
+        self.evictions = 0
+
+    def generation(self, tag: str) -> int:
+        return self.generations.get(tag, 0)
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[3]
+
+    def set(self, key: str, value, size: int, tag: str = "", generation: int = None):
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        if generation is not None and generation != self.generation(tag):
+            return  # The tag was invalidated while the value was being fetched
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, size, tag, value)
+        self.current_bytes += size
+        while len(self.entries) > self.max_entries or self.current_bytes > self.max_bytes:
+            oldest_key = next(iter(self.entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def invalidate_tag(self, tag: str) -> int:
+        self.generations[tag] = self.generation(tag) + 1
+        stale_keys = [key for key, entry in self.entries.items() if entry[2] == tag]
+        for key in stale_keys:
+            self._remove(key)
+        return len(stale_keys)
+
+    def clear(self):
+        self.entries.clear()
+        self.current_bytes = 0
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
+
+class RedisCache:
+    """
+    Shared cache backend for running several uvicorn workers. Invalidation bumps a
+    per-tag generation counter in Redis that is part of every key, so all workers
+    stop seeing stale entries at once; old keys simply expire via their TTL.
+    The memory cap is Redis' own `maxmemory` policy.
+    """
+    def __init__(self, url: str, ttl_seconds: float, prefix: str):
+        if redis_asyncio is None:
+            raise ValueError("CACHE_REDIS_URL is set but the 'redis' package is not installed.")
+        self.client = redis_asyncio.from_url(url)
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    async def generation(self, tag: str) -> int:
+        value = await self.client.get(f"{self.prefix}:gen:{tag}")
+        return int(value) if value else 0
+
+    async def get(self, key: str, tag: str):
+        generation = await self.generation(tag)
+        raw = await self.client.get(f"{self.prefix}:{tag}:{generation}:{key}")
+        return (json.loads(raw) if raw is not None else None), generation
+
+    async def set(self, key: str, value, tag: str, generation: int):
+        await self.client.set(f"{self.prefix}:{tag}:{generation}:{key}", json.dumps(value), ex=max(1, int(self.ttl_seconds)))
+
+    async def invalidate_tag(self, tag: str):
+        await self.client.incr(f"{self.prefix}:gen:{tag}")
+
+    async def close(self):
+        await self.client.aclose()
+
+class RetrievalCache:
+    """Caches retrieval results keyed on normalized query, top_k, namespace and metadata filter."""
+    def __init__(self, max_entries: int = RETRIEVAL_CACHE_MAX_ENTRIES, max_bytes: int = RETRIEVAL_CACHE_MAX_BYTES,
+                 ttl_seconds: float = RETRIEVAL_CACHE_TTL_SECONDS, redis_url: str = CACHE_REDIS_URL):
+        self.enabled = max_entries > 0
+        self.local = LRUCache(max_entries, max_bytes, ttl_seconds)
+        self.shared = RedisCache(redis_url, ttl_seconds, prefix="rag:retrieval") if redis_url else None
+        self.hits = 0
+        self.misses = 0
+
+    async def get_or_fetch(self, query: str, top_k: int, namespace: str, fetch, metadata_filter: dict = None):
+        """Returns the cached contexts for this query, or awaits fetch() and caches its result."""
+        if not self.enabled:
+            return await fetch()
+        key = make_cache_key(normalize_query(query), top_k, namespace, metadata_filter)
+
+        if self.shared is not None:
+            try:
+                cached, generation = await self.shared.get(key, namespace)
+            except Exception as e:
+                logger.warning(f"Shared retrieval cache unavailable, bypassing it: {e}")
+                return await fetch()
+            if cached is not None:
+                self.hits += 1
+                return cached
+            self.misses += 1
+            contexts = await fetch()
+            try:
+                await self.shared.set(key, contexts, namespace, generation)
+            except Exception as e:
+                logger.warning(f"Failed to write to shared retrieval cache: {e}")
+            return contexts
+
+        cached = self.local.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        generation = self.local.generation(namespace)
+        contexts = await fetch()
+        self.local.set(key, contexts, len(json.dumps(contexts, default=str)), tag=namespace, generation=generation)
+        return contexts
+
+    async def invalidate_namespace(self, namespace: str):
+        self.local.invalidate_tag(namespace)
+        if self.shared is not None:
+            try:
+                await self.shared.invalidate_tag(namespace)
+            except Exception as e:
+                logger.warning(f"Failed to invalidate shared retrieval cache for namespace '{namespace}': {e}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": "redis" if self.shared is not None else "memory",
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": len(self.local.entries),
+            "bytes": self.local.current_bytes,
+            "evictions": self.local.evictions,
+        }
+
+    async def close(self):
+        if self.shared is not None:
+            await self.shared.close()
+
+class AnswerCache:
+    """
+    Caches complete LLM answers keyed on namespace, normalized query, a hash of
+    the ids of the passages sent as context, and the model name. Chunk ids are
+    only unique within a namespace, so the namespace must be part of the key.
+    Entries are also tagged with it, so re-upserting documents drops the
+    answers built on them.
+    """
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, max_bytes: int = ANSWER_CACHE_MAX_BYTES,
+                 ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS, redis_url: str = CACHE_REDIS_URL):
+        self.enabled = max_entries > 0
+        self.local = LRUCache(max_entries, max_bytes, ttl_seconds)
+        self.shared = RedisCache(redis_url, ttl_seconds, prefix="rag:answer") if redis_url else None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    @staticmethod
+    def make_key(query: str, context_ids: list[str], model: str, namespace: str = "") -> str:
+        context_hash = hashlib.sha256("\n".join(context_ids).encode("utf-8")).hexdigest()
+        return make_cache_key(namespace, normalize_query(query), context_hash, model)
+
+    async def get(self, key: str, namespace: str):
+        """Returns (answer or None, generation). Pass the generation back to set()."""
+        if not self.enabled:
+            return None, 0
+        if self.shared is not None:
+            try:
+                answer, generation = await self.shared.get(key, namespace)
+            except Exception as e:
+                logger.warning(f"Shared answer cache unavailable, bypassing it: {e}")
+                return None, None
+        else:
+            answer, generation = self.local.get(key), self.local.generation(namespace)
+        if answer is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return answer, generation
+
+    async def set(self, key: str, answer: str, namespace: str, generation: int):
+        """Stores a finished answer, unless the namespace was invalidated since get()."""
+        if not self.enabled or generation is None or not answer:
+            return
+        if self.shared is not None:
+            try:
+                await self.shared.set(key, answer, namespace, generation)
+            except Exception as e:
+                logger.warning(f"Failed to write to shared answer cache: {e}")
+                return
+        else:
+            if generation != self.local.generation(namespace):
+                return
+            self.local.set(key, answer, len(answer.encode("utf-8")), tag=namespace, generation=generation)
+        self.stores += 1
+
+    async def invalidate_namespace(self, namespace: str):
+        self.local.invalidate_tag(namespace)
+        if self.shared is not None:
+            try:
+                await self.shared.invalidate_tag(namespace)
+            except Exception as e:
+                logger.warning(f"Failed to invalidate shared answer cache for namespace '{namespace}': {e}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": "redis" if self.shared is not None else "memory",
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stored": self.stores,
+            "entries": len(self.local.entries),
+            "bytes": self.local.current_bytes,
+            "evictions": self.local.evictions,
+        }
+
+    async def close(self):
+        if self.shared is not None:
+            await self.shared.close()
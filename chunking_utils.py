@@ -0,0 +1,94 @@
+import os
+import re
+
+# multilingual-e5-large truncates its input at 512 tokens; stay below that with
+# room for the subword overhead our approximate token count doesn't see.
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "350"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "50"))
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?。！？])\s+|\n{2,}")
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap, tokenizer-free token estimate: words and punctuation marks each count
+    as one token, plus a third for subword splits of longer words.
+    """
+    tokens = _TOKEN_RE.findall(text)
+    long_words = sum(1 for t in tokens if len(t) > 6)
+    return len(tokens) + long_words // 3
+
+def split_sentences(text: str) -> list[str]:
+    return [s.strip() for s in _SENTENCE_END_RE.split(text) if s and s.strip()]
+
+def _split_long_sentence(sentence: str, max_tokens: int) -> list[str]:
+    """
+    Splits a single sentence that is over the limit on word boundaries.
+    Tokens never span whitespace, so the estimate is kept as running counts
+    per word instead of re-counting the joined piece (linear, not quadratic).
+    """
+    pieces, current = [], []
+    token_count, long_words = 0, 0
+    for word in sentence.split():
+        current.append(word)
+        tokens = _TOKEN_RE.findall(word)
+        token_count += len(tokens)
+        long_words += sum(1 for t in tokens if len(t) > 6)
+        if token_count + long_words // 3 >= max_tokens:
+            pieces.append(" ".join(current))
+            current, token_count, long_words = [], 0, 0
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+def chunk_text(text: str, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> list[str]:
+    """
+    Splits text into chunks of at most ~max_tokens on sentence boundaries.
+    Consecutive chunks share their last/first sentences, up to overlap_tokens,
+    so a passage that straddles a boundary is still retrievable as a whole.
+    """
+    sentences = []
+    for sentence in split_sentences(text):
+        if estimate_tokens(sentence) > max_tokens:
+            sentences.extend(_split_long_sentence(sentence, max_tokens))
+        else:
+            sentences.append(sentence)
+
+    chunks = []
+    current, current_tokens = [], 0
+    for sentence in sentences:
+        sentence_tokens = estimate_tokens(sentence)
+        if current and current_tokens + sentence_tokens > max_tokens:
+            chunks.append(" ".join(current))
+            # Carry the tail of this chunk over as the start of the next one
+            overlap, overlap_count = [], 0
+            for previous in reversed(current):
+                previous_tokens = estimate_tokens(previous)
+                if overlap_count + previous_tokens > overlap_tokens:
+                    break
+                overlap.insert(0, previous)
+                overlap_count += previous_tokens
+            if overlap_count + sentence_tokens > max_tokens:
+                overlap, overlap_count = [], 0
+            current, current_tokens = overlap, overlap_count
+        current.append(sentence)
+        current_tokens += sentence_tokens
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+def chunk_document(id_prefix: str, text: str, source: str, page_number: int) -> list[dict]:
+    """
+    Chunks one extracted page/document into upsert-ready records:
+    {"id": "{id_prefix}-chunk-{i}", "text": ..., "source": ..., "page_number": ..., "chunk_index": i}
+    """
+    return [
+        {
+            "id": f"{id_prefix}-chunk-{i}",
+            "text": chunk,
+            "source": source,
+            "page_number": page_number,
+            "chunk_index": i,
+        }
+        for i, chunk in enumerate(chunk_text(text))
+    ]
@@ -0,0 +1,23 @@
+import re
+
+# The default collection is the unnamed namespace, which holds everything ingested before collections existed
+DEFAULT_COLLECTION = "default"
+_COLLECTION_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,62}$")
+
+def collection_namespace(collection: str = None) -> str:
+    """
+    Maps a collection name to the vector store namespace that holds it.
+    Names are 1-63 letters, digits, "_" or "-", starting with a letter or
+    digit; raises ValueError otherwise.
+    """
+    name = (collection or DEFAULT_COLLECTION).strip()
+    if name == DEFAULT_COLLECTION:
+        return ""
+    if not _COLLECTION_RE.match(name):
+        raise ValueError(f"Invalid collection name {name!r}: use 1-63 letters, digits, '_' or '-', "
+                         f"starting with a letter or digit.")
+    return name
+
+def namespace_collection(namespace: str) -> str:
+    """Inverse of collection_namespace."""
+    return namespace or DEFAULT_COLLECTION
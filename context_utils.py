@@ -0,0 +1,122 @@
+import os
+import re
+
+from chunking_utils import estimate_tokens, split_sentences
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_MAX_PASSAGE_TOKENS = int(os.getenv("CONTEXT_MAX_PASSAGE_TOKENS", "600"))
+# Passages whose word-trigram Jaccard similarity reaches this are treated as duplicates
+CONTEXT_DEDUPE_THRESHOLD = float(os.getenv("CONTEXT_DEDUPE_THRESHOLD", "0.8"))
+# MMR trade-off: 1.0 = relevance only, 0.0 = diversity only
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+def _words(text: str) -> list[str]:
+    return _WORD_RE.findall(text.lower())
+
+def _shingles(words: list[str], size: int = 3) -> set:
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def _jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def trim_passage(text: str, query_terms: set, max_tokens: int) -> str:
+    """
+    Cuts a passage that is over max_tokens down to the run of consecutive
+    sentences, within max_tokens, that contains the most query terms.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    sentences = split_sentences(text) or [text]
+    sentence_tokens = [estimate_tokens(s) for s in sentences]
+    sentence_hits = [len(query_terms.intersection(_words(s))) for s in sentences]
+
+    best_start, best_end, best_hits = 0, 0, -1
+    start, window_tokens, window_hits = 0, 0, 0
+    for end in range(len(sentences)):
+        window_tokens += sentence_tokens[end]
+        window_hits += sentence_hits[end]
+        while window_tokens > max_tokens and start < end:
+            window_tokens -= sentence_tokens[start]
+            window_hits -= sentence_hits[start]
+            start += 1
+        if window_hits > best_hits and window_tokens <= max_tokens:
+            best_start, best_end, best_hits = start, end + 1, window_hits
+    if best_hits < 0:
+        # Even a single sentence is over the limit: fall back to a word cut
+        return " ".join(text.split()[:max_tokens // 2])
+    return " ".join(sentences[best_start:best_end])
+
+def build_context(query: str, hits: list[dict], token_budget: int = CONTEXT_TOKEN_BUDGET,
+                  max_passage_tokens: int = CONTEXT_MAX_PASSAGE_TOKENS,
+                  dedupe_threshold: float = CONTEXT_DEDUPE_THRESHOLD,
+                  mmr_lambda: float = CONTEXT_MMR_LAMBDA) -> dict:
+    """
+    Picks the passages to send to the LLM from retrieved hits (best first):
+    drops near-duplicates, trims oversized passages around their best-matching
+    span, then selects by maximal marginal relevance until token_budget is used.
+    Returns {"passages": [...], "context": str, "tokens_retrieved": int,
+    "tokens_used": int, "tokens_saved": int, "duplicates_dropped": int}.
+    Each returned passage is a copy of its hit with "text" possibly trimmed.
+    """
+    query_terms = set(_words(query))
+    tokens_retrieved = 0
+    candidates = []
+    duplicates_dropped = 0
+    top_score = max((hit.get("rrf_score", hit.get("score")) or 0.0 for hit in hits), default=0.0) or 1.0
+
+    for rank, hit in enumerate(hits):
+        text = (hit.get("text") or "").strip()
+        if not text:
+            continue
+        tokens_retrieved += estimate_tokens(text)
+        shingles = _shingles(_words(text))
+        if any(_jaccard(shingles, kept["shingles"]) >= dedupe_threshold for kept in candidates):
+            duplicates_dropped += 1
+            continue
+        trimmed = trim_passage(text, query_terms, max_passage_tokens)
+        passage = dict(hit)
+        passage["text"] = trimmed
+        score = hit.get("rrf_score", hit.get("score")) or 0.0
+        candidates.append({
+            "passage": passage,
+            "shingles": shingles,
+            "words": set(_words(trimmed)),
+            "tokens": estimate_tokens(trimmed),
+            # Fall back to rank order when the backend gives no usable score
+            "relevance": score / top_score if score else 1.0 / (rank + 1),
+        })
+
+    selected = []
+    tokens_used = 0
+    remaining = list(candidates)
+    while remaining:
+        best, best_value = None, None
+        for candidate in remaining:
+            if tokens_used + candidate["tokens"] > token_budget:
+                continue
+            redundancy = max((_jaccard(candidate["words"], chosen["words"]) for chosen in selected), default=0.0)
+            value = mmr_lambda * candidate["relevance"] - (1.0 - mmr_lambda) * redundancy
+            if best_value is None or value > best_value:
+                best, best_value = candidate, value
+        if best is None:
+            break
+        selected.append(best)
+        tokens_used += best["tokens"]
+        remaining.remove(best)
+
+    passages = [candidate["passage"] for candidate in selected]
+    return {
+        "passages": passages,
+        "context": CONTEXT_SEPARATOR.join(passage["text"] for passage in passages),
+        "tokens_retrieved": tokens_retrieved,
+        "tokens_used": tokens_used,
+        "tokens_saved": max(0, tokens_retrieved - tokens_used),
+        "duplicates_dropped": duplicates_dropped,
+    }
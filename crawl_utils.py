@@ -0,0 +1,279 @@
+import os
+import logging
+import zlib
+import time
+import asyncio
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit
+
+from chunking_utils import chunk_document
+from retrieval_utils import upsert_documents_async, run_ingest_blocking
+from ingest_utils import (
+    IngestionProgress, IngestionInputError, TransientIngestionError, INGEST_FLUSH_THRESHOLD, finish_source_syncs
+)
+from manifest_utils import SourceSync, SourceBusyError
+from web_utils import get_parse_pool, canonicalize_url, page_source_url
+
+logger = logging.getLogger(__name__)
+
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "8"))
+CRAWL_MAX_PAGES = int(os.getenv("CRAWL_MAX_PAGES", "500"))
+CRAWL_MAX_DEPTH = int(os.getenv("CRAWL_MAX_DEPTH", "3"))
+SITEMAP_MAX_FILES = int(os.getenv("SITEMAP_MAX_FILES", "50"))
+# Limit on a sitemap's decompressed size (the sitemap protocol allows 50 MB)
+SITEMAP_MAX_BYTES = int(os.getenv("SITEMAP_MAX_BYTES", str(50 * 1024 * 1024)))
+SITEMAP_CONTENT_TYPES = ("application/xml", "text/xml", "application/gzip", "application/x-gzip",
+                         "application/octet-stream", "text/plain")
+
+def _host(url: str) -> str:
+    return (urlsplit(url).hostname or "").lower()
+
+def _domain_allowed(url: str, allowed_domains: set) -> bool:
+    """True if the URL's host is one of allowed_domains or a subdomain of one."""
+    host = _host(url)
+    return any(host == domain or host.endswith("." + domain) for domain in allowed_domains)
+
+def parse_sitemap(body: bytes) -> tuple[list[str], list[str]]:
+    """
+    Parses a sitemap (XML, gzipped XML or plain text with one URL per line).
+    Returns (page_urls, child_sitemap_urls); the latter is only non-empty for a sitemap index.
+    Gzipped bodies are decompressed incrementally and rejected with
+    IngestionInputError once they exceed SITEMAP_MAX_BYTES.
+    """
+    if body[:2] == b"\x1f\x8b":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        body = decompressor.decompress(body, SITEMAP_MAX_BYTES + 1)
+        if len(body) > SITEMAP_MAX_BYTES or decompressor.unconsumed_tail:
+            raise IngestionInputError(f"Sitemap is larger than {SITEMAP_MAX_BYTES} bytes when decompressed.")
+    stripped = body.lstrip()
+    if not stripped.startswith(b"<"):
+        lines = (line.strip() for line in stripped.decode("utf-8", errors="replace").splitlines())
+        return [line for line in lines if line.startswith(("http://", "https://"))], []
+    root = ET.fromstring(stripped)
+    locs = [el.text.strip() for el in root.iter() if el.tag.endswith("loc") and el.text and el.text.strip()]
+    if root.tag.endswith("sitemapindex"):
+        return [], locs
+    return locs, []
+
+async def load_sitemap_urls(web_fetcher, sitemap_url: str, max_urls: int) -> list[str]:
+    """
+    Collects page URLs from a sitemap, following sitemap indexes (up to
+    SITEMAP_MAX_FILES sitemap files). Raises if the top-level sitemap can't be read.
+    """
+    urls = []
+    pending = [sitemap_url]
+    files_read = 0
+    while pending and files_read < SITEMAP_MAX_FILES and len(urls) < max_urls:
+        current = pending.pop(0)
+        files_read += 1
+        result = await web_fetcher.fetch_raw(current, allowed_types=SITEMAP_CONTENT_TYPES)
+        try:
+            if result.error is not None:
+                raise (TransientIngestionError if result.retryable else IngestionInputError)(
+                    result.error, status_code=result.error_status)
+            # Decompressing and parsing up to SITEMAP_MAX_BYTES of XML is CPU-bound: keep it off the event loop
+            loop = asyncio.get_running_loop()
+            page_urls, child_sitemaps = await loop.run_in_executor(get_parse_pool(), parse_sitemap, result.body)
+        except (ET.ParseError, OSError, zlib.error) as e:
+            if current == sitemap_url:
+                raise IngestionInputError(f"Could not parse sitemap {current}: {e}")
+            logger.warning(f"Skipping unreadable sitemap {current}: {e}")
+            continue
+        except (IngestionInputError, TransientIngestionError) as e:
+            if current == sitemap_url:
+                raise
+            logger.warning(f"Skipping sitemap {current}: {e}")
+            continue
+        urls.extend(page_urls)
+        pending.extend(child_sitemaps)
+    return urls[:max_urls]
+
+class _CrawlState:
+    def __init__(self, max_pages: int):
+        self.max_pages = max_pages
+        self.queued = set()          # canonical URLs ever queued
+        self.fetched = set()         # canonical URLs of pages already stored (incl. redirects/rel=canonical)
+        self.content_hashes = set()
+        self.pending_documents = []
+        self.pending_results = []
+        self.pending_syncs = []
+        self.pages_fetched = 0
+        self.pages_ingested = 0
+        self.pages_unchanged = 0
+        self.duplicates = 0
+        self.chunks = 0
+        self.chunks_unchanged = 0
+        self.chunks_deleted = 0
+        self.failures = []
+
+async def crawl(vector_store, web_fetcher, urls: list[str] = None, sitemap_url: str = None,
+                seed_url: str = None, max_depth: int = 0, max_pages: int = CRAWL_MAX_PAGES,
+                allowed_domains: list[str] = None, concurrency: int = CRAWL_CONCURRENCY,
+                namespace: str = "", progress: IngestionProgress = None, force: bool = False) -> dict:
+    """
+    Ingests many pages with up to `concurrency` (at most CRAWL_CONCURRENCY) fetches in flight. Start URLs
+    come from `urls`, a sitemap and/or a seed URL; links are followed up to
+    max_depth hops, staying inside allowed_domains (default: the hosts of the
+    start URLs). Pages are deduplicated by canonical URL and content hash, and
+    their chunks are upserted in large batches as the crawl proceeds. Unless
+    force is set, pages unchanged since their last ingest are not re-upserted,
+    and of changed pages only new or changed chunks are; chunks a page no
+    longer has are deleted.
+    Returns a report with counts, pages_per_second and per-URL failures.
+    """
+    progress = progress or IngestionProgress()
+    progress.start()
+    started = time.monotonic()
+    max_depth = max(0, min(max_depth, CRAWL_MAX_DEPTH))
+    max_pages = max(1, min(max_pages, CRAWL_MAX_PAGES))
+    concurrency = max(1, min(concurrency, CRAWL_CONCURRENCY))
+    state = _CrawlState(max_pages)
+
+    start_urls = list(urls or [])
+    if seed_url:
+        start_urls.insert(0, seed_url)
+    if sitemap_url:
+        progress.stage = "reading sitemap"
+        start_urls.extend(await load_sitemap_urls(web_fetcher, sitemap_url, max_pages))
+    if not start_urls:
+        raise IngestionInputError("Nothing to crawl: give urls, a sitemap_url or a seed_url.")
+    domains = {domain.lower().lstrip(".") for domain in (allowed_domains or [])} or {_host(u) for u in start_urls}
+
+    queue = asyncio.Queue()
+    def enqueue(url: str, depth: int):
+        if len(state.queued) >= state.max_pages or not url.startswith(("http://", "https://")):
+            return
+        canonical = canonicalize_url(url)
+        if canonical in state.queued or not _domain_allowed(canonical, domains):
+            return
+        state.queued.add(canonical)
+        progress.pages_total = len(state.queued)
+        queue.put_nowait((url, depth))
+
+    for url in start_urls:
+        enqueue(url, 0)
+
+    async def flush():
+        if not state.pending_results:
+            return
+        # Swap the buffers synchronously so concurrent workers keep filling new ones
+        documents, results, syncs = state.pending_documents, state.pending_results, state.pending_syncs
+        state.pending_documents, state.pending_results, state.pending_syncs = [], [], []
+        progress.stage = "crawling and upserting"
+        try:
+            if documents:
+                upsert_result = await upsert_documents_async(vector_store, documents, namespace=namespace)
+                state.chunks += upsert_result.get("upserted_count", 0)
+                progress.chunks_done = state.chunks
+            state.chunks_deleted += await finish_source_syncs(vector_store, syncs, namespace=namespace)
+        except Exception as e:
+            # None of the pages in this batch are known to be stored: report them all as failed
+            logger.error(f"Crawl upsert of {len(results)} pages failed: {type(e).__name__}: {e}")
+            state.pages_ingested -= len(results)
+            for result in results:
+                state.failures.append({"url": result.url, "error": f"{type(e).__name__}: {e}", "status_code": 500,
+                                       "retryable": True})
+            return
+        finally:
+            for sync in syncs:
+                sync.release()  # No-op for the committed ones
+        # Only pages that are actually stored are remembered as up to date
+        for result in results:
+            await web_fetcher.remember(result, namespace=namespace)
+
+    async def crawl_page(url: str, depth: int):
+        result = await web_fetcher.fetch(url, namespace=namespace, use_cache=not force, want_links=depth < max_depth)
+        state.pages_fetched += 1
+        progress.pages_done = state.pages_fetched
+        if result.error is not None:
+            state.failures.append({"url": url, "error": result.error, "status_code": result.error_status,
+                                   "retryable": result.retryable})
+            return
+
+        for link in result.links:
+            enqueue(link, depth + 1)
+
+        # Redirects and rel=canonical can point several URLs at the same page
+        aliases = {canonicalize_url(u) for u in (result.final_url, result.canonical_url) if u}
+        aliases.add(canonicalize_url(url))
+        if state.fetched & aliases or (result.content_hash and result.content_hash in state.content_hashes):
+            state.duplicates += 1
+            return
+        state.fetched.update(aliases)
+        if result.content_hash:
+            state.content_hashes.add(result.content_hash)
+
+        if result.not_modified:
+            state.pages_unchanged += 1
+            return
+        if not result.text or not result.text.strip():
+            state.failures.append({"url": url, "error": "No meaningful text content found.", "status_code": 400,
+                                   "retryable": False})
+            return
+        # Stored under its canonical URL, so every variant of the page replaces the same chunks
+        source = page_source_url(result, url)
+        aliases = {url, result.final_url or url} - {source}
+        # A crawl holds many sources until its next flush, so it must never wait for one
+        try:
+            sync = await SourceSync.open(source, namespace=namespace, force=force, wait=False,
+                                         legacy_ids=[f"url-{u}" for u in {source, *aliases}], aliases=aliases)
+        except SourceBusyError as e:
+            state.failures.append({"url": url, "error": str(e), "status_code": 409, "retryable": True})
+            return
+        try:
+            documents = await run_ingest_blocking(chunk_document, f"url-{source}", result.text.strip(), source, 1)
+        except BaseException:
+            sync.release()
+            raise
+        state.pending_documents.extend(sync.changed(documents))
+        state.chunks_unchanged += sync.unchanged
+        state.pending_results.append(result)
+        state.pending_syncs.append(sync)
+        state.pages_ingested += 1
+        if len(state.pending_documents) >= INGEST_FLUSH_THRESHOLD:
+            await flush()
+
+    async def worker():
+        while True:
+            url, depth = await queue.get()
+            try:
+                await crawl_page(url, depth)
+            except Exception as e:
+                logger.error(f"Crawl of {url} failed: {type(e).__name__}: {e}")
+                state.failures.append({"url": url, "error": f"{type(e).__name__}: {e}", "status_code": 500,
+                                       "retryable": True})
+            finally:
+                queue.task_done()
+
+    progress.stage = "crawling"
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        try:
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        await flush()
+    finally:
+        for sync in state.pending_syncs:
+            sync.release()  # Only left over if the crawl was cancelled
+
+    elapsed = time.monotonic() - started
+    progress.stage = "done"
+    logger.info(f"Crawl finished: {state.pages_fetched} pages fetched, {state.pages_ingested} ingested, "
+                f"{state.chunks} chunks, {len(state.failures)} failures in {elapsed:.1f}s.")
+    return {
+        "pages_queued": len(state.queued),
+        "pages_fetched": state.pages_fetched,
+        "pages_ingested": state.pages_ingested,
+        "pages_unchanged": state.pages_unchanged,
+        "duplicates_skipped": state.duplicates,
+        "chunks": state.chunks,
+        "chunks_unchanged": state.chunks_unchanged,
+        "chunks_deleted": state.chunks_deleted,
+        "failed": len(state.failures),
+        "failures": state.failures,
+        "elapsed_seconds": round(elapsed, 3),
+        "pages_per_second": round(state.pages_fetched / elapsed, 2) if elapsed else 0.0,
+    }
@@ -0,0 +1,65 @@
+# Metadata filters use Pinecone's filter syntax everywhere, so the same dict is
+# sent to Pinecone as-is and evaluated locally for the local store and BM25.
+
+FILTERABLE_FIELDS = ("source", "page_number")
+MAX_FILTER_VALUES = 100
+
+_OPERATORS = {
+    "$eq": lambda value, arg: value == arg,
+    "$ne": lambda value, arg: value != arg,
+    "$in": lambda value, arg: value in arg,
+    "$nin": lambda value, arg: value not in arg,
+    "$gt": lambda value, arg: value is not None and value > arg,
+    "$gte": lambda value, arg: value is not None and value >= arg,
+    "$lt": lambda value, arg: value is not None and value < arg,
+    "$lte": lambda value, arg: value is not None and value <= arg,
+}
+
+def build_metadata_filter(sources: list[str] = None, page_numbers: list[int] = None,
+                          page_from: int = None, page_to: int = None):
+    """
+    Builds a filter matching chunks from any of `sources` and, optionally, any
+    of `page_numbers` and/or pages in [page_from, page_to]. Returns None when
+    nothing is restricted. Raises ValueError for an invalid combination.
+    """
+    sources = sorted(set(s for s in (sources or []) if s))
+    page_numbers = sorted(set(page_numbers or []))
+    if len(sources) > MAX_FILTER_VALUES or len(page_numbers) > MAX_FILTER_VALUES:
+        raise ValueError(f"Filters accept at most {MAX_FILTER_VALUES} sources and {MAX_FILTER_VALUES} page numbers.")
+    if page_from is not None and page_to is not None and page_from > page_to:
+        raise ValueError(f"page_from ({page_from}) is greater than page_to ({page_to}).")
+
+    clauses = []
+    if sources:
+        clauses.append({"source": {"$in": sources}})
+    if page_numbers:
+        clauses.append({"page_number": {"$in": page_numbers}})
+    if page_from is not None:
+        clauses.append({"page_number": {"$gte": page_from}})
+    if page_to is not None:
+        clauses.append({"page_number": {"$lte": page_to}})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+def matches_metadata_filter(fields: dict, metadata_filter: dict) -> bool:
+    """Evaluates a Pinecone-style filter ($and/$or, $eq/$ne/$in/$nin/$gt/$gte/$lt/$lte) against stored fields."""
+    if not metadata_filter:
+        return True
+    for key, condition in metadata_filter.items():
+        if key == "$and":
+            if not all(matches_metadata_filter(fields, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_metadata_filter(fields, clause) for clause in condition):
+                return False
+        else:
+            value = fields.get(key)
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            for operator, argument in condition.items():
+                if operator not in _OPERATORS:
+                    raise ValueError(f"Unsupported filter operator: {operator}")
+                if not _OPERATORS[operator](value, argument):
+                    return False
+    return True
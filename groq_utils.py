@@ -1,8 +1,14 @@
 import os
-from groq import AsyncGroq
+import logging
+from groq import AsyncGroq, RateLimitError
 import asyncio
+
+logger = logging.getLogger(__name__)
+
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 GROQ_MODEL_NAME = os.getenv("GROQ_MODEL")
+# Prefix of the chunk yielded instead of an answer when the API call fails
+LLM_ERROR_PREFIX = "Error from LLM:"
 
 groq_client = None
 
@@ -12,15 +18,16 @@ async def init_groq_client():
         raise ValueError("GROQ_API_KEY is not set in environment variables")
     try:
         groq_client = AsyncGroq(api_key=GROQ_API_KEY)
-        print("Successfully initialized AsyncGroq client.")
+        logger.info("Successfully initialized AsyncGroq client.")
         return groq_client
     except Exception as e:
         raise ValueError(f"Failed to initialize AsyncGroq client: {e}")
 
-async def get_groq_streaming_response(client: AsyncGroq, context: str, query: str):
+async def get_groq_streaming_response(client: AsyncGroq, context: str, query: str, on_rate_limited=None):
     """
     Gets a streaming response from Groq's chat completion using AsyncGroq.
     Yields content chunks (tokens) as they are received.
+    on_rate_limited, if given, is called when Groq answers with a rate-limit error.
     """
     if not client:
         raise ValueError("Groq client not initialized.")
@@ -34,6 +41,7 @@ Context: {context}
 
 Answer:"""
 
+    stream = None
     try:
         stream = await client.chat.completions.create(
             messages=[
@@ -45,14 +53,20 @@ Answer:"""
             model=GROQ_MODEL_NAME,
             stream=True,
         )
-        print(f"Streaming response from Groq: {stream}")
+        logger.debug(f"Streaming response from Groq: {stream}")
         async for chunk in stream:
             if chunk.choices[0].delta and chunk.choices[0].delta.content:
                 yield chunk.choices[0].delta.content
     except Exception as e:
+        if isinstance(e, RateLimitError) and on_rate_limited is not None:
+            on_rate_limited()
         error_detail = str(e)
         if hasattr(e, 'body') and e.body:
             error_detail = f"{error_detail} - API Response: {e.body}"
-        print(f"Error during Groq API call: {error_detail}")
-        yield f"Error from LLM: {error_detail}" 
+        logger.error(f"Error during Groq API call: {error_detail}")
+        yield f"{LLM_ERROR_PREFIX} {error_detail}"
+    finally:
+        # Also runs when the consumer stops early (client disconnect): stop paying for unread tokens
+        if stream is not None:
+            await stream.close() 
 
@@ -0,0 +1,187 @@
+import logging
+import time
+
+from chunking_utils import chunk_document
+from pdf_utils import count_pdf_pages, iter_pdf_pages
+from retrieval_utils import (
+    upsert_documents_async, delete_documents_async, run_ingest_blocking, UPSERT_BATCH_SIZE, UPSERT_CONCURRENCY
+)
+from manifest_utils import SourceSync
+from web_utils import page_source_url
+
+logger = logging.getLogger(__name__)
+
+# Flush enough chunks at once to keep every upsert slot busy
+INGEST_FLUSH_THRESHOLD = UPSERT_BATCH_SIZE * UPSERT_CONCURRENCY
+
+class IngestionInputError(ValueError):
+    """
+    The input itself can't be ingested (no text, 4xx from the site, ...).
+    Retrying won't help, so background jobs fail immediately on it.
+    """
+    def __init__(self, detail: str, status_code: int = 400):
+        super().__init__(detail)
+        self.status_code = status_code
+
+class TransientIngestionError(Exception):
+    """A failure that may go away on its own (timeout, 5xx, 429); background jobs retry it."""
+    def __init__(self, detail: str, status_code: int = 400):
+        super().__init__(detail)
+        self.status_code = status_code
+
+class IngestionProgress:
+    """Mutable progress counters, updated by the ingest functions as they go."""
+    def __init__(self):
+        self.stage = "queued"
+        self.pages_total = 0
+        self.pages_done = 0
+        self.chunks_done = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.pages_done = 0
+        self.chunks_done = 0
+
+    def finish(self):
+        self.finished_at = time.monotonic()
+
+    def to_dict(self) -> dict:
+        elapsed = ((self.finished_at or time.monotonic()) - self.started_at) if self.started_at else 0.0
+        return {
+            "stage": self.stage,
+            "pages_total": self.pages_total,
+            "pages_done": self.pages_done,
+            "chunks_done": self.chunks_done,
+            "elapsed_seconds": round(elapsed, 3),
+            "pages_per_second": round(self.pages_done / elapsed, 2) if elapsed else 0.0,
+            "chunks_per_second": round(self.chunks_done / elapsed, 2) if elapsed else 0.0,
+        }
+
+async def finish_source_syncs(vector_store, syncs: list[SourceSync], namespace: str = "") -> int:
+    """
+    Deletes the chunks that the synced sources no longer have, then records
+    their new state in the manifest (which releases them). Call once their
+    changed chunks are stored.
+    Returns the number of chunks deleted (not counting pre-chunking records,
+    which are deleted blindly and may not exist).
+    """
+    stale_ids = [chunk_id for sync in syncs for chunk_id in sync.stale_ids()]
+    legacy_ids = [chunk_id for sync in syncs for chunk_id in sync.legacy_stale_ids()]
+    if stale_ids or legacy_ids:
+        await delete_documents_async(vector_store, stale_ids + legacy_ids, namespace=namespace)
+    for sync in syncs:
+        await sync.commit()
+    return len(stale_ids)
+
+async def ingest_pdf_file(vector_store, pdf_path: str, filename: str, namespace: str = "",
+                          progress: IngestionProgress = None, force: bool = False) -> dict:
+    """
+    Extracts, chunks and upserts a PDF that is already on disk. If a PDF with
+    the same filename was ingested before, only new or changed chunks are
+    upserted (all of them with force) and chunks it no longer has are deleted.
+    Returns {"pages": int, "chunks": int, "chunks_unchanged": int, "chunks_deleted": int},
+    where chunks is the number upserted. Raises PDFLimitError for over-limit
+    files and IngestionInputError if no text was found.
+    """
+    progress = progress or IngestionProgress()
+    progress.start()
+    progress.stage = "extracting"
+    num_pages = await count_pdf_pages(pdf_path)
+    progress.pages_total = num_pages
+    # Before chunking, each page was stored as one record with this id
+    sync = await SourceSync.open(filename, namespace=namespace, force=force,
+                                 legacy_ids=[f"{filename}-page-{n}" for n in range(1, num_pages + 1)])
+    try:
+        documents_to_upsert = []
+        total_chunks = 0
+        # Pages arrive as the process pool finishes them; upsert while extraction continues
+        async for page_number, text_content in iter_pdf_pages(pdf_path, num_pages):
+            progress.pages_done += 1
+            if text_content and text_content.strip():
+                # Chunking a long page is CPU-bound: keep it off the event loop
+                documents_to_upsert.extend(sync.changed(await run_ingest_blocking(
+                    chunk_document, f"{filename}-page-{page_number}", text_content.strip(), filename, page_number
+                )))
+            else:
+                logger.debug(f"No text or empty text on page {page_number} of {filename}")
+
+            if len(documents_to_upsert) >= INGEST_FLUSH_THRESHOLD:
+                progress.stage = "upserting"
+                upsert_result = await upsert_documents_async(vector_store, documents_to_upsert, namespace=namespace)
+                total_chunks += upsert_result.get("upserted_count", 0)
+                progress.chunks_done = total_chunks
+                progress.stage = "extracting"
+                documents_to_upsert = []
+
+        if documents_to_upsert:
+            progress.stage = "upserting"
+            upsert_result = await upsert_documents_async(vector_store, documents_to_upsert, namespace=namespace)
+            total_chunks += upsert_result.get("upserted_count", 0)
+            progress.chunks_done = total_chunks
+
+        if sync.total_chunks == 0:
+            raise IngestionInputError(f"No text found in PDF: {filename}")
+        progress.stage = "removing stale chunks"
+        deleted = await finish_source_syncs(vector_store, [sync], namespace=namespace)
+        if sync.previous:
+            logger.info(f"Re-ingested {filename}: {total_chunks} chunks upserted, {sync.unchanged} unchanged, {deleted} deleted.")
+    finally:
+        sync.release()  # Still held if ingestion failed part-way
+    progress.stage = "done"
+    return {"pages": num_pages, "chunks": total_chunks, "chunks_unchanged": sync.unchanged, "chunks_deleted": deleted}
+
+async def ingest_url(vector_store, web_fetcher, url: str, namespace: str = "",
+                     progress: IngestionProgress = None, force: bool = False) -> dict:
+    """
+    Fetches, chunks and upserts one web page. Unless force is set, a page that
+    is unchanged since it was last ingested into the namespace is skipped, and
+    of a changed page only the new or changed chunks are upserted; chunks the
+    page no longer has are deleted.
+    Returns {"content_length": int, "chunks": int, "unchanged": bool,
+    "chunks_unchanged": int, "chunks_deleted": int}. Fetch failures are raised as
+    IngestionInputError or TransientIngestionError, carrying the HTTP status the
+    API should answer with.
+    """
+    progress = progress or IngestionProgress()
+    progress.start()
+    progress.stage = "fetching"
+    progress.pages_total = 1
+    logger.debug(f"Received request to fetch URL: {url}")
+    fetch_result = await web_fetcher.fetch(url, namespace=namespace, use_cache=not force)
+    if fetch_result.not_modified:
+        progress.pages_done = 1
+        progress.stage = "done"
+        return {"content_length": 0, "chunks": 0, "unchanged": True, "chunks_unchanged": 0, "chunks_deleted": 0}
+    if fetch_result.error is not None:
+        if fetch_result.retryable:
+            # Timeouts, rate limiting, server errors and network issues may clear up on retry
+            raise TransientIngestionError(fetch_result.error, status_code=fetch_result.error_status)
+        raise IngestionInputError(fetch_result.error, status_code=fetch_result.error_status)
+    text_content = fetch_result.text
+
+    if not text_content or not text_content.strip():
+        raise IngestionInputError(f"No meaningful text content found at URL: {url}")
+    progress.pages_done = 1
+
+    progress.stage = "upserting"
+    # Stored under its canonical URL, so every variant of the page replaces the same chunks
+    source = page_source_url(fetch_result, url)
+    aliases = {url, fetch_result.final_url or url} - {source}
+    sync = await SourceSync.open(source, namespace=namespace, force=force,
+                                 legacy_ids=[f"url-{u}" for u in {source, *aliases}], aliases=aliases)
+    try:
+        documents_to_upsert = sync.changed(
+            await run_ingest_blocking(chunk_document, f"url-{source}", text_content.strip(), source, 1))
+        if documents_to_upsert:
+            upsert_result = await upsert_documents_async(vector_store, documents_to_upsert, namespace=namespace)
+            progress.chunks_done = upsert_result.get("upserted_count", 0)
+        deleted = await finish_source_syncs(vector_store, [sync], namespace=namespace)
+    finally:
+        sync.release()  # Still held if ingestion failed part-way
+    await web_fetcher.remember(fetch_result, namespace=namespace)
+    progress.stage = "done"
+    return {"content_length": len(text_content), "chunks": progress.chunks_done, "unchanged": False,
+            "chunks_unchanged": sync.unchanged, "chunks_deleted": deleted}
@@ -0,0 +1,177 @@
+import os
+import logging
+import time
+import uuid
+import random
+import asyncio
+from collections import OrderedDict
+
+from ingest_utils import IngestionProgress, IngestionInputError
+from pdf_utils import PDFLimitError
+from collection_utils import DEFAULT_COLLECTION
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_MAX_SIZE = int(os.getenv("JOB_QUEUE_MAX_SIZE", "1000"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "2"))
+JOB_MAX_RETAINED = int(os.getenv("JOB_MAX_RETAINED", "1000"))
+
+# Errors caused by the input itself; retrying them only wastes a worker
+PERMANENT_ERRORS = (IngestionInputError, PDFLimitError)
+
+class JobQueueFullError(Exception):
+    pass
+
+class IngestionJob:
+    def __init__(self, kind: str, target: str, run, cleanup=None, collection: str = DEFAULT_COLLECTION):
+        self.id = uuid.uuid4().hex
+        self.kind = kind          # "pdf", "url" or "crawl"
+        self.target = target      # filename, URL, or the crawl's seed/sitemap/first URL
+        self.collection = collection
+        self.run = run            # async callable(progress) -> result dict
+        self.cleanup = cleanup    # optional callable, called once the job is finished
+        self.status = "queued"    # queued | running | retrying | succeeded | failed | cancelled
+        self.attempts = 0
+        self.progress = IngestionProgress()
+        self.result = None
+        self.errors = []
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("succeeded", "failed", "cancelled")
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "target": self.target,
+            "collection": self.collection,
+            "status": self.status,
+            "attempts": self.attempts,
+            "progress": self.progress.to_dict(),
+            "result": self.result,
+            "errors": self.errors,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+class JobQueue:
+    """
+    In-process ingestion queue: a bounded asyncio.Queue drained by a fixed number
+    of worker tasks. Failed jobs are retried with exponential backoff and jitter,
+    except for PERMANENT_ERRORS. Finished jobs are kept (up to max_retained) so
+    their status can still be read.
+    """
+    def __init__(self, workers: int = JOB_WORKERS, max_queue_size: int = JOB_QUEUE_MAX_SIZE,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, retry_base_seconds: float = JOB_RETRY_BASE_SECONDS,
+                 max_retained: int = JOB_MAX_RETAINED):
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.max_retained = max_retained
+        self.jobs = OrderedDict()
+        self.queue = None
+        self.worker_tasks = []
+
+    def start(self):
+        if self.worker_tasks:
+            return
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.worker_tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Started {self.workers} ingestion job workers.")
+
+    async def stop(self):
+        """Stops the workers; jobs still queued are cancelled and their cleanup runs (e.g. removing spooled PDFs)."""
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
+        while self.queue is not None and not self.queue.empty():
+            job = self.queue.get_nowait()
+            job.status = "cancelled"
+            job.progress.stage = "cancelled"
+            job.finished_at = time.time()
+            self._cleanup(job)
+        self.queue = None
+
+    def submit(self, kind: str, target: str, run, cleanup=None, collection: str = DEFAULT_COLLECTION) -> IngestionJob:
+        """Queues a job and returns it immediately. Raises JobQueueFullError if the queue is full."""
+        if self.queue is None:
+            raise RuntimeError("Job queue is not running.")
+        job = IngestionJob(kind, target, run, cleanup, collection)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise JobQueueFullError(f"Ingestion queue is full ({self.max_queue_size} jobs).")
+        self.jobs[job.id] = job
+        self._trim_finished_jobs()
+        return job
+
+    def get(self, job_id: str):
+        return self.jobs.get(job_id)
+
+    def stats(self) -> dict:
+        counts = {}
+        for job in self.jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {"queued": self.queue.qsize() if self.queue else 0, "workers": self.workers, "jobs_by_status": counts}
+
+    async def _worker(self, worker_number: int):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._run_job(job)
+            except Exception as e:
+                logger.error(f"Job worker {worker_number} crashed on job {job.id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _run_job(self, job: IngestionJob):
+        try:
+            while True:
+                job.attempts += 1
+                job.status = "running"
+                try:
+                    job.result = await job.run(job.progress)
+                    job.status = "succeeded"
+                    return
+                except Exception as e:
+                    job.errors.append(f"Attempt {job.attempts}: {type(e).__name__}: {e}")
+                    if isinstance(e, PERMANENT_ERRORS) or job.attempts >= self.max_attempts:
+                        logger.warning(f"Job {job.id} ({job.kind} {job.target}) failed: {e}")
+                        job.status = "failed"
+                        job.progress.stage = "failed"
+                        return
+                    delay = self.retry_base_seconds * (2 ** (job.attempts - 1))
+                    delay += random.uniform(0, delay / 2)
+                    logger.info(f"Job {job.id} attempt {job.attempts} failed ({e}); retrying in {delay:.1f}s.")
+                    job.status = "retrying"
+                    await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            job.progress.stage = "cancelled"
+            raise
+        finally:
+            job.finished_at = time.time()
+            job.progress.finish()
+            self._cleanup(job)
+
+    def _cleanup(self, job: IngestionJob):
+        if job.cleanup is not None:
+            try:
+                job.cleanup()
+            except Exception as e:
+                logger.warning(f"Cleanup for job {job.id} failed: {e}")
+
+    def _trim_finished_jobs(self):
+        if len(self.jobs) <= self.max_retained:
+            return
+        for job_id in [jid for jid, job in self.jobs.items() if job.finished]:
+            if len(self.jobs) <= self.max_retained:
+                break
+            del self.jobs[job_id]
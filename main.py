@@ -1,55 +1,108 @@
 import os
-import io
+import time
 import json
+import asyncio
+import logging
+import weakref
+from typing import Union, Optional
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Response, Request
 from fastapi.responses import StreamingResponse, HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, HttpUrl
 from dotenv import load_dotenv
 import uvicorn
-from PyPDF2 import PdfReader
 
-from pinecone_utils import init_pinecone_index, upsert_documents, retrieve_from_pinecone, PINECONE_INDEX_NAME
-from groq_utils import init_groq_client, get_groq_streaming_response
-from web_utils import WebContentFetcher
-
-# Load environment variables
+# Load environment variables before importing modules that read them at import time
 load_dotenv()
 
+from metrics_utils import (
+    configure_logging, span, record_stage, Timings, current_timings, ServerTimingMiddleware,
+    register_gauges, render_metrics
+)
+configure_logging()
+
+from vector_store import init_vector_store
+from retrieval_utils import (
+    retrieve_documents_async, start_index_stats_refresher,
+    stop_index_stats_refresher, get_cached_index_stats, shutdown_executor, retrieval_cache, answer_cache, lexical_index,
+    run_ingest_blocking, HYBRID_SEARCH_ENABLED
+)
+from pdf_utils import spool_upload_to_disk, remove_file, shutdown_process_pool, PDFLimitError
+from ingest_utils import ingest_pdf_file, ingest_url, IngestionInputError, TransientIngestionError
+from jobs_utils import JobQueue, JobQueueFullError
+from manifest_utils import close_manifest, get_manifest
+from collection_utils import collection_namespace, namespace_collection, DEFAULT_COLLECTION
+from filter_utils import build_metadata_filter
+from context_utils import build_context
+from cache_utils import make_cache_key, normalize_query
+from singleflight_utils import SingleFlight
+from sse_utils import stream_sse_events
+from admission_utils import (
+    admit_chat, ChatAdmission, BatchAdmission, OverloadedError, retrieval_limiter, llm_limiter,
+    CHAT_BATCH_MAX_QUERIES, CHAT_BATCH_RETRIEVAL_CONCURRENCY, CHAT_BATCH_LLM_CONCURRENCY
+)
+from groq_utils import init_groq_client, get_groq_streaming_response, GROQ_MODEL_NAME, LLM_ERROR_PREFIX
+from web_utils import WebContentFetcher, shutdown_parse_pool
+from crawl_utils import crawl, CRAWL_CONCURRENCY, CRAWL_MAX_PAGES
+
+logger = logging.getLogger(__name__)
+
 # Global variables for clients/index
-pinecone_idx = None
+vector_store = None
 groq_llm_client = None
 web_fetcher = None
+job_queue = JobQueue()
+chat_flights = SingleFlight()
 
 @asynccontextmanager
 async def lifespan(app_instance: FastAPI):
-    global pinecone_idx, groq_llm_client, web_fetcher
-    print("Starting up application and initializing services...")
+    global vector_store, groq_llm_client, web_fetcher
+    logger.info("Starting up application and initializing services...")
+    if HYBRID_SEARCH_ENABLED:
+        lexical_index.claim_directory()  # Refuses to start a second worker on the same BM25 index
     try:
-        pinecone_idx = init_pinecone_index()
-        if pinecone_idx is None: raise Exception("Pinecone index init failed.")
-        print(f"Pinecone index '{PINECONE_INDEX_NAME}' initialized.") 
+        vector_store = init_vector_store()
+        if vector_store is None: raise Exception("Vector store init failed.")
+        logger.info(f"Vector store '{vector_store.name}' initialized.") 
+        start_index_stats_refresher(vector_store)
     except Exception as e:
-        print(f"Pinecone initialization error: {e}")
-        pinecone_idx = None
+        logger.error(f"Vector store initialization error: {e}")
+        vector_store = None
 
     try:
         groq_llm_client = await init_groq_client()
         if groq_llm_client is None: raise Exception("Groq client init failed.")
-        print("Groq client initialized.")
+        logger.info("Groq client initialized.")
     except Exception as e:
-        print(f"Groq client initialization error: {e}")
+        logger.error(f"Groq client initialization error: {e}")
         groq_llm_client = None
     
     web_fetcher = WebContentFetcher()
-    print("WebContentFetcher initialized.")
+    logger.info("WebContentFetcher initialized.")
+
+    job_queue.start()
     
-    if not pinecone_idx or not groq_llm_client or not web_fetcher:
-        print("Warning: One or more services (Pinecone/Groq/WebFetcher) failed to initialize. API may not function fully.")
+    if not vector_store or not groq_llm_client or not web_fetcher:
+        logger.warning("One or more services (VectorStore/Groq/WebFetcher) failed to initialize. API may not function fully.")
     
     yield
 
+    await job_queue.stop()
+    if web_fetcher is not None:
+        await web_fetcher.aclose()
+    await stop_index_stats_refresher()
+    await retrieval_cache.close()
+    await answer_cache.close()
+    lexical_index.save_all()
+    lexical_index.release_directory()
+    shutdown_executor()
+    shutdown_process_pool()
+    shutdown_parse_pool()
+    close_manifest()
+    if vector_store is not None:
+        vector_store.close()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="RAG API with HTML and UI Support",
@@ -57,6 +110,22 @@ app = FastAPI(
     version="0.0.1",
     lifespan=lifespan # Added lifespan manager
 )
+app.add_middleware(ServerTimingMiddleware)
+
+# Point-in-time values read on every /metrics scrape
+register_gauges("rag_chat_active", "Chats currently holding a slot", lambda: {
+    "retrieval": retrieval_limiter.active, "llm": llm_limiter.active}, "limiter")
+register_gauges("rag_chat_waiting", "Chats queued for a slot", lambda: {
+    "retrieval": len(retrieval_limiter.waiters), "llm": len(llm_limiter.waiters)}, "limiter")
+register_gauges("rag_chat_concurrency_limit", "Current concurrency limit", lambda: {
+    "retrieval": retrieval_limiter.current_limit, "llm": llm_limiter.current_limit}, "limiter")
+register_gauges("rag_chat_rejected", "Chats rejected with 503 since startup", lambda: {
+    "retrieval": retrieval_limiter.rejected, "llm": llm_limiter.rejected}, "limiter")
+register_gauges("rag_cache_hit_ratio", "Cache hit ratio since startup", lambda: {
+    "retrieval": retrieval_cache.stats()["hit_rate"], "answer": answer_cache.stats()["hit_rate"]}, "cache")
+register_gauges("rag_ingest_queue_depth", "Background jobs waiting for a worker", lambda: {
+    "ingest": job_queue.stats()["queued"]}, "queue")
+register_gauges("rag_ingest_jobs", "Tracked background jobs by status", lambda: job_queue.stats()["jobs_by_status"], "status")
 
 # Mount static files directory (for UI)
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -65,24 +134,113 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 class PDFUploadResponse(BaseModel):
     message: str
     filename: str
+    collection: str = DEFAULT_COLLECTION
     total_pages_processed: int
+    total_chunks: int = 0      # Chunks upserted; unchanged ones from an earlier upload are skipped
+    chunks_unchanged: int = 0
+    chunks_deleted: int = 0    # Chunks an earlier version of the file had but this one doesn't
 
 class UrlUploadRequest(BaseModel):
     url: HttpUrl
+    background: bool = False
+    force: bool = False  # Re-ingest even if the page is unchanged since the last ingest
+    collection: Optional[str] = None  # Defaults to the "default" collection
+
+class BulkUrlUploadRequest(BaseModel):
+    urls: list[HttpUrl]
+    force: bool = False
+    collection: Optional[str] = None
+
+class JobSubmitResponse(BaseModel):
+    job_id: str
+    status: str
+    target: str
+    status_url: str
+    collection: str = DEFAULT_COLLECTION
+
+class BulkJobSubmitResponse(BaseModel):
+    jobs: list[JobSubmitResponse]
 
 class UrlUploadResponse(BaseModel):
     message: str
     url: str
+    collection: str = DEFAULT_COLLECTION
     content_length: int
+    total_chunks: int = 0
+    unchanged: bool = False
+    chunks_unchanged: int = 0
+    chunks_deleted: int = 0
+
+class CrawlRequest(BaseModel):
+    urls: list[HttpUrl] = []
+    sitemap_url: Optional[HttpUrl] = None
+    seed_url: Optional[HttpUrl] = None
+    max_depth: int = 0              # Link hops to follow from the start URLs
+    max_pages: int = CRAWL_MAX_PAGES
+    allowed_domains: list[str] = [] # Defaults to the hosts of the start URLs
+    concurrency: int = CRAWL_CONCURRENCY  # Capped at the configured value
+    background: bool = False
+    force: bool = False
+    collection: Optional[str] = None
+
+class CrawlFailure(BaseModel):
+    url: str
+    error: str
+    status_code: int
+    retryable: bool
+
+class CrawlResponse(BaseModel):
+    message: str
+    collection: str = DEFAULT_COLLECTION
+    pages_queued: int
+    pages_fetched: int
+    pages_ingested: int
+    pages_unchanged: int
+    duplicates_skipped: int
+    chunks: int
+    chunks_unchanged: int
+    chunks_deleted: int
+    failed: int
+    failures: list[CrawlFailure]
+    elapsed_seconds: float
+    pages_per_second: float
+
+class ChatFilters(BaseModel):
+    source: list[str] = []       # Only chunks from these sources (PDF filenames or URLs)
+    page_number: list[int] = []  # Only these pages
+    page_from: Optional[int] = None
+    page_to: Optional[int] = None
 
 class ChatQueryRequest(BaseModel):
     query: str
     top_k: int = 6
+    collection: Optional[str] = None
+    filters: Optional[ChatFilters] = None
+
+class BatchChatQuery(BaseModel):
+    query: str
+    id: Optional[str] = None              # Echoed back in the result, to match answers to questions
+    top_k: Optional[int] = None           # Defaults to the batch's top_k
+    filters: Optional[ChatFilters] = None  # Defaults to the batch's filters
+
+class BatchChatRequest(BaseModel):
+    queries: list[Union[str, BatchChatQuery]]
+    top_k: int = 6
+    collection: Optional[str] = None
+    filters: Optional[ChatFilters] = None
+    retrieval_concurrency: int = CHAT_BATCH_RETRIEVAL_CONCURRENCY  # Capped at the configured value
+    llm_concurrency: int = CHAT_BATCH_LLM_CONCURRENCY
+
+class CollectionStats(BaseModel):
+    name: str
+    vector_count: int = 0
+    sources: int = 0
+    chunks: int = 0
 
 # --- Dependencies ---
-async def get_pinecone_index_dependency():
-    if pinecone_idx is None: raise HTTPException(status_code=503, detail="Pinecone service unavailable.")
-    return pinecone_idx
+async def get_vector_store_dependency():
+    if vector_store is None: raise HTTPException(status_code=503, detail="Vector store unavailable.")
+    return vector_store
 
 async def get_groq_client_dependency():
     if groq_llm_client is None: raise HTTPException(status_code=503, detail="Groq service unavailable.")
@@ -102,116 +260,306 @@ async def read_index():
     except FileNotFoundError:
         return HTMLResponse(content="<html><body><h1>UI not found</h1><p>Please create static/index.html</p></body></html>", status_code=404)
 
-@app.post("/upload-pdf/", response_model=PDFUploadResponse, summary="Upload PDF, store pages with source/page as top-level fields")
-async def upload_pdf_endpoint(file: UploadFile = File(...),
-                                current_pinecone_index = Depends(get_pinecone_index_dependency)):
-    internal_namespace = "" 
+def _resolve_namespace(collection: Optional[str]) -> str:
+    """Namespace of a request's collection; an invalid collection name is a 400."""
+    try:
+        return collection_namespace(collection)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+
+def _job_submit_response(job) -> "JobSubmitResponse":
+    return JobSubmitResponse(job_id=job.id, status=job.status, target=job.target, status_url=f"/jobs/{job.id}",
+                             collection=job.collection)
+
+def _submit_pdf_job(current_vector_store, pdf_path: str, filename: str, namespace: str, force: bool = False):
+    """Queues ingestion of an already-spooled PDF; the file is deleted when the job finishes."""
+    return job_queue.submit(
+        "pdf", filename,
+        lambda progress: ingest_pdf_file(current_vector_store, pdf_path, filename, namespace=namespace,
+                                         progress=progress, force=force),
+        cleanup=lambda: remove_file(pdf_path),
+        collection=namespace_collection(namespace)
+    )
+
+def _submit_url_job(current_vector_store, current_web_fetcher, url_str: str, namespace: str, force: bool = False):
+    return job_queue.submit(
+        "url", url_str,
+        lambda progress: ingest_url(current_vector_store, current_web_fetcher, url_str, namespace=namespace,
+                                    progress=progress, force=force),
+        collection=namespace_collection(namespace)
+    )
+
+@app.post("/upload-pdf/", response_model=Union[PDFUploadResponse, JobSubmitResponse],
+          summary="Upload PDF, store pages with source/page as top-level fields")
+async def upload_pdf_endpoint(response: Response,
+                                file: UploadFile = File(...),
+                                background: bool = Form(False),
+                                force: bool = Form(False),
+                                collection: Optional[str] = Form(None),
+                                current_vector_store = Depends(get_vector_store_dependency)):
+    internal_namespace = _resolve_namespace(collection)
     if not file.filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Invalid file type. PDFs only.")
 
-    documents_to_upsert = []
-    pages_processed = 0
+    pdf_path = None
     try:
-        pdf_content = await file.read()
-        pdf_stream = io.BytesIO(pdf_content)
-        reader = PdfReader(pdf_stream)
-        num_pages = len(reader.pages)
-        pages_processed = num_pages
-
-        for i, page_obj in enumerate(reader.pages):
-            text_content = page_obj.extract_text()
-            if text_content and text_content.strip():
-                documents_to_upsert.append({
-                    "id": f"{file.filename}-page-{i+1}",
-                    "text": text_content.strip(),
-                    "source": file.filename,
-                    "page_number": i + 1
-                })
-            else:
-                print(f"No text or empty text on page {i+1} of {file.filename}")
-
-        if not documents_to_upsert:
-            raise HTTPException(status_code=400, detail=f"No text found in PDF: {file.filename}")
-
-        upsert_result = upsert_documents(current_pinecone_index, documents_to_upsert, namespace=internal_namespace)
-        
+        pdf_path = await spool_upload_to_disk(file)
+        if background:
+            job = _submit_pdf_job(current_vector_store, pdf_path, file.filename, internal_namespace, force)
+            pdf_path = None  # Owned by the job now
+            response.status_code = 202
+            return _job_submit_response(job)
+
+        result = await ingest_pdf_file(current_vector_store, pdf_path, file.filename, namespace=internal_namespace,
+                                       force=force)
         return PDFUploadResponse(
-            message=upsert_result["message"],
+            message=f"PDF processed; stored {result['chunks']} chunks ({result['chunks_unchanged']} unchanged, "
+                    f"{result['chunks_deleted']} removed).",
             filename=file.filename,
-            total_pages_processed=pages_processed
+            collection=namespace_collection(internal_namespace),
+            total_pages_processed=result["pages"],
+            total_chunks=result["chunks"],
+            chunks_unchanged=result["chunks_unchanged"],
+            chunks_deleted=result["chunks_deleted"]
         )
+    except HTTPException:
+        raise
+    except JobQueueFullError as qe:
+        raise HTTPException(status_code=503, detail=str(qe))
+    except PDFLimitError as le:
+        raise HTTPException(status_code=413, detail=str(le))
+    except IngestionInputError as ie:
+        raise HTTPException(status_code=ie.status_code, detail=str(ie))
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to process PDF: {str(e)}")
     finally:
         await file.close()
+        if pdf_path:
+            remove_file(pdf_path)
+
+@app.post("/upload-pdf/bulk/", response_model=BulkJobSubmitResponse, status_code=202,
+          summary="Queue several PDFs for background ingestion")
+async def upload_pdf_bulk_endpoint(files: list[UploadFile] = File(...),
+                                   force: bool = Form(False),
+                                   collection: Optional[str] = Form(None),
+                                   current_vector_store = Depends(get_vector_store_dependency)):
+    internal_namespace = _resolve_namespace(collection)
+    invalid = [f.filename for f in files if not f.filename.lower().endswith(".pdf")]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid file type. PDFs only: {', '.join(invalid)}")
+
+    jobs = []
+    try:
+        for file in files:
+            pdf_path = await spool_upload_to_disk(file)
+            try:
+                jobs.append(_submit_pdf_job(current_vector_store, pdf_path, file.filename, internal_namespace, force))
+            except Exception:
+                remove_file(pdf_path)
+                raise
+    except JobQueueFullError as qe:
+        raise HTTPException(status_code=503, detail=f"{qe} {len(jobs)} of {len(files)} files were queued.")
+    except PDFLimitError as le:
+        raise HTTPException(status_code=413, detail=f"{le} {len(jobs)} of {len(files)} files were queued.")
+    finally:
+        for file in files:
+            await file.close()
+    return BulkJobSubmitResponse(jobs=[_job_submit_response(job) for job in jobs])
 
-@app.post("/upload-url/", response_model=UrlUploadResponse, summary="Fetch content from URL and store it")
+@app.post("/upload-url/", response_model=Union[UrlUploadResponse, JobSubmitResponse],
+          summary="Fetch content from URL and store it")
 async def upload_url_endpoint(request: UrlUploadRequest,
-                              current_pinecone_index = Depends(get_pinecone_index_dependency),
+                              response: Response,
+                              current_vector_store = Depends(get_vector_store_dependency),
                               current_web_fetcher = Depends(get_web_fetcher_dependency)):
-    internal_namespace = ""
+    internal_namespace = _resolve_namespace(request.collection)
     url_str = str(request.url)
 
     try:
-        print(f"Received request to fetch URL: {url_str}")
-        text_content = await current_web_fetcher.fetch_and_parse(url_str)
-
-        if text_content.startswith("Error:"):
-            if "timed out" in text_content.lower():
-                raise HTTPException(status_code=408, detail=text_content)
-            elif "status code: 404" in text_content.lower():
-                 raise HTTPException(status_code=404, detail=text_content)
-            else:
-                raise HTTPException(status_code=400, detail=text_content)
-
-        if not text_content or not text_content.strip():
-            raise HTTPException(status_code=400, detail=f"No meaningful text content found at URL: {url_str}")
-
-        document_to_upsert = {
-            "id": f"url-{url_str}",
-            "text": text_content.strip(),
-            "source": url_str,
-            "page_number": 1
-        }
+        if request.background:
+            job = _submit_url_job(current_vector_store, current_web_fetcher, url_str, internal_namespace, request.force)
+            response.status_code = 202
+            return _job_submit_response(job)
 
-        upsert_result = upsert_documents(current_pinecone_index, [document_to_upsert], namespace=internal_namespace)
-        
+        result = await ingest_url(current_vector_store, current_web_fetcher, url_str, namespace=internal_namespace,
+                                  force=request.force)
         return UrlUploadResponse(
-            message="URL content processed and attempt to store made.",
+            message="URL content unchanged since the last ingest; skipped." if result["unchanged"]
+                    else "URL content processed and attempt to store made.",
             url=url_str,
-            content_length=len(text_content)
+            collection=namespace_collection(internal_namespace),
+            content_length=result["content_length"],
+            total_chunks=result["chunks"],
+            unchanged=result["unchanged"],
+            chunks_unchanged=result["chunks_unchanged"],
+            chunks_deleted=result["chunks_deleted"]
         )
     except HTTPException:
         raise
+    except JobQueueFullError as qe:
+        raise HTTPException(status_code=503, detail=str(qe))
+    except (IngestionInputError, TransientIngestionError) as ie:
+        raise HTTPException(status_code=ie.status_code, detail=str(ie))
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
     except Exception as e:
-        print(f"Unexpected error processing URL {url_str}: {type(e).__name__} - {str(e)}")
+        logger.error(f"Unexpected error processing URL {url_str}: {type(e).__name__} - {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to process URL: {str(e)}")
 
-async def generate_chat_stream(current_groq_client, current_pinecone_index, query: str, top_k: int):
-    internal_namespace = ""
-    retrieved_contexts = retrieve_from_pinecone(
-        current_pinecone_index,
-        query,
-        top_k,
-        namespace=internal_namespace
+@app.post("/upload-url/bulk/", response_model=BulkJobSubmitResponse, status_code=202,
+          summary="Queue several URLs for background ingestion")
+async def upload_url_bulk_endpoint(request: BulkUrlUploadRequest,
+                                   current_vector_store = Depends(get_vector_store_dependency),
+                                   current_web_fetcher = Depends(get_web_fetcher_dependency)):
+    internal_namespace = _resolve_namespace(request.collection)
+    jobs = []
+    try:
+        for url in dict.fromkeys(str(u) for u in request.urls):
+            jobs.append(_submit_url_job(current_vector_store, current_web_fetcher, url, internal_namespace, request.force))
+    except JobQueueFullError as qe:
+        raise HTTPException(status_code=503, detail=f"{qe} {len(jobs)} of {len(request.urls)} URLs were queued.")
+    return BulkJobSubmitResponse(jobs=[_job_submit_response(job) for job in jobs])
+
+@app.post("/crawl/", response_model=Union[CrawlResponse, JobSubmitResponse],
+          summary="Ingest a list of URLs, a sitemap or a site crawled from a seed URL")
+async def crawl_endpoint(request: CrawlRequest,
+                         response: Response,
+                         current_vector_store = Depends(get_vector_store_dependency),
+                         current_web_fetcher = Depends(get_web_fetcher_dependency)):
+    internal_namespace = _resolve_namespace(request.collection)
+    if not (request.urls or request.sitemap_url or request.seed_url):
+        raise HTTPException(status_code=400, detail="Give urls, a sitemap_url or a seed_url to crawl.")
+    target = str(request.seed_url or request.sitemap_url or request.urls[0])
+    run_crawl = lambda progress=None: crawl(
+        current_vector_store, current_web_fetcher,
+        urls=[str(u) for u in request.urls],
+        sitemap_url=str(request.sitemap_url) if request.sitemap_url else None,
+        seed_url=str(request.seed_url) if request.seed_url else None,
+        max_depth=request.max_depth,
+        max_pages=request.max_pages,
+        allowed_domains=request.allowed_domains,
+        concurrency=request.concurrency,
+        namespace=internal_namespace,
+        progress=progress,
+        force=request.force,
     )
 
+    try:
+        if request.background:
+            job = job_queue.submit("crawl", target, run_crawl, collection=namespace_collection(internal_namespace))
+            response.status_code = 202
+            return _job_submit_response(job)
+
+        result = await run_crawl()
+        return CrawlResponse(message=f"Crawl finished: {result['pages_ingested']} pages ingested, "
+                                     f"{result['failed']} failed.",
+                             collection=namespace_collection(internal_namespace), **result)
+    except HTTPException:
+        raise
+    except JobQueueFullError as qe:
+        raise HTTPException(status_code=503, detail=str(qe))
+    except (IngestionInputError, TransientIngestionError) as ie:
+        raise HTTPException(status_code=ie.status_code, detail=str(ie))
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        logger.error(f"Unexpected error crawling {target}: {type(e).__name__} - {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to crawl: {str(e)}")
+
+@app.get("/jobs/{job_id}", summary="Status and progress of a background ingestion job")
+async def job_status_endpoint(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    return job.to_dict()
+
+def _chat_flight_key(query: str, top_k: int, namespace: str, metadata_filter: dict = None) -> str:
+    return make_cache_key(normalize_query(query), top_k, namespace, metadata_filter)
+
+def _chat_metadata_filter(filters: Optional[ChatFilters]):
+    """Pinecone-style filter for a chat's filters (None if unrestricted); invalid filters are a 400."""
+    if filters is None:
+        return None
+    try:
+        return build_metadata_filter(filters.source, filters.page_number, filters.page_from, filters.page_to)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+
+async def generate_chat_stream(current_groq_client, current_vector_store, query: str, top_k: int,
+                               admission: ChatAdmission = None, internal_namespace: str = "",
+                               metadata_filter: dict = None, admit=None):
+    """
+    Yields the chat response as (event, data) tuples: ("sources", {...}),
+    ("token", text)..., then ("done", {...}) or ("error", {"message": ...}).
+    Identical questions (same normalized query, top_k, collection and
+    filters) asked while one is already being answered share its retrieval and
+    Groq stream instead of starting their own.
+    `admission` holds the retrieval/LLM capacity reserved by the endpoint; it
+    is released when the upstream work is finished (or unused, when coalesced).
+    Without it, `admit` (e.g. admit_chat) is called to reserve capacity if this
+    request turns out to start its own upstream work after all; its
+    OverloadedError then ends the stream.
+    """
+    if admission is not None:
+        admission.claim()
+
+    def start_producer():
+        nonlocal admission
+        if admission is None and admit is not None:
+            admission = admit()
+            admission.claim()
+        return _produce_chat_stream(current_groq_client, current_vector_store, query, top_k, internal_namespace,
+                                    admission, metadata_filter)
+
+    def release():
+        if admission is not None:
+            admission.release()
+
+    async for chunk in chat_flights.subscribe(
+        _chat_flight_key(query, top_k, internal_namespace, metadata_filter),
+        start_producer,
+        cleanup=release
+    ):
+        yield chunk
+
+async def _produce_chat_stream(current_groq_client, current_vector_store, query: str, top_k: int,
+                               internal_namespace: str, admission: ChatAdmission = None,
+                               metadata_filter: dict = None):
+    # Per-stage durations, sent to the client in the final "done" event
+    timings = Timings()
+    # Also collect spans from deeper layers (vector/BM25 search); this runs in its own task, so nothing leaks out
+    current_timings.set(timings)
+    if admission is not None:
+        with span("retrieval_queue_wait", timings):
+            await admission.retrieval.acquire()
+    try:
+        with span("retrieval", timings):
+            retrieved_contexts = await retrieve_documents_async(
+                current_vector_store,
+                query,
+                top_k,
+                namespace=internal_namespace,
+                metadata_filter=metadata_filter
+            )
+    finally:
+        if admission is not None:
+            admission.retrieval.release()
+
     # Prepare source information and context for LLM
     source_map = {}
-    contexts_for_llm = []
-
-    if retrieved_contexts:
-        print(f"Retrieved {len(retrieved_contexts)} contexts from Pinecone.")
-        for ctx in retrieved_contexts:
-            source_key = ctx.get("source", "N/A")
-            page_number = ctx.get("page_number", "N/A")
-            text_content = ctx.get('text', '')
-            
-            contexts_for_llm.append(text_content)
+    with span("context_build", timings):
+        built_context = build_context(query, retrieved_contexts) if retrieved_contexts else None
+
+    if built_context and built_context["passages"]:
+        logger.info(f"Retrieved {len(retrieved_contexts)} contexts from the vector store; "
+                    f"using {len(built_context['passages'])} ({built_context['tokens_used']} tokens, "
+                    f"{built_context['tokens_saved']} saved, {built_context['duplicates_dropped']} duplicates dropped).")
+        # Only the passages that made it into the prompt are listed as sources
+        for ctx in built_context["passages"]:
+            source_key = ctx.get("source") or "N/A"
+            page_number = ctx.get("page_number") or "N/A"
 
             if source_key not in source_map:
                 is_url = source_key.startswith("http://") or source_key.startswith("https://")
@@ -225,37 +573,254 @@ async def generate_chat_stream(current_groq_client, current_pinecone_index, quer
             source_map[key]["pages"].sort()
 
         source_list_for_json = list(source_map.values())    
-        full_context_for_llm = "\n\n---\n\n".join(contexts_for_llm)
+        full_context_for_llm = built_context["context"]
+        context_ids = [ctx.get("id") or "" for ctx in built_context["passages"]]
     else:
-        print("No context retrieved from Pinecone for the query.")
+        logger.info("No context retrieved from the vector store for the query.")
         source_list_for_json = [] # Ensure it's an empty list if no contexts
         full_context_for_llm = "No specific context was found to answer the query."
+        context_ids = []
+
+    # The same question over the same passages with the same model gets the same answer
+    answer_key = answer_cache.make_key(query, context_ids, GROQ_MODEL_NAME, internal_namespace)
+    cached_answer, cache_generation = await answer_cache.get(answer_key, internal_namespace)
+
+    # Sources go first so the UI can show them while the answer streams
+    initial_payload = {"sources": source_list_for_json, "answer_cached": cached_answer is not None}
+    if built_context:
+        initial_payload["context_tokens"] = {
+            "used": built_context["tokens_used"],
+            "saved": built_context["tokens_saved"],
+        }
+    yield ("sources", initial_payload)
 
-    # Yield sources as a JSON object, followed by a separator
-    initial_payload = {"sources": source_list_for_json}
-    yield json.dumps(initial_payload) + "\n###LLM_ANSWER###\n"
+    if cached_answer is not None:
+        logger.info("Answer cache hit; replaying the stored answer.")
+        yield ("token", cached_answer)
+        yield ("done", {"answer_cached": True, "timings": timings.totals_ms()})
+        return
 
     # Stream LLM response
-    async for chunk in get_groq_streaming_response(current_groq_client, full_context_for_llm, query):
-        yield chunk
+    if admission is not None:
+        with span("llm_queue_wait", timings):
+            await admission.llm.acquire()
+    answer_parts = []
+    llm_started = time.perf_counter()
+    first_token_at = None
+    try:
+        async for chunk in get_groq_streaming_response(current_groq_client, full_context_for_llm, query,
+                                                       on_rate_limited=llm_limiter.on_rate_limited):
+            if chunk.startswith(LLM_ERROR_PREFIX):
+                record_stage("llm_total", time.perf_counter() - llm_started, timings, error=True)
+                yield ("error", {"message": chunk})
+                return  # Failed answers are not cached
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+                record_stage("llm_ttft", first_token_at - llm_started, timings)
+            answer_parts.append(chunk)
+            yield ("token", chunk)
+    finally:
+        if admission is not None:
+            admission.llm.release()
+    finished_at = time.perf_counter()
+    if first_token_at is not None:
+        record_stage("llm_stream", finished_at - first_token_at, timings)
+    record_stage("llm_total", finished_at - llm_started, timings)
+    llm_limiter.on_success()
+    await answer_cache.set(answer_key, "".join(answer_parts), internal_namespace, cache_generation)
+    yield ("done", {"answer_cached": False, "timings": timings.totals_ms()})
 
 @app.post("/chat/", summary="Ask question, get streamed answer with source/page of top hit")
 async def chat_endpoint(request: ChatQueryRequest,
-                        current_pinecone_index = Depends(get_pinecone_index_dependency),
+                        http_request: Request,
+                        current_vector_store = Depends(get_vector_store_dependency),
                         current_groq_client = Depends(get_groq_client_dependency)):
     if not request.query:
         raise HTTPException(status_code=400, detail="Query cannot be empty.")
+    internal_namespace = _resolve_namespace(request.collection)
+    metadata_filter = _chat_metadata_filter(request.filters)
+    admission = None
+    # Joining an identical in-flight chat costs no upstream capacity. If that flight
+    # ends before the stream starts, the stream reserves capacity itself (admit=admit_chat).
+    if not chat_flights.in_flight(_chat_flight_key(request.query, request.top_k, internal_namespace, metadata_filter)):
+        try:
+            admission = admit_chat()
+        except OverloadedError as oe:
+            raise HTTPException(status_code=503, detail=str(oe), headers={"Retry-After": str(oe.retry_after)})
     try:
+        chat_events = generate_chat_stream(current_groq_client, current_vector_store, request.query, request.top_k,
+                                           admission=admission, internal_namespace=internal_namespace,
+                                           metadata_filter=metadata_filter, admit=admit_chat)
+        if admission is not None:
+            weakref.finalize(chat_events, admission.release_unclaimed)
         return StreamingResponse(
-            generate_chat_stream(current_groq_client, current_pinecone_index, request.query, request.top_k),
-            media_type="text/event-stream"
+            stream_sse_events(chat_events, request=http_request),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
         )
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
     except Exception as e:
-        print(f"Error in /chat/ endpoint: {e}")
+        logger.error(f"Error in /chat/ endpoint: {e}")
         raise HTTPException(status_code=500, detail=f"Chat query failed: {str(e)}")
 
+async def _answer_batch_query(current_groq_client, current_vector_store, item: dict,
+                              internal_namespace: str, admission: ChatAdmission) -> dict:
+    """Runs one unique question of a batch through the chat pipeline and collects the whole answer."""
+    result = {"indexes": item["indexes"], "ids": item["ids"], "query": item["query"], "answer": None,
+              "sources": [], "answer_cached": False, "timings": {}, "error": None}
+    answer_parts = []
+    started = time.perf_counter()
+    try:
+        async for event, data in generate_chat_stream(current_groq_client, current_vector_store, item["query"],
+                                                      item["top_k"], admission=admission,
+                                                      internal_namespace=internal_namespace,
+                                                      metadata_filter=item["metadata_filter"]):
+            if event == "sources":
+                result["sources"] = data["sources"]
+                result["answer_cached"] = data["answer_cached"]
+            elif event == "token":
+                answer_parts.append(data)
+            elif event == "error":
+                result["error"] = data["message"]
+            elif event == "done":
+                result["answer_cached"] = data["answer_cached"]
+                result["timings"] = data["timings"]
+    except OverloadedError as oe:
+        result["error"] = str(oe)
+        result["retry_after"] = oe.retry_after
+    except Exception as e:
+        logger.error(f"Batch chat query failed: {type(e).__name__}: {e}")
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        admission.release_unclaimed()
+    if result["error"] is None:
+        result["answer"] = "".join(answer_parts)
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+async def _stream_batch_results(current_groq_client, current_vector_store, unique_queries: list[dict],
+                                internal_namespace: str, batch: BatchAdmission, total_queries: int):
+    """
+    Answers all unique questions concurrently (bounded by the batch's limiters)
+    and yields one NDJSON "result" line per question as soon as it finishes,
+    then a "summary" line. Unfinished questions are cancelled if the client leaves.
+    """
+    started = time.perf_counter()
+    tasks = [asyncio.create_task(_answer_batch_query(current_groq_client, current_vector_store, item,
+                                                     internal_namespace, batch.admit()))
+             for item in unique_queries]
+    failed = 0
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            result = await next_result
+            if result["error"] is not None:
+                failed += 1
+            yield json.dumps({"type": "result", **result}) + "\n"
+        yield json.dumps({
+            "type": "summary",
+            "queries": total_queries,
+            "unique_queries": len(unique_queries),
+            "failed": failed,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        }) + "\n"
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+@app.post("/chat/batch/", summary="Answer many questions at once; results stream back as NDJSON as they finish")
+async def chat_batch_endpoint(request: BatchChatRequest,
+                              current_vector_store = Depends(get_vector_store_dependency),
+                              current_groq_client = Depends(get_groq_client_dependency)):
+    if not request.queries:
+        raise HTTPException(status_code=400, detail="No queries provided.")
+    if len(request.queries) > CHAT_BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=400,
+                            detail=f"Too many queries: {len(request.queries)} (max {CHAT_BATCH_MAX_QUERIES}).")
+    internal_namespace = _resolve_namespace(request.collection)
+    batch_filter = _chat_metadata_filter(request.filters)
+
+    # Identical questions (same normalized query, top_k and filters) are answered once
+    unique_queries = {}
+    for index, entry in enumerate(request.queries):
+        if isinstance(entry, str):
+            entry = BatchChatQuery(query=entry)
+        if not entry.query.strip():
+            raise HTTPException(status_code=400, detail=f"Query {index} is empty.")
+        top_k = entry.top_k if entry.top_k is not None else request.top_k
+        metadata_filter = _chat_metadata_filter(entry.filters) if entry.filters is not None else batch_filter
+        item = unique_queries.setdefault(
+            _chat_flight_key(entry.query, top_k, internal_namespace, metadata_filter),
+            {"query": entry.query, "top_k": top_k, "metadata_filter": metadata_filter, "indexes": [], "ids": []}
+        )
+        item["indexes"].append(index)
+        if entry.id is not None:
+            item["ids"].append(entry.id)
+
+    batch = BatchAdmission(len(unique_queries), request.retrieval_concurrency, request.llm_concurrency)
+    logger.info(f"Chat batch: {len(request.queries)} queries, {len(unique_queries)} unique.")
+    return StreamingResponse(
+        _stream_batch_results(current_groq_client, current_vector_store, list(unique_queries.values()),
+                              internal_namespace, batch, len(request.queries)),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/index-stats/", summary="Cached vector store stats (refreshed in the background)")
+async def index_stats_endpoint(current_vector_store = Depends(get_vector_store_dependency)):
+    return get_cached_index_stats()
+
+async def _collection_stats() -> dict:
+    """{collection name: CollectionStats} from the cached index stats and the ingestion manifest."""
+    collections = {}
+    index_stats = get_cached_index_stats()["stats"] or {}
+    for namespace, summary in (index_stats.get("namespaces") or {}).items():
+        name = namespace_collection(namespace)
+        collections[name] = CollectionStats(name=name, vector_count=summary.get("vector_count", 0))
+    for namespace, counts in (await run_ingest_blocking(get_manifest().stats)).items():
+        name = namespace_collection(namespace)
+        stats = collections.setdefault(name, CollectionStats(name=name))
+        stats.sources, stats.chunks = counts["sources"], counts["chunks"]
+    return collections
+
+@app.get("/collections/", response_model=list[CollectionStats],
+         summary="Collections with their vector, source and chunk counts")
+async def list_collections_endpoint():
+    return sorted((await _collection_stats()).values(), key=lambda stats: stats.name)
+
+@app.get("/collections/{collection}", response_model=CollectionStats, summary="Stats of one collection")
+async def collection_stats_endpoint(collection: str):
+    name = namespace_collection(_resolve_namespace(collection))
+    stats = (await _collection_stats()).get(name)
+    if stats is None:
+        raise HTTPException(status_code=404, detail=f"Collection not found: {name}")
+    return stats
+
+@app.get("/cache-stats/", summary="Hit/miss counters for the retrieval and answer caches, chat coalescing")
+async def cache_stats_endpoint():
+    return {"retrieval": retrieval_cache.stats(), "answer": answer_cache.stats(), "singleflight": chat_flights.stats()}
+
+@app.get("/fetch-stats/", summary="Per-host rate limiter waits and queue depth for web fetching")
+async def fetch_stats_endpoint():
+    return {"rate_limiter": web_fetcher.rate_limiter.stats()}
+
+@app.get("/admission-stats/", summary="Chat concurrency limits, queue depth, wait times and rejections")
+async def admission_stats_endpoint():
+    return {"retrieval": retrieval_limiter.stats(), "llm": llm_limiter.stats()}
+
+@app.get("/metrics", summary="Prometheus metrics: per-stage latency histograms and queue gauges")
+async def metrics_endpoint():
+    try:
+        body, content_type = render_metrics()
+    except ValueError as ve:
+        raise HTTPException(status_code=501, detail=str(ve))
+    return Response(content=body, media_type=content_type)
+
+@app.get("/jobs/", summary="Ingestion queue depth and job counts by status")
+async def jobs_stats_endpoint():
+    return job_queue.stats()
+
 @app.get("/", summary="Root endpoint with API status")
 async def read_root():
     return {
@@ -265,6 +830,6 @@ async def read_root():
 if __name__ == "__main__":
     required_vars = ["PINECONE_API_KEY", "GROQ_API_KEY", "PINECONE_INDEX"]
     if any(not os.getenv(var) for var in required_vars):
-        print(f"Error: Missing env vars: {', '.join(v for v in required_vars if not os.getenv(v))}")
+        logger.error(f"Missing env vars: {', '.join(v for v in required_vars if not os.getenv(v))}")
         exit(1)
     uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
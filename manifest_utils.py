@@ -0,0 +1,199 @@
+import os
+import logging
+import json
+import time
+import sqlite3
+import hashlib
+import asyncio
+import threading
+
+from retrieval_utils import run_ingest_blocking
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_PATH = os.getenv("MANIFEST_PATH", "manifest.sqlite3")
+
+_manifest = None
+# (namespace, source) -> [asyncio.Lock, number of holders and waiters]
+_source_locks = {}
+
+class SourceBusyError(Exception):
+    """Raised by SourceSync.open(wait=False) when another ingest of the source is in progress."""
+
+def chunk_fingerprint(document: dict) -> str:
+    """SHA-256 of everything stored for a chunk (text and metadata), so any change re-upserts it."""
+    payload = json.dumps({k: v for k, v in document.items() if k != "id"}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class DocumentManifest:
+    """
+    On-disk (SQLite) record of the chunks stored per (namespace, source): chunk
+    id and content fingerprint. Re-ingesting a source is diffed against it so
+    that only new or changed chunks are upserted and vanished ones are deleted.
+    Methods block on disk I/O: call them through run_ingest_blocking from async code.
+    """
+    def __init__(self, path: str = MANIFEST_PATH):
+        self.path = path
+        # One connection shared by executor threads; the lock keeps transactions from interleaving
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS manifest ("
+            "namespace TEXT NOT NULL, source TEXT NOT NULL, chunk_id TEXT NOT NULL, "
+            "content_hash TEXT NOT NULL, updated_at REAL, PRIMARY KEY (namespace, source, chunk_id))"
+        )
+        self.conn.commit()
+
+    def get(self, source: str, namespace: str = "") -> dict:
+        """Returns {chunk_id: content_hash} for the source (empty if it was never ingested)."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT chunk_id, content_hash FROM manifest WHERE namespace = ? AND source = ?",
+                (namespace, source)
+            ).fetchall()
+        return dict(rows)
+
+    def replace(self, source: str, fingerprints: dict, namespace: str = ""):
+        """Makes {chunk_id: content_hash} the complete record of the source, in one transaction."""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM manifest WHERE namespace = ? AND source = ?", (namespace, source))
+            self.conn.executemany(
+                "INSERT INTO manifest (namespace, source, chunk_id, content_hash, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [(namespace, source, chunk_id, content_hash, now) for chunk_id, content_hash in fingerprints.items()]
+            )
+
+    def stats(self) -> dict:
+        """Returns {namespace: {"sources": int, "chunks": int}}."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT namespace, COUNT(DISTINCT source), COUNT(*) FROM manifest GROUP BY namespace"
+            ).fetchall()
+        return {namespace: {"sources": sources, "chunks": chunks} for namespace, sources, chunks in rows}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def get_manifest() -> DocumentManifest:
+    global _manifest
+    if _manifest is None:
+        _manifest = DocumentManifest()
+    return _manifest
+
+def close_manifest():
+    global _manifest
+    if _manifest is not None:
+        _manifest.close()
+        _manifest = None
+
+class SourceSync:
+    """
+    Diffs one re-ingestion of a source against the manifest while its chunks
+    arrive. changed() filters each batch down to the chunks that must be
+    upserted (all of them with force); once everything is stored, stale_ids()
+    are the chunks the source no longer has and commit() records the new state.
+    Nothing is recorded if ingestion fails part-way, so the next run redoes it.
+    Sources stored before the manifest existed have no record; for them,
+    legacy_ids (the ids used before chunking) are deleted as stale as well.
+    aliases are other source names the same content was stored under before
+    (e.g. a page's non-canonical URLs): their chunks are stale too, and commit()
+    drops their records.
+    Create it with `await SourceSync.open(...)`, which reads the manifest off the
+    event loop. Ingests of the same (namespace, source) are serialized: open()
+    takes a per-source lock, held until commit() or release() (call release()
+    in a finally block; it is a no-op once committed).
+    """
+    def __init__(self, source: str, namespace: str = "", force: bool = False, manifest: DocumentManifest = None,
+                 previous: dict = None, legacy_ids: list[str] = None, aliases: dict = None):
+        self.source = source
+        self.namespace = namespace
+        self.force = force
+        self.manifest = manifest or get_manifest()
+        self.previous = previous or {}
+        self.legacy_ids = legacy_ids or []
+        self.aliases = aliases or {}  # {alias: {chunk_id: content_hash}}
+        self.current = {}
+        self.unchanged = 0
+        self.locked = False
+
+    @classmethod
+    async def open(cls, source: str, namespace: str = "", force: bool = False, manifest: DocumentManifest = None,
+                   legacy_ids: list[str] = None, wait: bool = True, aliases=()) -> "SourceSync":
+        """
+        Waits for other ingests of the source to finish, then reads its manifest
+        record. With wait=False, raises SourceBusyError instead of waiting; callers
+        that hold several syncs at once must use that, or two of them could deadlock.
+        """
+        key = (namespace, source)
+        entry = _source_locks.setdefault(key, [asyncio.Lock(), 0])
+        if not wait and entry[1] > 0:
+            raise SourceBusyError(f"{source} is already being ingested into this collection.")
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            _forget_lock(key, entry)
+            raise
+        sync = cls(source, namespace, force, manifest or get_manifest(), legacy_ids=legacy_ids)
+        sync.locked = True
+        try:
+            sync.previous = await run_ingest_blocking(sync.manifest.get, source, namespace)
+            for alias in aliases:
+                sync.aliases[alias] = await run_ingest_blocking(sync.manifest.get, alias, namespace)
+        except BaseException:
+            sync.release()
+            raise
+        return sync
+
+    def release(self):
+        if self.locked:
+            self.locked = False
+            key = (self.namespace, self.source)
+            entry = _source_locks[key]
+            entry[0].release()
+            _forget_lock(key, entry)
+
+    def changed(self, documents: list[dict]) -> list[dict]:
+        to_upsert = []
+        for document in documents:
+            fingerprint = chunk_fingerprint(document)
+            self.current[document["id"]] = fingerprint
+            if not self.force and self.previous.get(document["id"]) == fingerprint:
+                self.unchanged += 1
+            else:
+                to_upsert.append(document)
+        return to_upsert
+
+    @property
+    def total_chunks(self) -> int:
+        return len(self.current)
+
+    def stale_ids(self) -> list[str]:
+        previous = [chunk_id for record in (self.previous, *self.aliases.values()) for chunk_id in record]
+        return [chunk_id for chunk_id in dict.fromkeys(previous) if chunk_id not in self.current]
+
+    def legacy_stale_ids(self) -> list[str]:
+        """Pre-chunking ids to delete on a source's first sync; they may not exist, so they aren't counted."""
+        if self.previous:
+            return []
+        return [chunk_id for chunk_id in self.legacy_ids if chunk_id not in self.current]
+
+    async def commit(self):
+        """Records the new state of the source and releases it for other ingests."""
+        try:
+            await run_ingest_blocking(self.manifest.replace, self.source, self.current, self.namespace)
+            self.previous = dict(self.current)
+            for alias, record in self.aliases.items():
+                if record:
+                    await run_ingest_blocking(self.manifest.replace, alias, {}, self.namespace)
+            self.aliases = {}
+        finally:
+            self.release()
+
+def _forget_lock(key: tuple, entry: list):
+    entry[1] -= 1
+    if entry[1] == 0 and _source_locks.get(key) is entry:
+        del _source_locks[key]
@@ -0,0 +1,174 @@
+import os
+import sys
+import time
+import atexit
+import queue
+import logging
+import logging.handlers
+from contextvars import ContextVar
+
+try:
+    from prometheus_client import Histogram, Counter, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+    from prometheus_client.core import GaugeMetricFamily
+    PROMETHEUS_AVAILABLE = True
+except ImportError:  # Optional: spans are still timed and logged without it
+    PROMETHEUS_AVAILABLE = False
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "%(asctime)s %(levelname)s %(name)s: %(message)s")
+# Spans slower than this are logged at INFO; the rest at DEBUG
+SLOW_SPAN_SECONDS = float(os.getenv("SLOW_SPAN_SECONDS", "2.0"))
+
+# Latency buckets (seconds) covering cache hits up to slow LLM answers and PDF extraction
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+if PROMETHEUS_AVAILABLE:
+    STAGE_SECONDS = Histogram("rag_stage_duration_seconds", "Time spent per pipeline stage", ["stage"], buckets=_BUCKETS)
+    STAGE_ERRORS = Counter("rag_stage_errors_total", "Pipeline stage failures", ["stage"])
+
+logger = logging.getLogger(__name__)
+_log_listener = None
+
+def configure_logging(level: str = LOG_LEVEL):
+    """
+    Routes all log records through a queue to a background thread that writes
+    them to stderr, so logging never blocks the event loop on terminal/file I/O.
+    """
+    global _log_listener
+    if _log_listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    _log_listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(shutdown_logging)  # Flushes whatever is still queued
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+
+def configure_worker_logging(level: str = LOG_LEVEL):
+    """
+    Initializer for process pool workers: they log straight to stderr, since
+    the parent's queue listener doesn't exist in them.
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+def shutdown_logging():
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+class Timings:
+    """Span durations collected for one request, in the order they finished."""
+    def __init__(self):
+        self.spans = []  # (stage, seconds)
+
+    def add(self, stage: str, seconds: float):
+        self.spans.append((stage, seconds))
+
+    def totals_ms(self) -> dict:
+        """Milliseconds per stage; repeated stages (e.g. several upsert batches) are summed."""
+        totals = {}
+        for stage, seconds in self.spans:
+            totals[stage] = totals.get(stage, 0.0) + seconds * 1000
+        return {stage: round(ms, 1) for stage, ms in totals.items()}
+
+    def server_timing(self) -> str:
+        """Formats the totals as a Server-Timing header value."""
+        return ", ".join(f"{stage};dur={ms}" for stage, ms in self.totals_ms().items())
+
+# Set per HTTP request by ServerTimingMiddleware; spans anywhere in that request add to it
+current_timings: ContextVar = ContextVar("current_timings", default=None)
+
+def record_stage(stage: str, seconds: float, timings: Timings = None, error: bool = False):
+    if PROMETHEUS_AVAILABLE:
+        STAGE_SECONDS.labels(stage).observe(seconds)
+        if error:
+            STAGE_ERRORS.labels(stage).inc()
+    for collector in {id(t): t for t in (timings, current_timings.get()) if t is not None}.values():
+        collector.add(stage, seconds)
+    logger.log(logging.INFO if seconds >= SLOW_SPAN_SECONDS else logging.DEBUG,
+               "%s took %.1f ms%s", stage, seconds * 1000, " (failed)" if error else "")
+
+class span:
+    """
+    Times a block as one pipeline stage: `with span("vector_search"):`. The
+    duration goes to the rag_stage_duration_seconds histogram, the current
+    request's Timings (if any) and an explicitly passed Timings.
+    """
+    def __init__(self, stage: str, timings: Timings = None):
+        self.stage = stage
+        self.timings = timings
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record_stage(self.stage, time.perf_counter() - self.started, self.timings,
+                     error=exc_type is not None and not issubclass(exc_type, GeneratorExit))
+        return False
+
+class _GaugeCollector:
+    """Exposes values read at scrape time (queue depths, cache sizes, ...) as gauges."""
+    def __init__(self):
+        self.sources = []  # (name, help, callable returning {label_value: number}, label_name)
+
+    def collect(self):
+        for name, help_text, read, label in self.sources:
+            family = GaugeMetricFamily(name, help_text, labels=[label])
+            try:
+                for label_value, value in read().items():
+                    family.add_metric([str(label_value)], float(value))
+            except Exception as e:
+                logger.warning("Could not read metric %s: %s", name, e)
+                continue
+            yield family
+
+_gauges = _GaugeCollector()
+if PROMETHEUS_AVAILABLE:
+    REGISTRY.register(_gauges)
+
+def register_gauges(name: str, help_text: str, read, label: str):
+    """Registers a callable returning {label_value: number}, read on every /metrics scrape."""
+    _gauges.sources.append((name, help_text, read, label))
+
+def render_metrics():
+    """Returns (body, content_type) for the /metrics endpoint."""
+    if not PROMETHEUS_AVAILABLE:
+        raise ValueError("Metrics are unavailable: install 'prometheus-client'.")
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+class ServerTimingMiddleware:
+    """
+    ASGI middleware: collects the spans recorded while handling a request and
+    returns them in a Server-Timing header. Streaming responses send their
+    headers first, so their timings arrive in the final stream event instead.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings = Timings()
+        token = current_timings.set(timings)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and timings.spans:
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timings.server_timing().encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_timings.reset(token)
@@ -0,0 +1,121 @@
+import os
+import time
+import logging
+import asyncio
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import aiofiles
+from PyPDF2 import PdfReader
+
+from metrics_utils import span, record_stage, configure_worker_logging
+
+logger = logging.getLogger(__name__)
+
+PDF_MAX_FILE_BYTES = int(os.getenv("PDF_MAX_FILE_BYTES", str(100 * 1024 * 1024)))
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "2000"))
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Each worker task re-opens the file, so hand out pages in small ranges
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+UPLOAD_SPOOL_CHUNK_BYTES = 1024 * 1024
+
+_process_pool = None
+
+class PDFLimitError(ValueError):
+    """Raised when an upload is over the configured file size or page count."""
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        # Spawned, not forked: forking would copy held locks and the parent's log queue handler
+        _process_pool = ProcessPoolExecutor(max_workers=PDF_EXTRACT_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=configure_worker_logging)
+    return _process_pool
+
+def shutdown_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+async def spool_upload_to_disk(upload_file, max_bytes: int = PDF_MAX_FILE_BYTES) -> str:
+    """
+    Copies an UploadFile to a temporary file in fixed-size chunks, so the whole
+    upload is never held in memory. Returns the path; the caller deletes it.
+    Raises PDFLimitError as soon as the upload goes over max_bytes.
+    """
+    fd, path = tempfile.mkstemp(suffix=".pdf", prefix="upload-")
+    os.close(fd)
+    written = 0
+    try:
+        async with aiofiles.open(path, "wb") as out:
+            while True:
+                chunk = await upload_file.read(UPLOAD_SPOOL_CHUNK_BYTES)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > max_bytes:
+                    raise PDFLimitError(f"File is larger than the {max_bytes // (1024 * 1024)} MB limit.")
+                await out.write(chunk)
+    except BaseException:
+        remove_file(path)
+        raise
+    return path
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+# --- Worker-process functions (must be top-level so they can be pickled) ---
+def _count_pages(path: str) -> int:
+    return len(PdfReader(path).pages)
+
+def _extract_page_range(path: str, start: int, end: int) -> tuple[list[tuple[int, str]], float]:
+    """
+    Extracts pages [start, end) and returns ((1-based page number, text) pairs,
+    seconds spent extracting), timed here so pool queueing isn't counted.
+    """
+    started = time.perf_counter()
+    reader = PdfReader(path)
+    pages = []
+    for i in range(start, end):
+        try:
+            text = reader.pages[i].extract_text() or ""
+        except Exception as e:
+            logger.warning(f"Failed to extract text from page {i+1} of {path}: {e}")
+            text = ""
+        pages.append((i + 1, text))
+    return pages, time.perf_counter() - started
+
+async def count_pdf_pages(path: str, max_pages: int = PDF_MAX_PAGES) -> int:
+    loop = asyncio.get_running_loop()
+    with span("pdf_count_pages"):
+        num_pages = await loop.run_in_executor(get_process_pool(), _count_pages, path)
+    if num_pages > max_pages:
+        raise PDFLimitError(f"PDF has {num_pages} pages; the limit is {max_pages}.")
+    return num_pages
+
+async def iter_pdf_pages(path: str, num_pages: int, pages_per_task: int = PDF_PAGES_PER_TASK):
+    """
+    Extracts pages in parallel in the process pool and yields
+    (page_number, text) pairs as each range finishes (not in page order).
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool()
+    step = max(1, pages_per_task)
+    futures = [
+        loop.run_in_executor(pool, _extract_page_range, path, start, min(start + step, num_pages))
+        for start in range(0, num_pages, step)
+    ]
+    try:
+        for next_done in asyncio.as_completed(futures):
+            pages, elapsed = await next_done
+            record_stage("pdf_extract", elapsed)
+            for page_number, text in pages:
+                yield page_number, text
+    finally:
+        for future in futures:
+            future.cancel()
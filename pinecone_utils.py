@@ -1,6 +1,9 @@
 import os
+import logging
 from pinecone import Pinecone, ServerlessSpec
 
+logger = logging.getLogger(__name__)
+
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX")
 PINECONE_MODEL_NAME = "multilingual-e5-large"
@@ -8,25 +11,33 @@ PINECONE_DIMENSION = 1024  # Dimension for multilingual-e5-large
 PINECONE_METRIC = "cosine"   # Common metric for sentence embeddings
 PINECONE_CLOUD = os.getenv("PINECONE_CLOUD", "aws")
 PINECONE_REGION = os.getenv("PINECONE_REGION", "us-east-1")
+# Size of the SDK's HTTP connection pool; keep it >= RETRIEVAL_MAX_WORKERS so
+# concurrent searches/upserts from the executor don't queue for a connection.
+PINECONE_POOL_MAXSIZE = int(os.getenv("PINECONE_POOL_MAXSIZE", "32"))
 
 pinecone_client = None
 index = None
 
 def init_pinecone_index():
     global pinecone_client, index
+    if index is not None:
+        # Reuse the existing client/index (and its connection pool) instead of
+        # opening new ones on every call.
+        return index
     if not PINECONE_API_KEY:
-        print("Error: PINECONE_API_KEY is not set.")
+        logger.error("PINECONE_API_KEY is not set.")
         raise ValueError("PINECONE_API_KEY is not set in environment variables.")
 
     try:
-        pinecone_client = Pinecone(api_key=PINECONE_API_KEY)
+        if pinecone_client is None:
+            pinecone_client = Pinecone(api_key=PINECONE_API_KEY, connection_pool_maxsize=PINECONE_POOL_MAXSIZE)
         
         # Get existing index names
         indexes_on_server = pinecone_client.list_indexes()
         existing_index_names = [index.name for index in indexes_on_server] # ListResponse is iterable
 
         if PINECONE_INDEX_NAME not in existing_index_names:
-            print(f"Index '{PINECONE_INDEX_NAME}' not found. Creating a new one with model integration...")
+            logger.info(f"Index '{PINECONE_INDEX_NAME}' not found. Creating a new one with model integration...")
             pinecone_client.create_index_for_model(
                 name=PINECONE_INDEX_NAME,
                 cloud=PINECONE_CLOUD,
@@ -38,13 +49,12 @@ def init_pinecone_index():
                     }
                 }
             )
-            print(f"Index '{PINECONE_INDEX_NAME}' created successfully with model '{PINECONE_MODEL_NAME}'.")
+            logger.info(f"Index '{PINECONE_INDEX_NAME}' created successfully with model '{PINECONE_MODEL_NAME}'.")
         else:
-            print(f"Index '{PINECONE_INDEX_NAME}' already exists.")
+            logger.info(f"Index '{PINECONE_INDEX_NAME}' already exists.")
 
         index = pinecone_client.Index(PINECONE_INDEX_NAME)
-        print(f"Successfully connected to Pinecone index: {PINECONE_INDEX_NAME}")
-        print(index.describe_index_stats())
+        logger.info(f"Successfully connected to Pinecone index: {PINECONE_INDEX_NAME}")
         return index
     except Exception as e:
         raise ValueError(f"Pinecone initialization failed: {str(e)}")
@@ -52,57 +62,64 @@ def init_pinecone_index():
 def upsert_documents(pinecone_index, documents: list[dict], namespace: str = ""):
     """
     Upserts documents to the Pinecone index.
-    Input documents: {"id": "...", "text": "...", "source": "...", "page_number": ...}
-    All these fields (id, text, source, page_number) are stored as top-level attributes.
+    Input documents: {"id": "...", "text": "...", "source": "...", "page_number": ..., "chunk_index": ...}
+    All these fields (id, text, source, page_number and the optional chunk_index) are stored as top-level attributes.
+    This sends a single request; use retrieval_utils.upsert_documents_async to batch large inputs.
     Pinecone embeds the content of the "text" field due to field_map.
     """
     if not pinecone_index:
         raise ValueError("Pinecone index not initialized.")
     if not documents:
-        print("No documents provided for upserting.")
+        logger.debug("No documents provided for upserting.")
         return {"upserted_count": 0, "message": "No documents provided."}
 
     records_to_upsert = []
     for doc in documents:
         if not all(k in doc for k in ["id", "text", "source", "page_number"]):
-            print(f"Skipping doc due to missing required keys (id, text, source, page_number): {doc.get('id', 'N/A')}")
+            logger.warning(f"Skipping doc due to missing required keys (id, text, source, page_number): {doc.get('id', 'N/A')}")
             continue
         if not doc["text"].strip():
-            print(f"Skipping doc due to empty 'text': {doc.get('id', 'N/A')}")
+            logger.warning(f"Skipping doc due to empty 'text': {doc.get('id', 'N/A')}")
             continue
         
         # All fields are now top-level
-        records_to_upsert.append({
+        record = {
             "id": doc["id"],
             "text": doc["text"],
             "source": doc["source"],
             "page_number": doc["page_number"]
-        })
+        }
+        if "chunk_index" in doc:
+            record["chunk_index"] = doc["chunk_index"]
+        records_to_upsert.append(record)
     
     if not records_to_upsert:
-        return {"message": "No valid documents after filtering."}
+        return {"upserted_count": 0, "message": "No valid documents after filtering."}
 
     try:
         pinecone_index.upsert_records(records=records_to_upsert, namespace=namespace)
-        return {"message": "PDF processed and content stored."}
+        return {"upserted_count": len(records_to_upsert), "message": "PDF processed and content stored."}
     except Exception as e:
-        print(f"Error upserting to Pinecone: {e}")
+        logger.error(f"Error upserting to Pinecone: {e}")
         raise ValueError(f"Pinecone upsert failed: {str(e)}")
 
-def retrieve_from_pinecone(pinecone_index, query_text: str, top_k: int = 3, namespace: str = ""):
+def retrieve_from_pinecone(pinecone_index, query_text: str, top_k: int = 3, namespace: str = "",
+                           metadata_filter: dict = None):
     """
     Retrieves relevant documents from Pinecone.
     Pinecone, with create_index_for_model and field_map, returns user-supplied fields 
     (like source, page_number) in match.fields.
+    metadata_filter (Pinecone filter syntax, e.g. {"source": {"$in": [...]}})
+    restricts the search to matching records.
     """
     if not pinecone_index:
         raise ValueError("Pinecone index not initialized.")
     
-    print(pinecone_index.describe_index_stats())
-    
     try:
         search_payload = {"inputs": {"text": query_text}, "top_k": top_k}
-        print(f"Attempting to query Pinecone with payload: {search_payload}, namespace: '{namespace if namespace else "default"}'")
+        if metadata_filter:
+            search_payload["filter"] = metadata_filter
+        logger.debug(f"Querying Pinecone (top_k={top_k}, namespace='{namespace or 'default'}', filter={metadata_filter})")
         query_response = pinecone_index.search(
             query=search_payload, 
             namespace=namespace 
@@ -121,14 +138,51 @@ def retrieve_from_pinecone(pinecone_index, query_text: str, top_k: int = 3, name
                         "text": fields.get('text'),
                         "score": hit_item['_score'],
                         "source": fields.get("source"),
-                        "page_number": fields.get("page_number")
+                        "page_number": fields.get("page_number"),
+                        "chunk_index": fields.get("chunk_index")
                     }
                     contexts.append(context_item)
                 else:
-                    print(f"Warning: Skipping a hit due to unexpected structure or missing fields. Hit: {hit_item}")
+                    logger.warning(f"Skipping a hit due to unexpected structure or missing fields. Hit: {hit_item}")
         else:
-            print(f"Warning: No 'hits' found in Pinecone response or 'hits' is not a list. Response: {query_response}")
+            logger.debug(f"No 'hits' found in Pinecone response or 'hits' is not a list. Response: {query_response}")
 
         return contexts
     except Exception as e:
-        raise ValueError(f"Pinecone query failed: {str(e)}") 
\ No newline at end of file
+        raise ValueError(f"Pinecone query failed: {str(e)}")
+
+def delete_from_pinecone(pinecone_index, ids: list[str], namespace: str = ""):
+    """Deletes records by id from the given namespace (Pinecone takes at most 1000 ids per call)."""
+    if not pinecone_index:
+        raise ValueError("Pinecone index not initialized.")
+    ids = list(ids)
+    if not ids:
+        return {"deleted_count": 0}
+    try:
+        for start in range(0, len(ids), 1000):
+            pinecone_index.delete(ids=ids[start:start + 1000], namespace=namespace)
+        return {"deleted_count": len(ids)}
+    except Exception as e:
+        logger.error(f"Error deleting from Pinecone: {e}")
+        raise ValueError(f"Pinecone delete failed: {str(e)}")
+
+def describe_index_stats(pinecone_index) -> dict:
+    """
+    Fetches index statistics from Pinecone and returns them as a plain dict:
+    {"total_vector_count": int, "dimension": int, "index_fullness": float,
+     "namespaces": {namespace: {"vector_count": int}}}
+    This is a network round trip; callers should use the cached copy kept by
+    retrieval_utils instead of calling it on the request path.
+    """
+    if not pinecone_index:
+        raise ValueError("Pinecone index not initialized.")
+    stats = pinecone_index.describe_index_stats()
+    namespaces = {}
+    for ns_name, ns_summary in (getattr(stats, "namespaces", None) or {}).items():
+        namespaces[ns_name] = {"vector_count": getattr(ns_summary, "vector_count", 0)}
+    return {
+        "total_vector_count": getattr(stats, "total_vector_count", 0),
+        "dimension": getattr(stats, "dimension", None),
+        "index_fullness": getattr(stats, "index_fullness", None),
+        "namespaces": namespaces,
+    }
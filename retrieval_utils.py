@@ -0,0 +1,206 @@
+import os
+import logging
+import json
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from cache_utils import RetrievalCache, AnswerCache
+from bm25_utils import LexicalIndex, reciprocal_rank_fusion
+from metrics_utils import span
+
+logger = logging.getLogger(__name__)
+
+# VectorStore methods (the Pinecone SDK, local index scans) are blocking; they run
+# on this bounded thread pool so a slow search or upsert never blocks the event
+# loop (and every other stream).
+RETRIEVAL_MAX_WORKERS = int(os.getenv("RETRIEVAL_MAX_WORKERS", "16"))
+# Ingestion (upserts, deletes, BM25 indexing, chunking, manifest and fetch-cache
+# I/O) has its own pool, so a bulk ingest can't take the threads chat retrieval needs.
+INGEST_MAX_WORKERS = int(os.getenv("INGEST_MAX_WORKERS", "8"))
+INDEX_STATS_REFRESH_SECONDS = float(os.getenv("INDEX_STATS_REFRESH_SECONDS", "60"))
+# Pinecone caps integrated-embedding upserts at 96 records and 2 MB per request
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "96"))
+UPSERT_BATCH_MAX_BYTES = int(os.getenv("UPSERT_BATCH_MAX_BYTES", str(2 * 1024 * 1024)))
+UPSERT_CONCURRENCY = int(os.getenv("UPSERT_CONCURRENCY", "4"))
+# Hybrid retrieval: fuse BM25 hits with the dense hits (reciprocal rank fusion).
+# Each side contributes top_k * HYBRID_CANDIDATE_FACTOR candidates.
+HYBRID_SEARCH_ENABLED = os.getenv("HYBRID_SEARCH_ENABLED", "true").lower() == "true"
+HYBRID_CANDIDATE_FACTOR = int(os.getenv("HYBRID_CANDIDATE_FACTOR", "2"))
+
+_executor = None
+_ingest_executor = None
+_index_stats = None
+_index_stats_updated_at = None
+_index_stats_task = None
+
+retrieval_cache = RetrievalCache()
+answer_cache = AnswerCache()
+lexical_index = LexicalIndex()
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=RETRIEVAL_MAX_WORKERS, thread_name_prefix="retrieval")
+    return _executor
+
+def get_ingest_executor() -> ThreadPoolExecutor:
+    global _ingest_executor
+    if _ingest_executor is None:
+        _ingest_executor = ThreadPoolExecutor(max_workers=INGEST_MAX_WORKERS, thread_name_prefix="ingest")
+    return _ingest_executor
+
+def shutdown_executor():
+    """Shuts down both the retrieval and the ingestion executor."""
+    global _executor, _ingest_executor
+    for executor in (_executor, _ingest_executor):
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+    _executor = _ingest_executor = None
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking call on the retrieval executor and awaits its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+async def run_ingest_blocking(func, *args, **kwargs):
+    """Runs a blocking ingestion call on the ingestion executor and awaits its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_ingest_executor(), functools.partial(func, *args, **kwargs))
+
+async def _timed(stage: str, awaitable):
+    with span(stage):
+        return await awaitable
+
+async def _hybrid_search(vector_store, query_text: str, top_k: int, namespace: str, metadata_filter: dict = None):
+    """Runs the dense and the BM25 search concurrently and fuses them down to top_k hits."""
+    if not HYBRID_SEARCH_ENABLED:
+        return await _timed("vector_search", run_blocking(vector_store.search, query_text, top_k, namespace=namespace,
+                                                          metadata_filter=metadata_filter))
+    candidates = top_k * max(1, HYBRID_CANDIDATE_FACTOR)
+    dense_hits, lexical_hits = await asyncio.gather(
+        _timed("vector_search", run_blocking(vector_store.search, query_text, candidates, namespace=namespace,
+                                             metadata_filter=metadata_filter)),
+        _timed("bm25_search", run_blocking(lexical_index.search, query_text, candidates, namespace=namespace,
+                                           metadata_filter=metadata_filter)),
+    )
+    if not lexical_hits:
+        return dense_hits[:top_k]
+    return reciprocal_rank_fusion([dense_hits, lexical_hits], top_k)
+
+async def retrieve_documents_async(vector_store, query_text: str, top_k: int = 3, namespace: str = "",
+                                   metadata_filter: dict = None):
+    """
+    Async counterpart of VectorStore.search; same arguments and return value
+    (hybrid hits also carry "rrf_score"). Dense hits are fused with BM25 hits
+    unless HYBRID_SEARCH_ENABLED is off; metadata_filter applies to both.
+    Results are served from retrieval_cache when the same query was seen recently.
+    """
+    return await retrieval_cache.get_or_fetch(
+        query_text, top_k, namespace,
+        lambda: _hybrid_search(vector_store, query_text, top_k, namespace, metadata_filter),
+        metadata_filter=metadata_filter
+    )
+
+def batch_documents(documents: list[dict], max_records: int = UPSERT_BATCH_SIZE,
+                    max_bytes: int = UPSERT_BATCH_MAX_BYTES) -> list[list[dict]]:
+    """Groups documents into batches that respect both the record and the payload size limit."""
+    batches, current, current_bytes = [], [], 0
+    for doc in documents:
+        doc_bytes = len(json.dumps(doc, default=str).encode("utf-8"))
+        if current and (len(current) >= max_records or current_bytes + doc_bytes > max_bytes):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append(doc)
+        current_bytes += doc_bytes
+    if current:
+        batches.append(current)
+    return batches
+
+async def upsert_documents_async(vector_store, documents: list[dict], namespace: str = "",
+                                 concurrency: int = UPSERT_CONCURRENCY):
+    """
+    Async counterpart of VectorStore.upsert. Documents are sent in size-limited
+    batches, at most `concurrency` at a time. Returns
+    {"upserted_count": int, "batches": int, "message": str}; raises ValueError
+    if any batch failed (after the others have finished).
+    Cached retrieval results for the namespace are dropped once the write is done.
+    """
+    if not documents:
+        return await run_ingest_blocking(vector_store.upsert, documents, namespace=namespace)
+
+    batches = batch_documents(documents)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def upsert_batch(batch):
+        async with semaphore:
+            with span("vector_upsert"):
+                result = await run_ingest_blocking(vector_store.upsert, batch, namespace=namespace)
+            if HYBRID_SEARCH_ENABLED:
+                with span("bm25_index"):
+                    await run_ingest_blocking(lexical_index.add_documents, batch, namespace=namespace)
+            return result
+
+    try:
+        results = await asyncio.gather(*(upsert_batch(batch) for batch in batches), return_exceptions=True)
+    finally:
+        await invalidate_caches(namespace)
+
+    errors = [r for r in results if isinstance(r, Exception)]
+    upserted_count = sum(r.get("upserted_count", 0) for r in results if isinstance(r, dict))
+    if errors:
+        raise ValueError(f"{len(errors)} of {len(batches)} upsert batches failed "
+                         f"({upserted_count} records stored): {errors[0]}")
+    return {
+        "upserted_count": upserted_count,
+        "batches": len(batches),
+        "message": f"Stored {upserted_count} chunks in {len(batches)} batches.",
+    }
+
+async def delete_documents_async(vector_store, ids: list[str], namespace: str = ""):
+    """Async counterpart of VectorStore.delete; drops cached retrievals and answers for the namespace."""
+    try:
+        result = await run_ingest_blocking(vector_store.delete, ids, namespace=namespace)
+        if HYBRID_SEARCH_ENABLED:
+            await run_ingest_blocking(lexical_index.delete_documents, ids, namespace=namespace)
+        return result
+    finally:
+        await invalidate_caches(namespace)
+
+async def invalidate_caches(namespace: str):
+    """Drops every cached retrieval and answer that may depend on the namespace's documents."""
+    await retrieval_cache.invalidate_namespace(namespace)
+    await answer_cache.invalidate_namespace(namespace)
+
+# --- Index stats (background only) ---
+async def _refresh_index_stats_forever(vector_store, interval: float):
+    global _index_stats, _index_stats_updated_at
+    while True:
+        try:
+            _index_stats = await run_blocking(vector_store.stats)
+            _index_stats_updated_at = time.time()
+        except Exception as e:
+            logger.warning(f"Failed to refresh vector store stats: {e}")
+        await asyncio.sleep(interval)
+
+def start_index_stats_refresher(vector_store, interval: float = INDEX_STATS_REFRESH_SECONDS):
+    """Starts a background task that keeps a cached copy of the index stats."""
+    global _index_stats_task
+    if _index_stats_task is None or _index_stats_task.done():
+        _index_stats_task = asyncio.create_task(_refresh_index_stats_forever(vector_store, interval))
+    return _index_stats_task
+
+async def stop_index_stats_refresher():
+    global _index_stats_task
+    if _index_stats_task is not None:
+        _index_stats_task.cancel()
+        try:
+            await _index_stats_task
+        except asyncio.CancelledError:
+            pass
+        _index_stats_task = None
+
+def get_cached_index_stats() -> dict:
+    """Returns the last fetched index stats (None until the first refresh completes)."""
+    return {"stats": _index_stats, "updated_at": _index_stats_updated_at}
@@ -0,0 +1,124 @@
+import os
+import asyncio
+
+CHAT_SINGLEFLIGHT_ENABLED = os.getenv("CHAT_SINGLEFLIGHT_ENABLED", "true").lower() == "true"
+
+class _Flight:
+    def __init__(self):
+        self.chunks = []               # Everything produced so far, in order
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self.started = False
+        self.cleanup = None
+        self.changed = asyncio.Event() # Replaced after every notification
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight streams. The first caller for a key (the
+    leader) starts the producer in a background task; callers arriving while it
+    runs subscribe to the same flight. Every chunk is appended to the flight's
+    log and each subscriber reads the log with its own cursor, so late joiners
+    are replayed from the start and a slow reader never holds up the others.
+    The producer is cancelled if every subscriber goes away before it finishes,
+    and the flight is forgotten once it completes.
+    """
+    def __init__(self, enabled: bool = CHAT_SINGLEFLIGHT_ENABLED):
+        self.enabled = enabled
+        self.flights = {}
+        self.leaders = 0
+        self.joined = 0
+
+    async def _produce(self, key: str, flight: _Flight, producer):
+        flight.started = True
+        try:
+            async for chunk in producer:
+                flight.chunks.append(chunk)
+                flight.notify()
+        except asyncio.CancelledError:
+            flight.error = ConnectionAbortedError("Stream cancelled: all subscribers went away.")
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            if flight.cleanup is not None:
+                flight.cleanup()
+            flight.notify()
+
+    async def subscribe(self, key: str, make_producer, cleanup=None):
+        """
+        Yields the chunks of the stream for key, starting make_producer() (an
+        async generator factory) only if no identical stream is in flight.
+        The factory may raise (e.g. when there is no capacity to start new
+        work); nothing is registered then, and the exception propagates.
+        Re-raises the producer's exception after replaying what it produced.
+        cleanup (optional, sync) is called once the producer this caller started
+        has finished, or right away if the caller joined an existing flight.
+        """
+        if not self.enabled:
+            try:
+                async for chunk in make_producer():
+                    yield chunk
+            finally:
+                if cleanup is not None:
+                    cleanup()
+            return
+
+        flight = self.flights.get(key)
+        if flight is None:
+            producer = make_producer()
+            flight = _Flight()
+            flight.cleanup = cleanup
+            self.flights[key] = flight
+            flight.task = asyncio.create_task(self._produce(key, flight, producer))
+            self.leaders += 1
+        else:
+            self.joined += 1
+            if cleanup is not None:
+                cleanup()
+        flight.subscribers += 1
+
+        position = 0
+        try:
+            while True:
+                changed = flight.changed
+                if position < len(flight.chunks):
+                    chunk = flight.chunks[position]
+                    position += 1
+                    yield chunk
+                elif flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                else:
+                    await changed.wait()
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # Nobody is listening any more: new callers must not join a dying flight
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+                flight.task.cancel()
+                if not flight.started and flight.cleanup is not None:
+                    flight.cleanup()  # The task never ran, so its own cleanup won't either
+
+    def in_flight(self, key: str) -> bool:
+        return self.enabled and key in self.flights
+
+    def stats(self) -> dict:
+        started = self.leaders + self.joined
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self.flights),
+            "subscribers": sum(flight.subscribers for flight in self.flights.values()),
+            "upstream_streams": self.leaders,
+            "coalesced_requests": self.joined,
+            "coalesced_rate": round(self.joined / started, 4) if started else 0.0,
+        }
@@ -0,0 +1,97 @@
+import os
+import logging
+import json
+import time
+import asyncio
+
+logger = logging.getLogger(__name__)
+
+# Token deltas arriving within this window are sent as one SSE event (0 sends every delta at once)
+CHAT_STREAM_FLUSH_MS = float(os.getenv("CHAT_STREAM_FLUSH_MS", "40"))
+# ...unless this many characters are already buffered
+CHAT_STREAM_MAX_BUFFER_CHARS = int(os.getenv("CHAT_STREAM_MAX_BUFFER_CHARS", "512"))
+CHAT_DISCONNECT_POLL_SECONDS = float(os.getenv("CHAT_DISCONNECT_POLL_SECONDS", "0.5"))
+
+_END = object()
+
+def format_sse(event: str, data) -> str:
+    """Frames one Server-Sent Event; data is JSON-encoded so newlines in tokens are safe."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_sse_events(events, request=None, flush_ms: float = CHAT_STREAM_FLUSH_MS,
+                            max_buffer_chars: int = CHAT_STREAM_MAX_BUFFER_CHARS,
+                            disconnect_poll_seconds: float = CHAT_DISCONNECT_POLL_SECONDS):
+    """
+    Turns an async iterator of (event, data) tuples into SSE frames.
+    "token" events carry text and are batched: deltas are held for up to
+    flush_ms (or until max_buffer_chars) and sent as one event. Any other event
+    flushes pending tokens first. If the iterator raises, an "error" event is sent.
+    While streaming, request.is_disconnected() is polled; once the client is
+    gone the source iterator is closed right away, which cancels upstream work.
+    """
+    queue = asyncio.Queue()
+
+    async def pump():
+        try:
+            async for item in events:
+                await queue.put(item)
+        except Exception as e:
+            logger.error(f"Chat stream failed: {type(e).__name__}: {e}")
+            await queue.put(("error", {"message": str(e)}))
+        finally:
+            if hasattr(events, "aclose"):
+                await events.aclose()
+            await queue.put(_END)
+
+    pump_task = asyncio.create_task(pump())
+    flush_seconds = max(0.0, flush_ms / 1000.0)
+    pending, pending_chars, pending_since = [], 0, None
+    next_disconnect_check = time.monotonic() + disconnect_poll_seconds
+
+    def take_pending() -> str:
+        nonlocal pending, pending_chars, pending_since
+        frame = format_sse("token", {"text": "".join(pending)})
+        pending, pending_chars, pending_since = [], 0, None
+        return frame
+
+    try:
+        while True:
+            now = time.monotonic()
+            timeout = next_disconnect_check - now if request is not None else None
+            if pending:
+                flush_in = pending_since + flush_seconds - now
+                timeout = flush_in if timeout is None else min(timeout, flush_in)
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=max(0.0, timeout)) if timeout is not None \
+                    else await queue.get()
+            except asyncio.TimeoutError:
+                item = None
+
+            now = time.monotonic()
+            if request is not None and now >= next_disconnect_check:
+                if await request.is_disconnected():
+                    logger.info("Client disconnected; closing the chat stream.")
+                    return
+                next_disconnect_check = now + disconnect_poll_seconds
+
+            if item is _END:
+                if pending:
+                    yield take_pending()
+                return
+            if item is not None:
+                event, data = item
+                if event == "token":
+                    if data:
+                        pending.append(data)
+                        pending_chars += len(data)
+                        pending_since = pending_since or now
+                else:
+                    if pending:
+                        yield take_pending()
+                    yield format_sse(event, data)
+                    continue
+            if pending and (pending_chars >= max_buffer_chars or now - pending_since >= flush_seconds):
+                yield take_pending()
+    finally:
+        pump_task.cancel()
+        await asyncio.gather(pump_task, return_exceptions=True)
@@ -0,0 +1,402 @@
+import os
+import logging
+import re
+import json
+import math
+import zlib
+import threading
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from pinecone_utils import (
+    init_pinecone_index, upsert_documents, retrieve_from_pinecone, delete_from_pinecone, describe_index_stats
+)
+from filter_utils import matches_metadata_filter
+
+logger = logging.getLogger(__name__)
+
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "pinecone")  # "pinecone" or "local"
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "local_index")
+LOCAL_EMBEDDER = os.getenv("LOCAL_EMBEDDER", "hashing")  # "hashing" or "sentence-transformers"
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+LOCAL_EMBEDDING_DIM = int(os.getenv("LOCAL_EMBEDDING_DIM", "1024"))  # Only used by the hashing embedder
+# Above this many vectors a namespace is partitioned (IVF) and only the closest
+# LOCAL_IVF_NPROBE partitions are scanned per query.
+LOCAL_IVF_MIN_VECTORS = int(os.getenv("LOCAL_IVF_MIN_VECTORS", "50000"))
+LOCAL_IVF_NPROBE = int(os.getenv("LOCAL_IVF_NPROBE", "8"))
+
+RECORD_FIELDS = ("text", "source", "page_number", "chunk_index")
+_NAMESPACE_RE = re.compile(r"^[A-Za-z0-9_.-]*$")
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+class VectorStore(ABC):
+    """
+    Storage/search backend used by retrieval_utils. All methods are blocking;
+    retrieval_utils runs them on its executor.
+    Documents and search hits use the same dicts as pinecone_utils:
+    {"id", "text", "source", "page_number", "chunk_index"} (+ "score" on hits).
+    """
+    name = "base"
+
+    @abstractmethod
+    def upsert(self, documents: list[dict], namespace: str = "") -> dict:
+        """Stores documents; returns {"upserted_count": int, "message": str}."""
+
+    @abstractmethod
+    def search(self, query_text: str, top_k: int = 3, namespace: str = "", metadata_filter: dict = None) -> list[dict]:
+        """Returns up to top_k hits, best first, among records matching metadata_filter (Pinecone syntax)."""
+
+    @abstractmethod
+    def delete(self, ids: list[str], namespace: str = "") -> dict:
+        """Deletes records by id; returns {"deleted_count": int}."""
+
+    @abstractmethod
+    def stats(self) -> dict:
+        """Same shape as pinecone_utils.describe_index_stats."""
+
+    def close(self):
+        pass
+
+class PineconeVectorStore(VectorStore):
+    name = "pinecone"
+
+    def __init__(self, pinecone_index):
+        self.index = pinecone_index
+
+    def upsert(self, documents: list[dict], namespace: str = "") -> dict:
+        return upsert_documents(self.index, documents, namespace=namespace)
+
+    def search(self, query_text: str, top_k: int = 3, namespace: str = "", metadata_filter: dict = None) -> list[dict]:
+        return retrieve_from_pinecone(self.index, query_text, top_k, namespace=namespace, metadata_filter=metadata_filter)
+
+    def delete(self, ids: list[str], namespace: str = "") -> dict:
+        return delete_from_pinecone(self.index, ids, namespace=namespace)
+
+    def stats(self) -> dict:
+        return describe_index_stats(self.index)
+
+# --- Local embedders ---
+class HashingEmbedder:
+    """
+    Dependency-free, deterministic embedder: signed feature hashing of word
+    unigrams and bigrams with sublinear term frequency, L2-normalized. It is
+    lexical rather than semantic, which makes it a good fit for tests,
+    benchmarks and air-gapped setups without a model download.
+    """
+    def __init__(self, dimension: int = LOCAL_EMBEDDING_DIM):
+        self.dimension = dimension
+
+    def _features(self, text: str) -> dict:
+        words = _WORD_RE.findall(text.lower())
+        counts = {}
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            counts[feature] = counts.get(feature, 0) + 1
+        return counts
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, count in self._features(text).items():
+                h = zlib.crc32(feature.encode("utf-8"))
+                sign = 1.0 if (h >> 31) & 1 else -1.0
+                matrix[row, h % self.dimension] += sign * (1.0 + math.log(count))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+class SentenceTransformerEmbedder:
+    """Semantic embeddings from a local sentence-transformers model (optional dependency)."""
+    def __init__(self, model_name: str = LOCAL_EMBEDDING_MODEL):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ValueError("LOCAL_EMBEDDER=sentence-transformers requires `pip install sentence-transformers`.")
+        self.model = SentenceTransformer(model_name)
+        self.dimension = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        return np.asarray(self.model.encode(texts, normalize_embeddings=True), dtype=np.float32)
+
+def make_embedder(name: str = LOCAL_EMBEDDER):
+    if name == "hashing":
+        return HashingEmbedder()
+    if name == "sentence-transformers":
+        return SentenceTransformerEmbedder()
+    raise ValueError(f"Unknown LOCAL_EMBEDDER: {name}")
+
+# --- Local memory-mapped index ---
+class _LocalNamespace:
+    """
+    One namespace of the local index, stored in its own directory:
+    vectors.f32  - float32 matrix (capacity x dim), memory-mapped, grown by doubling
+    records.jsonl - append-only log of upserted records and deletions, replayed on load
+    Rows of deleted or overwritten records are masked out, not compacted.
+    """
+    def __init__(self, directory: str, dimension: int):
+        self.directory = directory
+        self.dimension = dimension
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.log_path = os.path.join(directory, "records.jsonl")
+        self.lock = threading.RLock()
+        self.count = 0                 # rows used (alive or not)
+        self.id_to_row = {}
+        self.row_ids = []
+        self.records = []              # row -> stored fields
+        self.alive = np.zeros(0, dtype=bool)
+        self.matrix = None
+        # IVF partitioning
+        self.centroids = None
+        self.row_partition = np.zeros(0, dtype=np.int32)
+        self.ivf_built_at_count = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _open_matrix(self, capacity: int):
+        if self.matrix is not None:
+            self.matrix.flush()
+            del self.matrix
+        mode = "r+" if os.path.exists(self.vectors_path) else "w+"
+        if mode == "r+" and os.path.getsize(self.vectors_path) < capacity * self.dimension * 4:
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(capacity * self.dimension * 4)
+        self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode=mode, shape=(capacity, self.dimension))
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:len(self.alive)] = self.alive[:capacity]
+        self.alive = alive
+
+    def _ensure_capacity(self, rows_needed: int):
+        capacity = self.matrix.shape[0] if self.matrix is not None else 0
+        if rows_needed <= capacity:
+            return
+        new_capacity = max(1024, capacity)
+        while new_capacity < rows_needed:
+            new_capacity *= 2
+        self._open_matrix(new_capacity)
+
+    def _load(self):
+        if os.path.exists(self.vectors_path):
+            capacity = os.path.getsize(self.vectors_path) // (self.dimension * 4)
+            self._open_matrix(max(capacity, 1024))
+        else:
+            self._open_matrix(1024)
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, "r", encoding="utf-8") as log:
+            for line in log:
+                entry = json.loads(line)
+                if "delete" in entry:
+                    row = self.id_to_row.pop(entry["delete"], None)
+                    if row is not None:
+                        self.alive[row] = False
+                    continue
+                row = entry["row"]
+                while len(self.row_ids) <= row:
+                    self.row_ids.append(None)
+                    self.records.append(None)
+                previous = self.id_to_row.get(entry["id"])
+                if previous is not None:
+                    self.alive[previous] = False
+                self.id_to_row[entry["id"]] = row
+                self.row_ids[row] = entry["id"]
+                self.records[row] = entry["fields"]
+                self.alive[row] = True
+        self.count = len(self.row_ids)
+
+    def upsert(self, documents: list[dict], vectors: np.ndarray):
+        with self.lock:
+            self._ensure_capacity(self.count + len(documents))
+            start = self.count
+            with open(self.log_path, "a", encoding="utf-8") as log:
+                for offset, doc in enumerate(documents):
+                    row = start + offset
+                    previous = self.id_to_row.get(doc["id"])
+                    if previous is not None:
+                        self.alive[previous] = False
+                    fields = {k: doc[k] for k in RECORD_FIELDS if k in doc}
+                    self.id_to_row[doc["id"]] = row
+                    self.row_ids.append(doc["id"])
+                    self.records.append(fields)
+                    self.alive[row] = True
+                    log.write(json.dumps({"row": row, "id": doc["id"], "fields": fields}) + "\n")
+            self.matrix[start:start + len(documents)] = vectors
+            self.matrix.flush()
+            self.count += len(documents)
+            if self.centroids is not None:
+                self._assign_partitions(start, self.count)
+            alive_count = len(self.id_to_row)
+            if alive_count >= LOCAL_IVF_MIN_VECTORS and alive_count >= 2 * self.ivf_built_at_count:
+                self.build_ivf()
+
+    def delete(self, ids: list[str]) -> int:
+        deleted = 0
+        with self.lock, open(self.log_path, "a", encoding="utf-8") as log:
+            for doc_id in ids:
+                row = self.id_to_row.pop(doc_id, None)
+                if row is None:
+                    continue
+                self.alive[row] = False
+                log.write(json.dumps({"delete": doc_id}) + "\n")
+                deleted += 1
+        return deleted
+
+    def build_ivf(self, n_lists: int = None, iterations: int = 10):
+        """Partitions the alive vectors with spherical k-means (sqrt(n) lists by default)."""
+        with self.lock:
+            rows = np.flatnonzero(self.alive[:self.count])
+            if len(rows) == 0:
+                return
+            n_lists = n_lists or max(1, int(math.sqrt(len(rows))))
+            rng = np.random.default_rng(0)
+            sample = rows if len(rows) <= 256 * n_lists else rng.choice(rows, 256 * n_lists, replace=False)
+            data = np.asarray(self.matrix[np.sort(sample)])
+            centroids = data[rng.choice(len(data), min(n_lists, len(data)), replace=False)].copy()
+            for _ in range(iterations):
+                assignment = np.argmax(data @ centroids.T, axis=1)
+                for c in range(len(centroids)):
+                    members = data[assignment == c]
+                    if len(members):
+                        centroid = members.sum(axis=0)
+                        centroids[c] = centroid / (np.linalg.norm(centroid) or 1.0)
+            self.centroids = centroids
+            self.row_partition = np.zeros(self.alive.shape[0], dtype=np.int32)
+            self._assign_partitions(0, self.count)
+            self.ivf_built_at_count = len(rows)
+            logger.info(f"Built IVF index with {len(centroids)} partitions over {len(rows)} vectors in {self.directory}.")
+
+    def _assign_partitions(self, start: int, end: int):
+        if len(self.row_partition) < self.alive.shape[0]:
+            grown = np.zeros(self.alive.shape[0], dtype=np.int32)
+            grown[:len(self.row_partition)] = self.row_partition
+            self.row_partition = grown
+        for block_start in range(start, end, 65536):
+            block_end = min(end, block_start + 65536)
+            block = np.asarray(self.matrix[block_start:block_end])
+            self.row_partition[block_start:block_end] = np.argmax(block @ self.centroids.T, axis=1)
+
+    def search(self, query_vector: np.ndarray, top_k: int, predicate=None) -> list[tuple[int, float]]:
+        """predicate, if given, is called with a row's stored fields; rows it rejects are skipped."""
+        with self.lock:
+            if self.count == 0 or top_k <= 0:
+                return []
+            candidates = self.alive[:self.count].copy()
+            if predicate is not None:
+                candidates &= np.fromiter((predicate(fields) for fields in self.records[:self.count]),
+                                          dtype=bool, count=self.count)
+            if self.centroids is not None and len(self.centroids) > LOCAL_IVF_NPROBE:
+                centroid_scores = self.centroids @ query_vector
+                probe = np.argpartition(-centroid_scores, LOCAL_IVF_NPROBE - 1)[:LOCAL_IVF_NPROBE]
+                candidates &= np.isin(self.row_partition[:self.count], probe)
+            rows = np.flatnonzero(candidates)
+            if len(rows) == 0:
+                return []
+            # Contiguous scan when most rows are candidates, gather otherwise
+            if len(rows) > self.count // 2:
+                scores = np.asarray(self.matrix[:self.count]) @ query_vector
+                scores = scores[rows]
+            else:
+                scores = np.asarray(self.matrix[rows]) @ query_vector
+            k = min(top_k, len(rows))
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+            return [(int(rows[i]), float(scores[i])) for i in best]
+
+    def close(self):
+        with self.lock:
+            if self.matrix is not None:
+                self.matrix.flush()
+
+class LocalVectorStore(VectorStore):
+    """
+    Local, in-process index: one memory-mapped float32 matrix per namespace,
+    exact cosine top-k with argpartition (IVF-partitioned above
+    LOCAL_IVF_MIN_VECTORS). Embeddings come from a pluggable embedder with an
+    `embed(texts) -> np.ndarray` method and a `dimension` attribute.
+    """
+    name = "local"
+
+    def __init__(self, directory: str = LOCAL_INDEX_DIR, embedder=None):
+        self.directory = directory
+        self.embedder = embedder or make_embedder()
+        self.namespaces = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        for entry in os.listdir(directory):
+            if os.path.isdir(os.path.join(directory, entry)):
+                self._namespace(self._namespace_from_dir(entry))
+
+    @staticmethod
+    def _dir_for_namespace(namespace: str) -> str:
+        if not _NAMESPACE_RE.match(namespace) or namespace in (".", ".."):
+            raise ValueError(f"Invalid namespace for the local index: {namespace!r}")
+        return f"ns-{namespace}" if namespace else "default"
+
+    @staticmethod
+    def _namespace_from_dir(dirname: str) -> str:
+        return dirname[3:] if dirname.startswith("ns-") else ""
+
+    def _namespace(self, namespace: str) -> _LocalNamespace:
+        with self.lock:
+            ns = self.namespaces.get(namespace)
+            if ns is None:
+                directory = os.path.join(self.directory, self._dir_for_namespace(namespace))
+                ns = _LocalNamespace(directory, self.embedder.dimension)
+                self.namespaces[namespace] = ns
+            return ns
+
+    def upsert(self, documents: list[dict], namespace: str = "") -> dict:
+        valid = [
+            doc for doc in documents
+            if all(k in doc for k in ("id", "text", "source", "page_number")) and doc["text"].strip()
+        ]
+        if not valid:
+            return {"upserted_count": 0, "message": "No valid documents after filtering."}
+        vectors = self.embedder.embed([doc["text"] for doc in valid])
+        self._namespace(namespace).upsert(valid, vectors)
+        return {"upserted_count": len(valid), "message": "Content stored in the local index."}
+
+    def search(self, query_text: str, top_k: int = 3, namespace: str = "", metadata_filter: dict = None) -> list[dict]:
+        ns = self._namespace(namespace)
+        query_vector = self.embedder.embed([query_text])[0]
+        predicate = (lambda fields: matches_metadata_filter(fields, metadata_filter)) if metadata_filter else None
+        hits = []
+        for row, score in ns.search(query_vector, top_k, predicate):
+            fields = ns.records[row]
+            hits.append({
+                "id": ns.row_ids[row],
+                "text": fields.get("text"),
+                "score": score,
+                "source": fields.get("source"),
+                "page_number": fields.get("page_number"),
+                "chunk_index": fields.get("chunk_index"),
+            })
+        return hits
+
+    def delete(self, ids: list[str], namespace: str = "") -> dict:
+        return {"deleted_count": self._namespace(namespace).delete(ids)}
+
+    def build_ivf(self, namespace: str = "", n_lists: int = None):
+        self._namespace(namespace).build_ivf(n_lists)
+
+    def stats(self) -> dict:
+        namespaces = {name: {"vector_count": len(ns.id_to_row)} for name, ns in list(self.namespaces.items())}
+        return {
+            "total_vector_count": sum(ns["vector_count"] for ns in namespaces.values()),
+            "dimension": self.embedder.dimension,
+            "index_fullness": None,
+            "namespaces": namespaces,
+        }
+
+    def close(self):
+        for ns in list(self.namespaces.values()):
+            ns.close()
+
+def init_vector_store(backend: str = VECTOR_STORE_BACKEND) -> VectorStore:
+    """Creates the configured vector store (VECTOR_STORE_BACKEND)."""
+    if backend == "local":
+        store = LocalVectorStore()
+        logger.info(f"Using local vector store in '{store.directory}' ({type(store.embedder).__name__}).")
+        return store
+    if backend == "pinecone":
+        return PineconeVectorStore(init_pinecone_index())
+    raise ValueError(f"Unknown VECTOR_STORE_BACKEND: {backend}")
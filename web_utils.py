@@ -1,77 +1,559 @@
+import os
+import logging
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, urlunsplit, urljoin, urldefrag, parse_qsl, urlencode
 import re
+import time
+import codecs
+import sqlite3
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import httpx
 from bs4 import BeautifulSoup
+from metrics_utils import span, configure_worker_logging
+from retrieval_utils import run_ingest_blocking
+
+try:
+    import lxml.html
+    import lxml.etree
+    LXML_AVAILABLE = True
+except ImportError:
+    LXML_AVAILABLE = False
+
+try:
+    import h2  # noqa: F401 - httpx only negotiates HTTP/2 when this is installed
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+WEB_MAX_CONNECTIONS = int(os.getenv("WEB_MAX_CONNECTIONS", "20"))
+WEB_CACHE_PATH = os.getenv("WEB_CACHE_PATH", "web_cache.sqlite3")
+WEB_MAX_DOWNLOAD_BYTES = int(os.getenv("WEB_MAX_DOWNLOAD_BYTES", str(10 * 1024 * 1024)))
+HTML_PARSE_WORKERS = int(os.getenv("HTML_PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))
+WEB_RATE_LIMIT_PER_MINUTE = int(os.getenv("WEB_RATE_LIMIT_PER_MINUTE", "20"))
+WEB_RATE_LIMIT_BURST = int(os.getenv("WEB_RATE_LIMIT_BURST", "1"))
+WEB_DEFAULT_RETRY_AFTER_SECONDS = float(os.getenv("WEB_DEFAULT_RETRY_AFTER_SECONDS", "30"))
+WEB_MAX_RETRY_AFTER_SECONDS = float(os.getenv("WEB_MAX_RETRY_AFTER_SECONDS", "300"))
+ALLOWED_CONTENT_TYPES = ("text/html", "application/xhtml+xml", "text/plain")
+# Query parameters that only track the visitor and never change the page
+_TRACKING_PARAMS = ("utm_", "fbclid", "gclid", "mc_cid", "mc_eid")
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+class _HostBucket:
+    __slots__ = ("tokens", "updated", "waiting", "acquired", "total_wait", "max_wait", "throttled")
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.updated = now
+        self.waiting = 0
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.throttled = 0
 
 class RateLimiter:
-    def __init__(self, requests_per_minute: int = 30):
+    """
+    Per-host token bucket. acquire() reserves a token immediately (the balance
+    may go negative) and sleeps until that token would have been refilled, so
+    concurrent callers are spaced out in arrival order instead of all waking
+    together. Everything between reading and updating a bucket is synchronous,
+    which makes it safe across coroutines without a lock, and each acquire is O(1).
+    penalize() pushes a host's balance into debt after a 429/Retry-After.
+    """
+    def __init__(self, requests_per_minute: int = WEB_RATE_LIMIT_PER_MINUTE, burst: int = WEB_RATE_LIMIT_BURST,
+                 max_hosts: int = 10000):
         self.requests_per_minute = requests_per_minute
-        self.requests = []
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(max(1, burst))
+        self.max_hosts = max_hosts
+        self.buckets = {}
+
+    def _bucket(self, host: str, now: float) -> _HostBucket:
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            if len(self.buckets) >= self.max_hosts:
+                self._prune(now)
+            bucket = _HostBucket(self.capacity, now)
+            self.buckets[host] = bucket
+        else:
+            bucket.tokens = min(self.capacity, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        return bucket
+
+    def _prune(self, now: float):
+        # Forget hosts whose bucket has refilled completely: recreating them is equivalent
+        for host in [h for h, b in self.buckets.items()
+                     if not b.waiting and b.tokens + (now - b.updated) * self.rate >= self.capacity]:
+            del self.buckets[host]
+
+    async def acquire(self, host: str = ""):
+        bucket = self._bucket(host, time.monotonic())
+        bucket.tokens -= 1.0
+        bucket.acquired += 1
+        wait_time = -bucket.tokens / self.rate if bucket.tokens < 0 else 0.0
+        if wait_time <= 0:
+            return
+        bucket.total_wait += wait_time
+        bucket.max_wait = max(bucket.max_wait, wait_time)
+        bucket.waiting += 1
+        try:
+            logger.debug(f"Rate limiter active for '{host}': waiting for {wait_time:.2f} seconds.")
+            await asyncio.sleep(wait_time)
+        except asyncio.CancelledError:
+            bucket.tokens += 1.0  # hand the reserved token back
+            raise
+        finally:
+            bucket.waiting -= 1
+
+    def penalize(self, host: str, retry_after: float):
+        """Blocks new requests to host for retry_after seconds (e.g. from a 429 Retry-After header)."""
+        bucket = self._bucket(host, time.monotonic())
+        bucket.tokens = min(bucket.tokens, -retry_after * self.rate)
+        bucket.throttled += 1
+        logger.warning(f"Host '{host}' asked us to back off; pausing it for {retry_after:.1f} seconds.")
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        hosts = {}
+        for host, bucket in self.buckets.items():
+            tokens = min(self.capacity, bucket.tokens + (now - bucket.updated) * self.rate)
+            hosts[host] = {
+                "acquired": bucket.acquired,
+                "waiting": bucket.waiting,
+                "throttled": bucket.throttled,
+                "avg_wait_seconds": round(bucket.total_wait / bucket.acquired, 3) if bucket.acquired else 0.0,
+                "max_wait_seconds": round(bucket.max_wait, 3),
+                "next_slot_in_seconds": round(max(0.0, (1.0 - tokens) / self.rate), 3),
+            }
+        return {
+            "requests_per_minute": self.requests_per_minute,
+            "burst": int(self.capacity),
+            "waiting": sum(bucket.waiting for bucket in self.buckets.values()),
+            "hosts": hosts,
+        }
+
+def parse_retry_after(value: str, default: float = WEB_DEFAULT_RETRY_AFTER_SECONDS) -> float:
+    """Reads a Retry-After header (delay in seconds or HTTP date), capped at WEB_MAX_RETRY_AFTER_SECONDS."""
+    seconds = default
+    if value:
+        value = value.strip()
+        if value.isdigit():
+            seconds = float(value)
+        else:
+            try:
+                seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                pass
+    return min(max(seconds, 0.0), WEB_MAX_RETRY_AFTER_SECONDS)
+
+# --- HTML extraction (runs in worker processes; must stay top-level so it can be pickled) ---
+_BOILERPLATE_TAGS = ("script", "style", "noscript", "template", "svg", "iframe", "nav", "header", "footer", "aside", "form")
+_BLOCK_TAGS = ("p", "pre", "td", "li", "blockquote", "h1", "h2", "h3", "h4", "dd")
+
+def _normalize_whitespace(text: str) -> str:
+    return re.sub(r'\s+', ' ', text).strip()
+
+def _absolute_links(base_url: str, hrefs) -> list[str]:
+    links = []
+    for href in hrefs:
+        href = (href or "").strip()
+        if not href or href.startswith(("#", "mailto:", "javascript:", "tel:")):
+            continue
+        absolute = urldefrag(urljoin(base_url, href))[0]
+        if absolute.startswith(("http://", "https://")):
+            links.append(absolute)
+    return list(dict.fromkeys(links))
+
+_HEADER_CHARSET_RE = re.compile(r"charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+_META_CHARSET_RE = re.compile(rb"<meta[^>]+charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+_BOMS = ((codecs.BOM_UTF8, "utf-8"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"))
+
+def _known_codec(name) -> str:
+    try:
+        return codecs.lookup(name).name if name else None
+    except LookupError:
+        return None
+
+def detect_charset(body: bytes, content_type: str) -> str:
+    """
+    Charset of a response body: the Content-Type header's, else a byte order
+    mark, else (for HTML) a <meta charset> near the top, else UTF-8.
+    """
+    header_match = _HEADER_CHARSET_RE.search(content_type or "")
+    charset = _known_codec(header_match.group(1)) if header_match else None
+    if charset:
+        return charset
+    for bom, name in _BOMS:
+        if body.startswith(bom):
+            return name
+    if not (content_type or "").startswith("text/plain"):
+        meta_match = _META_CHARSET_RE.search(body[:4096])
+        charset = _known_codec(meta_match.group(1).decode("ascii", errors="ignore")) if meta_match else None
+    return charset or "utf-8"
+
+def _extract_with_lxml(body: bytes, encoding: str, base_url: str, want_links: bool) -> dict:
+    doc = lxml.html.document_fromstring(body, parser=lxml.html.HTMLParser(encoding=encoding))
+    # Links and the canonical URL are read before navigation is stripped
+    canonical = next(iter(doc.xpath("//link[@rel='canonical']/@href")), None)
+    links = _absolute_links(base_url, doc.xpath("//a/@href")) if want_links else []
+    lxml.etree.strip_elements(doc, lxml.etree.Comment, *_BOILERPLATE_TAGS, with_tail=False)
+    return {"text": _main_text(doc), "links": links,
+            "canonical": urljoin(base_url, canonical.strip()) if canonical else None}
+
+def _main_text(doc) -> str:
+    # Prefer explicit main-content containers
+    for xpath in ("//main", "//article", "//*[@role='main']"):
+        found = doc.xpath(xpath)
+        if found:
+            text = _normalize_whitespace(" ".join(el.text_content() for el in found))
+            if text:
+                return text
+
+    # Otherwise score containers by the text of their block-level children
+    # (readability-style): a parent gets a block's full length, a grandparent half.
+    scores = {}
+    for block in doc.iter(*_BLOCK_TAGS):
+        length = len(_normalize_whitespace(block.text_content()))
+        if length < 25:
+            continue
+        parent = block.getparent()
+        if parent is None:
+            continue
+        scores[parent] = scores.get(parent, 0) + length
+        grandparent = parent.getparent()
+        if grandparent is not None:
+            scores[grandparent] = scores.get(grandparent, 0) + length / 2
+
+    body_el = doc.find("body")
+    full_text = _normalize_whitespace((body_el if body_el is not None else doc).text_content())
+    if scores:
+        best = max(scores, key=scores.get)
+        best_text = _normalize_whitespace(best.text_content())
+        # Only trust the winner if it holds a meaningful share of the page
+        if len(best_text) >= 0.25 * len(full_text):
+            return best_text
+    return full_text
+
+def _extract_with_bs4(body: bytes, encoding: str, base_url: str, want_links: bool) -> dict:
+    soup = BeautifulSoup(body, "html.parser", from_encoding=encoding)
+    canonical = soup.find("link", rel="canonical", href=True)
+    links = _absolute_links(base_url, (a["href"] for a in soup.find_all("a", href=True))) if want_links else []
+    for element in soup(list(_BOILERPLATE_TAGS)):
+        element.decompose()
+    return {"text": _normalize_whitespace(soup.get_text(separator=' ', strip=True)), "links": links,
+            "canonical": urljoin(base_url, canonical["href"].strip()) if canonical else None}
+
+def extract_page(body: bytes, content_type: str, base_url: str = "", want_links: bool = False) -> dict:
+    """
+    Extracts the main readable text from an HTML (or plain text) response body.
+    The body is decoded with detect_charset().
+    Returns {"text": str, "links": [absolute URLs] (only with want_links), "canonical": str or None}.
+    """
+    encoding = detect_charset(body, content_type)
+    if content_type.startswith("text/plain"):
+        text = body.decode(encoding, errors="replace")
+        return {"text": _normalize_whitespace(text), "links": [], "canonical": None}
+    if LXML_AVAILABLE:
+        try:
+            return _extract_with_lxml(body, encoding, base_url, want_links)
+        except Exception as e:
+            logger.warning(f"lxml extraction failed ({e}); falling back to BeautifulSoup.")
+    return _extract_with_bs4(body, encoding, base_url, want_links)
 
-    async def acquire(self):
-        now = datetime.now()
-        # Remove requests older than 1 minute
-        self.requests = [
-            req for req in self.requests if now - req < timedelta(minutes=1)
-        ]
+_parse_pool = None
 
-        if len(self.requests) >= self.requests_per_minute:
-            # Wait until we can make another request
-            wait_time = 60 - (now - self.requests[0]).total_seconds()
-            if wait_time > 0:
-                print(f"Rate limiter active: waiting for {wait_time:.2f} seconds.")
-                await asyncio.sleep(wait_time)
+def get_parse_pool() -> ProcessPoolExecutor:
+    global _parse_pool
+    if _parse_pool is None:
+        # Spawned, not forked: forking would copy held locks and the parent's log queue handler
+        _parse_pool = ProcessPoolExecutor(max_workers=HTML_PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                          initializer=configure_worker_logging)
+    return _parse_pool
 
-        self.requests.append(now) 
+def shutdown_parse_pool():
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown(wait=False, cancel_futures=True)
+        _parse_pool = None
+
+class FetchCache:
+    """
+    On-disk (SQLite) record of what was last ingested per (namespace, URL):
+    ETag, Last-Modified and a SHA-256 of the raw body. Used to send conditional
+    GETs and to skip parsing/upserting pages that haven't changed.
+    Methods block on disk I/O: call them through run_ingest_blocking from async code.
+    """
+    def __init__(self, path: str = WEB_CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS fetch_cache ("
+            "namespace TEXT NOT NULL, url TEXT NOT NULL, etag TEXT, last_modified TEXT, "
+            "content_hash TEXT, fetched_at REAL, PRIMARY KEY (namespace, url))"
+        )
+        self.conn.commit()
+
+    def get(self, url: str, namespace: str = ""):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, content_hash FROM fetch_cache WHERE namespace = ? AND url = ?",
+                (namespace, url)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"etag": row[0], "last_modified": row[1], "content_hash": row[2]}
+
+    def put(self, url: str, etag: str, last_modified: str, content_hash: str, namespace: str = ""):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO fetch_cache (namespace, url, etag, last_modified, content_hash, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, url, etag, last_modified, content_hash, time.time())
+            )
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class FetchResult:
+    """
+    Outcome of WebContentFetcher.fetch. `text` is None when not_modified or on error.
+    On error, `retryable` tells whether trying again later may help and
+    `error_status` is the HTTP status the API should report.
+    `final_url` is the URL after redirects and `canonical_url` the page's
+    rel=canonical, if any; `links` are only filled in when links were asked for.
+    """
+    def __init__(self, url: str, text: str = None, error: str = None, not_modified: bool = False,
+                 status_code: int = None, etag: str = None, last_modified: str = None, content_hash: str = None,
+                 retryable: bool = False, error_status: int = 400, final_url: str = None,
+                 body: bytes = None, content_type: str = None):
+        self.url = url
+        self.text = text
+        self.final_url = final_url
+        self.links = []
+        self.canonical_url = None
+        self.body = body
+        self.content_type = content_type
+        self.error = error
+        self.retryable = retryable
+        self.error_status = error_status
+        self.not_modified = not_modified
+        self.status_code = status_code
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_hash = content_hash
+
+def canonicalize_url(url: str) -> str:
+    """
+    Normalizes a URL for deduplication: lowercase scheme and host, no default
+    port, no fragment, "/" for an empty path, tracking parameters removed and
+    the remaining query parameters sorted.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and (scheme, parts.port) not in (("http", 80), ("https", 443)):
+        host = f"{host}:{parts.port}"
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith(_TRACKING_PARAMS)
+    )
+    return urlunsplit((scheme, host, parts.path or "/", urlencode(query), ""))
+
+def page_source_url(result: FetchResult, url: str) -> str:
+    """
+    The canonicalized URL a fetched page is stored under: its rel=canonical if
+    that is an http(s) URL on the same host, otherwise the URL after redirects.
+    A page can't claim another host's URL and overwrite that source.
+    """
+    source = result.final_url or url
+    canonical = result.canonical_url
+    if canonical:
+        parts, final = urlsplit(canonical), urlsplit(source)
+        if parts.scheme in ("http", "https") and (parts.hostname or "").lower() == (final.hostname or "").lower():
+            source = canonical
+    return canonicalize_url(source)
 
 class WebContentFetcher:
     def __init__(self):
-        self.rate_limiter = RateLimiter(requests_per_minute=20)
+        self.rate_limiter = RateLimiter()
+        self.cache = FetchCache()
+        self.client = None
 
-    async def fetch_and_parse(self, url: str) -> str:
-        """Fetch and parse content from a webpage"""
-        try:
-            await self.rate_limiter.acquire()
-
-            print(f"Fetching content from: {url}")
-
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    url,
-                    headers={
-                        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-                    },
-                    follow_redirects=True,
-                    timeout=30.0, # seconds
-                )
-                response.raise_for_status()
+    def _get_client(self) -> httpx.AsyncClient:
+        # One pooled client for the whole process: connections (and TLS sessions)
+        # are kept alive and reused across fetches.
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                headers={"User-Agent": USER_AGENT},
+                follow_redirects=True,
+                timeout=30.0, # seconds
+                limits=httpx.Limits(
+                    max_connections=WEB_MAX_CONNECTIONS,
+                    max_keepalive_connections=WEB_MAX_CONNECTIONS,
+                    keepalive_expiry=30.0,
+                ),
+            )
+        return self.client
 
-            soup = BeautifulSoup(response.text, "html.parser")
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+        self.cache.close()
+
+    async def _read_capped(self, response: httpx.Response, max_bytes: int):
+        """Reads a streamed body up to max_bytes, hashing as it goes. Returns (body, sha256) or None if over the cap."""
+        digest = hashlib.sha256()
+        body = bytearray()
+        async for chunk in response.aiter_bytes():
+            body.extend(chunk)
+            if len(body) > max_bytes:
+                return None
+            digest.update(chunk)
+        return bytes(body), digest.hexdigest()
+
+    async def _download(self, url: str, headers: dict = None,
+                        allowed_types: tuple = ALLOWED_CONTENT_TYPES) -> FetchResult:
+        """
+        Rate-limited, size-capped GET. On success the raw bytes are in `body`;
+        a 304 comes back as not_modified. Errors are returned, not raised.
+        """
+        host = ""
+        try:
+            host = urlsplit(url).netloc.lower()
+            await self.rate_limiter.acquire(host)
 
-            for element in soup(["script", "style", "nav", "header", "footer", "aside", "form"]):
-                element.decompose()
+            logger.debug(f"Fetching content from: {url}")
 
-            text = soup.get_text(separator=' ', strip=True)
-            
-            text = re.sub(r'\s+', ' ', text).strip()
+            async with self._get_client().stream("GET", url, headers=headers or {}) as response:
+                if response.status_code == 304:
+                    return FetchResult(url, not_modified=True, status_code=304, final_url=str(response.url))
+                response.raise_for_status()
 
-            # MAX_TEXT_LENGTH = 8000 
-            # if len(text) > MAX_TEXT_LENGTH:
-            #     text = text[:MAX_TEXT_LENGTH] + "... [content truncated]"
+                # Reject binary and oversized responses before downloading them
+                content_type = response.headers.get("Content-Type", "text/html").lower()
+                if not content_type.startswith(allowed_types):
+                    logger.info(f"Unsupported content type '{content_type}' at {url}")
+                    return FetchResult(url, status_code=response.status_code, error_status=415,
+                                       error=f"Error: Unsupported content type: {content_type}")
+                declared_length = response.headers.get("Content-Length")
+                too_large_error = f"Error: The webpage is larger than the {WEB_MAX_DOWNLOAD_BYTES} byte limit."
+                if declared_length and declared_length.isdigit() and int(declared_length) > WEB_MAX_DOWNLOAD_BYTES:
+                    return FetchResult(url, status_code=response.status_code, error_status=413, error=too_large_error)
+                read = await self._read_capped(response, WEB_MAX_DOWNLOAD_BYTES)
+                if read is None:
+                    return FetchResult(url, status_code=response.status_code, error_status=413, error=too_large_error)
+                body, content_hash = read
 
-            print(f"Successfully fetched and parsed content ({len(text)} characters) from {url}")
-            return text
+            return FetchResult(url, status_code=response.status_code, etag=response.headers.get("ETag"),
+                               last_modified=response.headers.get("Last-Modified"), content_hash=content_hash,
+                               final_url=str(response.url), body=body, content_type=content_type)
 
         except httpx.TimeoutException:
-            print(f"Request timed out for URL: {url}")
-            return "Error: The request timed out while trying to fetch the webpage."
+            logger.warning(f"Request timed out for URL: {url}")
+            return FetchResult(url, retryable=True, error_status=408,
+                               error="Error: The request timed out while trying to fetch the webpage.")
         except httpx.RequestError as e: # More general network/request error
-            print(f"Request error occurred while fetching {url}: {str(e)}")
-            return f"Error: Could not access the webpage. Network issue or invalid URL ({str(e)})"
+            logger.warning(f"Request error occurred while fetching {url}: {str(e)}")
+            return FetchResult(url, retryable=True,
+                               error=f"Error: Could not access the webpage. Network issue or invalid URL ({str(e)})")
         except httpx.HTTPStatusError as e: # For 4xx/5xx responses
-            print(f"HTTP status error occurred while fetching {url}: {str(e)}")
-            return f"Error: Could not access the webpage. Status code: {e.response.status_code} ({str(e)})"
+            logger.warning(f"HTTP status error occurred while fetching {url}: {str(e)}")
+            status = e.response.status_code
+            retry_after = e.response.headers.get("Retry-After")
+            if status == 429 or (status == 503 and retry_after):
+                self.rate_limiter.penalize(host, parse_retry_after(retry_after))
+            return FetchResult(url, status_code=status, retryable=status == 429 or status >= 500,
+                               error_status=404 if status == 404 else 400,
+                               error=f"Error: Could not access the webpage. Status code: {e.response.status_code} ({str(e)})")
+        except Exception as e:
+            logger.error(f"Error fetching content from {url}: {type(e).__name__} - {str(e)}")
+            return FetchResult(url, error=f"Error: An unexpected error occurred while fetching the webpage ({str(e)})")
+
+    async def fetch(self, url: str, namespace: str = "", use_cache: bool = True,
+                    want_links: bool = False) -> FetchResult:
+        """
+        Fetches and parses a webpage. With use_cache, sends the validators stored
+        for (namespace, url) and returns not_modified=True, without parsing,
+        when the server answers 304 or the body hash is unchanged.
+        With want_links, the page's outgoing links are returned in `links`; no
+        validators are sent then, so that even unchanged pages can be followed.
+        Call remember() once the content has been stored.
+        """
+        cached = await run_ingest_blocking(self.cache.get, url, namespace) if use_cache else None
+        headers = {}
+        if cached and not want_links:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        with span("web_fetch"):
+            result = await self._download(url, headers)
+        if result.error is not None:
+            return result
+        if result.not_modified:
+            if not headers:
+                return FetchResult(url, status_code=304, error="Error: Unexpected 304 response to an unconditional request.")
+            logger.info(f"Content not modified (304) at {url}")
+            result.etag, result.last_modified = cached["etag"], cached["last_modified"]
+            result.content_hash = cached["content_hash"]
+            return result
+
+        body, result.body = result.body, None
+        unchanged = bool(cached) and cached["content_hash"] == result.content_hash
+        if unchanged:
+            logger.info(f"Content unchanged (same hash) at {url}")
+            result.not_modified = True
+            if not want_links:
+                return result
+
+        try:
+            # Parsing is CPU-bound: keep it off the event loop
+            loop = asyncio.get_running_loop()
+            with span("html_parse"):
+                page = await loop.run_in_executor(get_parse_pool(), extract_page, body, result.content_type,
+                                                  result.final_url or url, want_links)
         except Exception as e:
-            print(f"Error fetching content from {url}: {type(e).__name__} - {str(e)}")
-            return f"Error: An unexpected error occurred while fetching the webpage ({str(e)})"
+            logger.error(f"Error parsing content from {url}: {type(e).__name__} - {str(e)}")
+            return FetchResult(url, error=f"Error: An unexpected error occurred while parsing the webpage ({str(e)})")
+        result.links = page["links"]
+        result.canonical_url = page["canonical"]
+        if unchanged:
+            return result
+        result.text = page["text"]
+
+        # MAX_TEXT_LENGTH = 8000 
+        # if len(text) > MAX_TEXT_LENGTH:
+        #     text = text[:MAX_TEXT_LENGTH] + "... [content truncated]"
+
+        logger.info(f"Successfully fetched and parsed content ({len(result.text)} characters) from {url}")
+        return result
+
+    async def fetch_raw(self, url: str, allowed_types: tuple) -> FetchResult:
+        """Downloads a non-HTML resource (e.g. a sitemap) with the same rate limit and size cap; bytes are in `body`."""
+        with span("web_fetch"):
+            return await self._download(url, allowed_types=allowed_types)
+
+    async def remember(self, result: FetchResult, namespace: str = ""):
+        """Stores a successful fetch's validators, so the next fetch of the URL can be skipped if unchanged."""
+        if result.error is None and result.content_hash:
+            await run_ingest_blocking(self.cache.put, result.url, result.etag, result.last_modified,
+                                      result.content_hash, namespace)
+
+    async def fetch_and_parse(self, url: str) -> str:
+        """Fetch and parse content from a webpage (always downloads; returns an "Error: ..." string on failure)"""
+        result = await self.fetch(url, use_cache=False)
+        return result.error if result.error is not None else result.text